@@ -0,0 +1,76 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Per-chunk cost of turning streamed partials into deltas, legacy vs StreamDeltaTracker.
+
+Run from backend/:  python -m benchmarks.bench_delta_tracker [--chars 50000] [--chunk 4]
+
+The legacy loop (startswith on the accumulated text + _compute_delta + string concatenation)
+gets slower as the answer grows; the tracker's per-chunk cost should stay flat.
+"""
+
+import argparse
+import os
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "bench-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.bench.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from src.services.ai_service import StreamDeltaTracker, _compute_delta  # noqa: E402
+
+
+def _legacy(partials):
+    last_sent = ""
+    last_full = ""
+    timings = []
+    for text in partials:
+        start = time.perf_counter()
+        candidate_full = text if text.startswith(last_full) else last_full + text
+        delta = _compute_delta(last_sent, candidate_full)
+        if delta:
+            last_sent += delta
+        last_full = candidate_full
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _tracker(partials):
+    tracker = StreamDeltaTracker()
+    timings = []
+    for text in partials:
+        start = time.perf_counter()
+        tracker.feed(text)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _report(name, timings, buckets=5):
+    size = max(1, len(timings) // buckets)
+    cols = []
+    for i in range(buckets):
+        part = timings[i * size:(i + 1) * size] or [0.0]
+        cols.append(f"{sum(part) / len(part) * 1e6:8.2f}")
+    print(f"{name:<22}" + " ".join(cols) + f"   total {sum(timings) * 1e3:8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chars", type=int, default=50_000)
+    parser.add_argument("--chunk", type=int, default=4, help="characters added per partial")
+    args = parser.parse_args()
+
+    text = ("流式输出 streaming output, " * (args.chars // 20 + 1))[:args.chars]
+    cumulative = [text[:end] for end in range(args.chunk, len(text) + 1, args.chunk)]
+    fragments = [text[i:i + args.chunk] for i in range(0, len(text), args.chunk)]
+
+    print(f"{args.chars} chars, {len(cumulative)} chunks; avg us/chunk per answer quintile")
+    _report("legacy cumulative", _legacy(cumulative))
+    _report("tracker cumulative", _tracker(cumulative))
+    _report("legacy fragments", _legacy(fragments))
+    _report("tracker fragments", _tracker(fragments))
+
+
+if __name__ == "__main__":
+    main()
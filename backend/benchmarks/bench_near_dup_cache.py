@@ -0,0 +1,86 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Lookup latency of the MinHash/LSH near-duplicate cache with a large index.
+
+Run from backend/:  python -m benchmarks.bench_near_dup_cache [--entries 1000000] [--queries 2000]
+
+The index is filled with random signatures (building 1M real prompts only measures the
+hasher), then real prompts are inserted and looked up: exact repeats, near duplicates
+and unrelated prompts. Lookup time includes signature computation.
+"""
+
+import argparse
+import os
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "bench-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.bench.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+import numpy as np  # noqa: E402
+
+from src.services.near_dup_cache import NearDuplicateCache  # noqa: E402
+
+TOPICS = ["password reset", "billing invoice", "export my data", "delete my account", "change the language",
+          "two factor login", "api rate limits", "team workspace", "refund policy", "mobile app sync"]
+
+
+def _prompt(i):
+    return f"Hi, could you explain how {TOPICS[i % len(TOPICS)]} works for customer number {i}? Thanks a lot"
+
+
+def _near(text):
+    return text.replace("Hi, could you", "hi can you").replace("Thanks a lot", "thanks a lot!!")
+
+
+def _pct(timings, q):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100.0))] * 1e6
+
+
+def _report(name, timings, hits):
+    print(f"{name:<12} p50 {_pct(timings, 50):8.1f} us   p99 {_pct(timings, 99):8.1f} us   hits {hits}/{len(timings)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--num-perm", type=int, default=64)
+    parser.add_argument("--bands", type=int, default=8)
+    parser.add_argument("--threshold", type=float, default=0.8)
+    args = parser.parse_args()
+
+    cache = NearDuplicateCache(
+        max_entries=args.entries, threshold=args.threshold, num_perm=args.num_perm, bands=args.bands,
+    )
+    rng = np.random.default_rng(0)
+    filler = args.entries - args.queries
+    start = time.perf_counter()
+    for block in range(0, filler, 100_000):
+        sigs = rng.integers(0, 1 << 32, size=(min(100_000, filler - block), args.num_perm), dtype=np.uint32)
+        for sig in sigs:
+            cache.add_signature(sig, 0, "filler")
+    prompts = [_prompt(i) for i in range(args.queries)]
+    for text in prompts:
+        cache.add(text, "answer")
+    print(f"built {len(cache)} entries in {time.perf_counter() - start:.1f}s, "
+          f"index arrays {cache.stats()['index_bytes'] / 2 ** 20:.0f} MiB")
+
+    for name, queries in (
+            ("exact", prompts),
+            ("near-dup", [_near(p) for p in prompts]),
+            ("unrelated", [f"Write a haiku about the sea and lighthouse keeper {i}" for i in range(args.queries)]),
+    ):
+        timings, hits = [], 0
+        for text in queries:
+            t0 = time.perf_counter()
+            hits += cache.lookup(text) is not None
+            timings.append(time.perf_counter() - t0)
+        _report(name, timings, hits)
+
+
+if __name__ == "__main__":
+    main()
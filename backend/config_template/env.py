@@ -33,6 +33,7 @@ if config.config_file_name is not None:
 
 # === 第五步：导入你的模型 ===
 from src.models.conversation import Conversation
+from src.models.conversation_summary import ConversationSummary
 from src.models.message import Message
 from src.models.user import User
 
@@ -3,23 +3,137 @@
 # @Email   : pi.apple.lab@gmail.com
 import json
 import logging
+import re
+import time
 
 from fastapi import APIRouter, Request, Depends
 # 在文件顶部确保导入以下
 from fastapi import HTTPException
+from starlette.background import BackgroundTask
 from pydantic_ai.ag_ui import handle_ag_ui_request
 from pydantic_ai.ui.ag_ui import AGUIAdapter
 
 # ToolReturn is optional if you want to wrap results; ToolReturn / ModelRetry can also be used if needed
 
+from src.services.admission import AdmissionLease, AdmissionRejected, admission_controller
 from src.services.agentic_service import get_or_create_agent
+from src.services.context_service import estimate_tokens
+from src.services.degradation import degradation_controller
+from src.services.disconnect_guard import ClientDisconnected, cancel_on_disconnect, disconnect_stats
+from src.services.llm_router import LLMEndpoint, provider_router
+from src.services.scheduler import PRIORITY_AGENT
 from src.common.auth_bearer import get_current_user
-from typing import Dict
+from src.common.config import settings
+from typing import Any, AsyncIterator, Dict
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/agui", tags=["agui"])
 
+_EVENT_TYPE = re.compile(r'"type"\s*:\s*"([A-Z_]+)"')
+
+
+def _event_type(chunk: Any) -> str:
+    text = chunk.decode("utf-8", "ignore") if isinstance(chunk, bytes) else str(chunk)
+    match = _EVENT_TYPE.search(text)
+    return match.group(1) if match else ""
+
+
+async def _route_event_stream(body: AsyncIterator[Any], endpoint: LLMEndpoint) -> AsyncIterator[Any]:
+    """
+    把一次 agent 运行的首字延迟与成败反馈给 provider_router（与 chat 的 _stream_routed 一致）。
+    RUN_STARTED 在调用模型之前就已发出，首字延迟取其后的第一个事件；
+    运行中的异常由 AG-UI 转成 RUN_ERROR 事件而不是抛出，同样记为失败。客户端断开（取消）不计成败。
+    """
+    start = time.perf_counter()
+    first = True
+    failed = False
+    provider_router.begin(endpoint)
+    try:
+        async for chunk in body:
+            event_type = _event_type(chunk)
+            if first and event_type not in ("RUN_STARTED", "RUN_ERROR"):
+                first = False
+                provider_router.record_ttft(endpoint, (time.perf_counter() - start) * 1000.0)
+            if event_type == "RUN_ERROR":
+                failed = True
+            yield chunk
+    except Exception:
+        provider_router.record_failure(endpoint)
+        raise
+    else:
+        if failed:
+            provider_router.record_failure(endpoint)
+        else:
+            provider_router.record_success(endpoint)
+    finally:
+        provider_router.end(endpoint)
+
+
+async def _guard_event_stream(body: AsyncIterator[Any], request: Request, lease: AdmissionLease) -> AsyncIterator[Any]:
+    """
+    客户端断开时取消 agent 运行（包括进行中的工具调用）。AG-UI 的会话状态由前端保存，这里不落库；
+    token 数按已发出的事件流文本估算，仅用于统计节省量。运行结束或取消时释放准入名额。
+    """
+    stats = disconnect_stats["agui"]
+    emitted = 0
+    finished = False
+    try:
+        async for chunk in cancel_on_disconnect(body, request.is_disconnected, settings.SSE_DISCONNECT_POLL_SECONDS):
+            emitted += estimate_tokens(chunk.decode("utf-8", "ignore") if isinstance(chunk, bytes) else str(chunk))
+            yield chunk
+        finished = True
+        stats.record_completed(emitted)
+    except ClientDisconnected:
+        logger.info("AG-UI 客户端已断开，取消 agent 运行")
+    finally:
+        lease.release()
+        if not finished:
+            saved = stats.record_cancelled(emitted)
+            logger.info(f"AG-UI run cancelled, estimated tokens saved={saved}")
+
+
+async def _admit_run(current_user: Dict) -> AdmissionLease:
+    """
+    负载降级到 shed 级别时拒绝新的运行（503）；
+    准入控制：单用户并发超限立即 429；排队等待上游名额，队列满或超时 503
+    """
+    try:
+        degradation_controller.check_admission()
+        lease = admission_controller.admit(current_user.get("user_id"))
+        try:
+            await lease.acquire_upstream(PRIORITY_AGENT)
+        except BaseException:
+            lease.release()
+            raise
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail,
+                            headers={**e.headers, **degradation_controller.headers()})
+    return lease
+
+
+def _guard_response(response: Any, request: Request, lease: AdmissionLease, endpoint: LLMEndpoint) -> Any:
+    """
+    给 AG-UI 返回的流式响应套上路由反馈与断开保护，由 _guard_event_stream 在运行结束时释放准入名额。
+    body 从未被迭代时（例如客户端在开始发送前断开）生成器的 finally 不会执行，
+    由响应的 background 在发送结束后兜底释放（release 可重复调用，已释放时不做任何事）。
+    """
+    response.headers.update(degradation_controller.headers())
+    if getattr(response, "body_iterator", None) is None:
+        lease.release()
+        return response
+    response.body_iterator = _guard_event_stream(_route_event_stream(response.body_iterator, endpoint), request, lease)
+    background = response.background
+
+    async def release_after_send():
+        if not lease.released:
+            lease.release()
+        if background is not None:
+            await background()
+
+    response.background = BackgroundTask(release_after_send)
+    return response
+
 
 @router.post("/agent", response_model=None)
 async def agui_agent_endpoint(
@@ -35,13 +149,20 @@ async def agui_agent_endpoint(
     except Exception as e:
         logging.warning(f"Failed to log body: {e}")
 
+    lease = await _admit_run(current_user)
     agent = get_or_create_agent()
+    # 每次运行选择当前最优的健康端点
+    endpoint = provider_router.choose()
 
     try:
-        # handle_ag_ui_request 会返回 StreamingResponse
-        response = await handle_ag_ui_request(request=request, agent=agent)
-        return response
+        # handle_ag_ui_request 会返回 StreamingResponse；负载降级时限制最大输出 token（tool_search 由 agent 按等级停用）
+        response = await handle_ag_ui_request(
+            request=request, agent=agent, model=provider_router.model_for(endpoint),
+            model_settings=degradation_controller.model_settings(),
+        )
+        return _guard_response(response, request, lease, endpoint)
     except Exception as e:
+        lease.release()
         logging.exception("AG-UI run failed")
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -61,7 +182,10 @@ async def agui_deferred_results(
     if current_user is None:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+    # 批准工具调用后 agent 会继续运行并调用模型，与 /agent 一样经过准入、降级、端点路由与断开保护
+    lease = await _admit_run(current_user)
     agent = get_or_create_agent()
+    endpoint = provider_router.choose()
 
     # 关键修改：处理 deferred_results 中的工具调用批准
     deferred_results = request_json.get('deferred_results', [])
@@ -82,7 +206,12 @@ async def agui_deferred_results(
 
     try:
         # AGUIAdapter.dispatch_request 会处理工具结果的返回
-        return await AGUIAdapter.dispatch_request(request, agent=agent)
+        response = await AGUIAdapter.dispatch_request(
+            request, agent=agent, model=provider_router.model_for(endpoint),
+            model_settings=degradation_controller.model_settings(),
+        )
+        return _guard_response(response, request, lease, endpoint)
     except Exception as e:
+        lease.release()
         logging.exception("AG-UI deferred_results dispatch failed")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,122 +1,229 @@
 # @Home    : www.pi-apple.com
 # @Author  : Leon
 # @Email   : pi.apple.lab@gmail.com
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
 from src.common.auth_bearer import get_current_user
-from src.db.session import get_db
+from src.common.config import settings
+from src.services.admission import AdmissionRejected, admission_controller
+from src.db.session import async_session_scope, get_pool_status
 from src.schemas.chat import ChatRequest
-from src.services.ai_service import stream_chat_response
-from src.crud.crud_conversation import conversation
-from src.crud.crud_message import create_message
-from typing import Dict, List, Any
+from src.services.ai_service import MODEL_NAME, SYSTEM_PROMPT, stream_chat_response
+from src.crud.crud_conversation import async_conversation
+from src.services.degradation import degradation_controller
+from src.services.context_service import estimate_tokens, load_conversation_context, trim_history
+from src.services.disconnect_guard import (
+    TRUNCATED_MARKER, ClientDisconnected, cancel_on_disconnect, disconnect_stats, run_detached,
+)
+from src.services.message_writer import message_writer
+from src.services.scheduler import PRIORITY_INTERACTIVE
+from src.services.stream_buffer import ReplayGap, TurnBuffer, stream_buffers
+from src.services.stream_coalescer import coalesce_deltas
+from src.services.summary_service import summary_service
+from typing import Any, AsyncIterator, Dict, List, Tuple
+import asyncio
 import json
 import logging
 
 logger = logging.getLogger(__name__)
-try:
-    from src.crud.crud_message import get_messages_by_conversation
-except Exception as e:
-    logger.warning(f"未找到 get_messages_by_conversation 函数，将无法从 DB 拉取历史消息: {e}")
-    # 如果不存在此函数，后面会回退为不从 DB 拉历史（但强烈建议实现该 CRUD）
-    get_messages_by_conversation = None  # type: ignore
 
 router = APIRouter(tags=["chat"])
 
+# 告诉中间代理不要缓冲或变换（提高流式交付的可能性）
+SSE_HEADERS = {
+    "Cache-Control": "no-cache, no-transform",
+    "X-Accel-Buffering": "no",
+    "Connection": "keep-alive",
+}
+
 
 @router.post("/chat", response_model=None)
 async def chat(
         request: ChatRequest,
-        db: Session = Depends(get_db),
+        http_request: Request,
         current_user: Dict = Depends(get_current_user)
 ):
     if current_user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
-    # 确保会话存在
-    conversation_id = conversation.create_conversation_if_not_exists(db, request.conversation_id)
+    # 断线重连：带 Last-Event-ID 时从续传缓冲区重放，不重新生成
+    last_event_id = http_request.headers.get("last-event-id")
+    if last_event_id:
+        return _resume_stream(last_event_id, http_request, current_user)
 
-    # --------- 构造 history（优先用 client 提供的 request.history，否则从 DB 拉取） ----------
-    history: List[Dict[str, str]] = []
+    # 负载降级到 shed 级别时拒绝新的生成（503）；
+    # 准入控制：单用户并发超限立即 429；需要调用上游时排队等待全局名额，队列满或超时 503
     try:
-        if request.history and isinstance(request.history, list):
-            # use client's provided history (defensive copy)
-            history = [dict(r) for r in request.history]
-        else:
-            # client 未提供 history：尝试从 DB 读取历史消息（按时间顺序）
-            if get_messages_by_conversation:
-                try:
-                    msgs = get_messages_by_conversation(db, conversation_id)
-                    # msgs 期望是一个可迭代的 ORM 对象集合，每项含有 role/content/timestamp 等
-                    history = []
-                    for m in msgs:
-                        # 兼容 ORM 属性或 dict
-                        role = getattr(m, "role", None) or (m.get("role") if isinstance(m, dict) else None)
-                        content = getattr(m, "content", None) or (m.get("content") if isinstance(m, dict) else None)
-                        if role and content is not None:
-                            history.append({"role": role, "content": content})
-                except Exception as ex:
-                    logging.exception(f"从 DB 获取会话历史失败，将降级为空历史: {ex}")
-                    history = []
-            else:
-                # 没有可用的 DB 获取函数，降级为空历史（但建议实现）
-                history = []
-    except Exception as ex:
-        logging.exception(f"history 构造异常，降级为空历史: {ex}")
-        history = []
-
-    # 在 history 基础上 append 本次 user 消息，形成发送给模型的完整上下文
-    full_history = history + [{"role": "user", "content": request.message}]
-
-    # 保存 user 消息到数据库（在构造好 full_history 后执行，避免读取历史时包含刚写入的一条造成重复）
+        degradation_controller.check_admission()
+        lease = admission_controller.admit(current_user.get("user_id"))
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail,
+                            headers={**e.headers, **degradation_controller.headers()})
+    started = False
     try:
-        create_message(db, conversation_id, "user", request.message)
-    except Exception as ex:
-        logging.exception(f"保存 user 消息到 DB 失败（非致命）:{ex}")
+        # 流开始前的读取放在同一个短 Session 中完成；流式生成期间不持有任何数据库连接
+        async with async_session_scope() as db:
+            # 确保会话存在
+            conversation_id = await async_conversation.create_conversation_if_not_exists(db, request.conversation_id)
+
+            # --------- 构造 history（优先用 client 提供的 request.history，否则从 DB 拉取） ----------
+            history: List[Dict[str, str]] = []
+            try:
+                if request.history and isinstance(request.history, list):
+                    # use client's provided history (defensive copy)，同样只保留预算内最新的部分
+                    history = trim_history([dict(r) for r in request.history])
+                else:
+                    # client 未提供 history：滚动摘要 + 最近的、满足预算的消息（倒序 LIMIT 查询，按时间正序返回）
+                    try:
+                        history = await load_conversation_context(db, conversation_id)
+                    except Exception as ex:
+                        logging.exception(f"从 DB 获取会话历史失败，将降级为空历史: {ex}")
+                        history = []
+            except Exception as ex:
+                logging.exception(f"history 构造异常，降级为空历史: {ex}")
+                history = []
 
-    # ------------------------------------------------------------------------------
+        # 负载降级到 cap_history 及以上时只保留最近的若干条历史（滚动摘要保留在最前）
+        history_limit = degradation_controller.history_limit()
+        if history_limit and len(history) > history_limit:
+            summary = history[:1] if history[0].get("role") == "system" else []
+            history = summary + trim_history(history[len(summary):], max_messages=history_limit)
 
-    async def event_generator():
-        """
-        event_generator 会不断 yield SSE 事件块（字符串），格式为 "data: <json>\n\n"。
-        stream_chat_response 已保证返回 delta（新增后缀），但实现要兼容任意返回情况。
-        """
-        full_response = ""
+        # 在 history 基础上 append 本次 user 消息，形成发送给模型的完整上下文
+        full_history = history + [{"role": "user", "content": request.message}]
 
-        # 发一个 comment 以尽早触发代理 flush（对某些代理有帮助）
-        yield ":\n\n"
+        # 相同上下文的生成正在进行时合并到它上面，不再调用一次模型；否则排队等待一个上游生成名额
+        context_key = stream_buffers.fanout_key(full_history, MODEL_NAME, SYSTEM_PROMPT)
+        origin = stream_buffers.find_inflight(context_key)
+        if origin is None:
+            await lease.acquire_upstream(PRIORITY_INTERACTIVE)
 
+        # 保存 user 消息到数据库（在构造好 full_history 后执行，避免读取历史时包含刚写入的一条造成重复）
+        # 由 write-behind 队列与其他会话的消息合并为批量 INSERT
         try:
-            async for chunk in stream_chat_response(full_history):
-                if not chunk:
-                    continue
-                # chunk 期望是“新增后缀”（delta）文本；追加并发送
-                full_response += chunk
-                yield f"data: {json.dumps({'content': chunk}, ensure_ascii=False)}\n\n"
-
-            # 流结束，将完整 assistant 回答保存入 DB
-            try:
-                create_message(db, conversation_id, "assistant", full_response)
-            except Exception as ep:
-                logging.exception(f"保存 assistant 消息到 DB 失败（非致命）:{ep}")
-
-            yield "data: [DONE]\n\n"
-        except Exception as e:
-            logging.exception("聊天流异常")
-            error_msg = f"[Stream Error: {str(e)}]"
+            await message_writer.write(conversation_id, "user", request.message)
+        except Exception as ex:
+            logging.exception(f"保存 user 消息到 DB 失败（非致命）:{ex}")
+
+        # ------------------------------------------------------------------------------
+
+        async def save_truncated(partial: str):
+            """生成被放弃：保存已生成的部分回答（带中断标记）"""
+            await message_writer.write(conversation_id, "assistant", partial + TRUNCATED_MARKER)
+            summary_service.schedule(conversation_id)
+
+        async def produce(buffer: TurnBuffer):
+            """
+            在后台任务中运行生成，把 SSE 帧写入续传缓冲区；客户端连接只是订阅者。
+            合并到进行中的相同生成时，改为转发它的输出，回答照常保存到本会话。
+            stream_chat_response 已保证返回 delta（新增后缀），但实现要兼容任意返回情况。
+            细碎的 delta 经 coalesce_deltas 按时间/字节窗口合并后再写帧（首个 delta 立即发送）。
+            所有订阅者离开超过宽限期后任务被取消，已生成的部分回答带中断标记落库。
+            """
+            full_response = ""
+            frames = 0
+            logger.debug(f"chat stream start, conversation={conversation_id}, turn={buffer.key}, "
+                         f"shared_with={origin.key if origin else None}, pool={get_pool_status()}")
+            if origin is not None:
+                chunks = _fanout_chunks(origin)
+            else:
+                chunks = coalesce_deltas(stream_chat_response(full_history))
             try:
-                create_message(db, conversation_id, "assistant", error_msg)
-            except Exception as ep:
-                logging.exception(f"保存错误消息到 DB 失败（非致命）:{ep}")
-            yield f"data: {json.dumps({'content': error_msg}, ensure_ascii=False)}\n\n"
-            yield "data: [DONE]\n\n"
-
-    # 告诉中间代理不要缓冲或变换（提高流式交付的可能性）
-    headers = {
-        "Cache-Control": "no-cache, no-transform",
-        "X-Accel-Buffering": "no",
-        "Connection": "keep-alive",
-    }
-
-    return StreamingResponse(event_generator(), media_type="text/event-stream; charset=utf-8", headers=headers)
+                async for chunk in chunks:
+                    if not chunk:
+                        continue
+                    # chunk 期望是“新增后缀”（delta）文本；追加并发送
+                    full_response += chunk
+                    frames += 1
+                    stream_buffers.append(buffer, json.dumps({'content': chunk}, ensure_ascii=False))
+
+                # 流结束，将完整 assistant 回答交给 write-behind 队列保存
+                disconnect_stats["chat"].record_completed(estimate_tokens(full_response))
+                try:
+                    await message_writer.write(conversation_id, "assistant", full_response)
+                    # 后台刷新滚动摘要，不阻塞本轮及后续请求
+                    summary_service.schedule(conversation_id)
+                except Exception as ep:
+                    logging.exception(f"保存 assistant 消息到 DB 失败（非致命）:{ep}")
+
+                stream_buffers.append(buffer, "[DONE]")
+            except asyncio.CancelledError:
+                saved = disconnect_stats["chat"].record_cancelled(estimate_tokens(full_response))
+                logger.info(f"chat stream cancelled, conversation={conversation_id}, frames={frames}, "
+                            f"estimated tokens saved={saved}")
+                if full_response:
+                    run_detached(save_truncated(full_response), "保存被中断的 assistant 消息")
+                raise
+            except Exception as e:
+                logging.exception("聊天流异常")
+                error_msg = f"[Stream Error: {str(e)}]"
+                try:
+                    await message_writer.write(conversation_id, "assistant", error_msg)
+                except Exception as ep:
+                    logging.exception(f"保存错误消息到 DB 失败（非致命）:{ep}")
+                stream_buffers.append(buffer, json.dumps({'content': error_msg}, ensure_ascii=False))
+                stream_buffers.append(buffer, "[DONE]")
+            finally:
+                lease.release()
+                logger.debug(f"chat stream end, conversation={conversation_id}, frames={frames}, pool={get_pool_status()}")
+
+        started = True
+        buffer = stream_buffers.start(
+            conversation_id, current_user.get("user_id"), produce,
+            context_key=context_key if origin is None else None,
+        )
+        return StreamingResponse(
+            _sse_events(stream_buffers.subscribe(buffer), http_request),
+            media_type="text/event-stream; charset=utf-8",
+            headers={**SSE_HEADERS, **degradation_controller.headers()},
+        )
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail,
+                            headers={**e.headers, **degradation_controller.headers()})
+    finally:
+        # 生成任务启动后由它负责释放名额
+        if not started:
+            lease.release()
+
+
+async def _fanout_chunks(origin: TurnBuffer) -> AsyncIterator[str]:
+    """订阅进行中的相同生成：先拿到已生成的前缀，再跟随实时输出；上游没有正常结束时抛出异常"""
+    async for _, data in stream_buffers.subscribe(origin, fanout=True):
+        if data == "[DONE]":
+            return
+        yield json.loads(data).get("content", "")
+    raise RuntimeError("合并的上游生成已中断")
+
+
+def _resume_stream(last_event_id: str, http_request: Request, current_user: Dict) -> StreamingResponse:
+    """按 Last-Event-ID 重放错过的帧并接上实时生成，不发起新的上游请求"""
+    parsed = stream_buffers.parse_event_id(last_event_id)
+    buffer = stream_buffers.get(parsed[0]) if parsed else None
+    if buffer is None or buffer.user_id != current_user.get("user_id"):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Stream not found or expired")
+    after = parsed[1]
+    if not buffer.can_replay(after):
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Stream position is no longer buffered")
+    logger.info(f"chat stream resume, turn={buffer.key}, after={after}, last={buffer.last_seq}")
+    return StreamingResponse(
+        _sse_events(stream_buffers.subscribe(buffer, after=after, resume=True), http_request),
+        media_type="text/event-stream; charset=utf-8",
+        headers=SSE_HEADERS,
+    )
+
+
+async def _sse_events(events: AsyncIterator[Tuple[str, str]], http_request: Request):
+    """
+    把缓冲区的帧写成带 id 的 SSE 事件（"id: <turn>:<seq>\ndata: <json>\n\n"），客户端断线重连时带上 Last-Event-ID 续传。
+    轮询 is_disconnected 发现断开后立即退订。
+    """
+    # 发一个 comment 以尽早触发代理 flush（对某些代理有帮助）
+    yield ":\n\n"
+    try:
+        async for event_id, data in cancel_on_disconnect(
+                events, http_request.is_disconnected, poll_interval=settings.SSE_DISCONNECT_POLL_SECONDS):
+            yield f"id: {event_id}\ndata: {data}\n\n"
+    except ClientDisconnected:
+        logger.info("客户端已断开，退订生成")
+    except ReplayGap as e:
+        logger.warning(f"续传缓冲区帧已被淘汰: {e}")
@@ -0,0 +1,118 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import logging
+from typing import Dict
+
+from fastapi import APIRouter, Depends, Query
+from src.common.auth_bearer import get_current_user
+from src.db.session import get_pool_stats, get_query_stats
+from src.services.admission import admission_controller
+from src.services.degradation import degradation_controller
+from src.services.disconnect_guard import disconnect_stats
+from src.services.llm_hedging import llm_hedger
+from src.services.llm_providers import provider_registry
+from src.services.llm_router import provider_router
+from src.services.message_writer import message_writer
+from src.services.near_dup_cache import near_dup_cache
+from src.services.response_cache import response_cache
+from src.services.search_service import result_shaper, search_cache, search_executor, search_orchestrator
+from src.services.stream_buffer import stream_buffers
+from src.services.stream_coalescer import coalesce_stats
+from src.services.summary_service import summary_service
+
+logger = logging.getLogger(__name__)
+router = APIRouter(prefix="/metrics", tags=["metrics"])
+
+
+@router.get("/db/pool")
+async def db_pool_metrics(current_user: Dict = Depends(get_current_user)):
+    """数据库连接池占用与遥测（checkout 等待时间、峰值占用、overflow、超时次数）"""
+    return get_pool_stats()
+
+
+@router.get("/db/queries")
+async def db_query_metrics(
+        top: int = Query(20, ge=1, le=500),
+        order_by: str = Query("total_ms", pattern="^(total_ms|count|max_ms|avg_ms|p95_ms)$"),
+        current_user: Dict = Depends(get_current_user),
+):
+    """按语句指纹聚合的查询统计（count/total/p50/p95），用于定位热点查询"""
+    return get_query_stats(top=top, order_by=order_by)
+
+
+@router.get("/messages/writer")
+async def message_writer_metrics(current_user: Dict = Depends(get_current_user)):
+    """write-behind 消息写入队列：队列深度、批次数、平均批大小、失败数"""
+    return message_writer.stats()
+
+
+@router.get("/summaries")
+async def summary_metrics(current_user: Dict = Depends(get_current_user)):
+    """滚动摘要后台任务：运行中数量、更新次数、版本冲突与失败次数"""
+    return summary_service.stats()
+
+
+@router.get("/chat/stream")
+async def chat_stream_metrics(current_user: Dict = Depends(get_current_user)):
+    """聊天流 SSE 帧合并：每个响应的平均帧数（写出次数）、每帧合并的 delta 数、各类 flush 次数"""
+    return coalesce_stats.snapshot()
+
+
+@router.get("/admission")
+async def admission_metrics(current_user: Dict = Depends(get_current_user)):
+    """准入控制：进行中的上游生成、排队数、排队等待时间分布与各原因的拒绝次数"""
+    return admission_controller.stats()
+
+
+@router.get("/degradation")
+async def degradation_metrics(current_user: Dict = Depends(get_current_user)):
+    """负载降级：当前服务等级、压力及各信号（进行中生成数、事件循环延迟、首字延迟）、等级切换记录与拒绝次数"""
+    return degradation_controller.stats()
+
+
+@router.get("/streams/disconnects")
+async def stream_disconnect_metrics(current_user: Dict = Depends(get_current_user)):
+    """客户端中途断开：各路由的取消次数、取消前已产出的 token 与估算节省的 token"""
+    return {route: stats.snapshot() for route, stats in disconnect_stats.items()}
+
+
+@router.get("/streams/buffers")
+async def stream_buffer_metrics(current_user: Dict = Depends(get_current_user)):
+    """续传缓冲区：缓冲中的生成数与字节数、续传次数、重放帧数、无法续传次数与被放弃的生成"""
+    return stream_buffers.stats()
+
+
+@router.get("/llm/cache")
+async def response_cache_metrics(current_user: Dict = Depends(get_current_user)):
+    """LLM 回答缓存（精确匹配与近似重复）：命中/未命中次数、命中率、内存占用字节数、回放字节数、淘汰与策略跳过次数"""
+    return {"exact": response_cache.stats(), "near_duplicate": near_dup_cache.stats()}
+
+
+@router.get("/llm/connections")
+async def llm_connection_metrics(current_user: Dict = Depends(get_current_user)):
+    """LLM provider 共享连接池：请求数、新建连接与复用比例、TLS 握手次数与耗时"""
+    return provider_registry.stats()
+
+
+@router.get("/llm/router")
+async def llm_router_metrics(current_user: Dict = Depends(get_current_user)):
+    """LLM 端点路由：各端点 EWMA 首字延迟、错误率、进行中请求数、冷却状态与 TTFT 分布"""
+    return provider_router.stats()
+
+
+@router.get("/llm/hedging")
+async def llm_hedging_metrics(current_user: Dict = Depends(get_current_user)):
+    """LLM 请求对冲：对冲比例、主请求 / 对冲请求胜出次数、被取消的请求数与对冲延迟分布"""
+    return llm_hedger.stats()
+
+
+@router.get("/search")
+async def search_metrics(current_user: Dict = Depends(get_current_user)):
+    """搜索工具：结果缓存、搜索线程池、对冲搜索各后端的延迟分布与胜出次数，以及结果整形的压缩比"""
+    return {
+        "cache": search_cache.stats(),
+        "executor": search_executor.stats(),
+        "backends": search_orchestrator.stats(),
+        "shaping": result_shaper.stats(),
+    }
@@ -2,6 +2,7 @@
 # @Author  : Leon
 # @Email   : pi.apple.lab@gmail.com
 import os
+from typing import Literal
 
 from pydantic_settings import BaseSettings
 from functools import lru_cache
@@ -14,6 +15,121 @@ class Settings(BaseSettings):
     OPENAI_BASE_URL: str = os.getenv("OPENAI_BASE_URL")
     DATABASE_URL: str = os.getenv("DATABASE_URL")
 
+    # Database connection pool settings（每个 worker 进程、每个引擎各自生效）
+    DB_POOL_SIZE: int = 5  # 常驻连接数
+    DB_MAX_OVERFLOW: int = 10  # 超出 pool_size 后允许临时创建的连接数
+    DB_POOL_TIMEOUT: float = 30.0  # 等待空闲连接的最长秒数，超时抛出 TimeoutError
+    DB_POOL_RECYCLE: int = 1800  # 连接最长存活秒数，-1 表示不回收
+    DB_POOL_PRE_PING: bool = True  # checkout 前探测连接是否可用
+
+    # SQL logging / query timing
+    DB_ECHO: bool = False  # 仅调试时开启：同步打印每条 SQL 及参数
+    DB_SLOW_QUERY_MS: float = 200.0  # 超过该耗时的语句才写慢查询日志
+    DB_QUERY_STATS_MAX_FINGERPRINTS: int = 500  # 按指纹聚合的语句种类上限
+
+    # Message persistence (write-behind)
+    MESSAGE_WRITE_MODE: str = "ack"  # direct: 逐条提交; ack: 批量提交并等待确认; async: 批量提交、入队即返回
+    MESSAGE_WRITE_BATCH_SIZE: int = 200  # 单批最多写入的消息数
+    MESSAGE_WRITE_FLUSH_MS: float = 20.0  # 攒批的最长等待时间
+    MESSAGE_WRITE_QUEUE_SIZE: int = 10000  # 队列上限，满时写入方等待（背压）
+
+    # Chat context window（每轮发送给模型的历史上限）
+    CHAT_HISTORY_MAX_MESSAGES: int = 20  # 最多加载的历史消息条数
+    CHAT_HISTORY_MAX_CHARS: int = 16000  # 历史消息总字符数上限，0 表示不限制
+    CHAT_HISTORY_MAX_TOKENS: int = 0  # 历史消息估算 token 上限，0 表示不限制
+
+    # Rolling conversation summaries（后台把较早的消息并入摘要）
+    SUMMARY_ENABLED: bool = True
+    SUMMARY_TRIGGER_MESSAGES: int = 16  # 未摘要消息达到该条数时触发，应不大于 CHAT_HISTORY_MAX_MESSAGES
+    SUMMARY_KEEP_RECENT: int = 6  # 最近的若干条保持原文，不折叠进摘要
+    SUMMARY_MAX_FOLD: int = 100  # 单次最多折叠的消息条数
+    SUMMARY_MAX_CHARS: int = 4000  # 摘要最大字符数
+
+    # Shared HTTP client for LLM providers（所有 provider 共用的连接池）
+    LLM_HTTP_MAX_CONNECTIONS: int = 100  # 连接总数上限
+    LLM_HTTP_MAX_KEEPALIVE: int = 20  # 保持的空闲 keep-alive 连接数
+    LLM_HTTP_KEEPALIVE_EXPIRY: float = 60.0  # 空闲连接保留时间（秒）
+    LLM_HTTP_CONNECT_TIMEOUT: float = 5.0  # 建连超时（秒）
+    LLM_HTTP_READ_TIMEOUT: float = 60.0  # 读取超时（秒），流式响应为两个数据块之间的最长间隔
+    LLM_HTTP2: bool = False  # 启用 HTTP/2（需要 h2）
+
+    # LLM endpoint routing
+    LLM_ENDPOINTS: str = ""  # JSON 数组：[{"name", "base_url", "model", "api_key"?, "weight"?}]，为空时按 AI_PROVIDER 生成
+    LLM_ROUTING_STRATEGY: str = "least_latency"  # least_latency: EWMA 首字延迟最低; weighted: 按权重随机
+    LLM_ENDPOINT_COOLDOWN_SECONDS: float = 30.0  # 端点连续失败后暂停路由的时间
+    LLM_TTFT_STALE_SECONDS: float = 30.0  # 端点超过该时间没有首字延迟样本时探测一次，新样本替换旧的 EWMA；0 表示不探测
+
+    # LLM request hedging
+    LLM_HEDGE_ENABLED: bool = False  # 首字超时后发起第二个相同请求，先出字者胜出，另一个立即取消
+    LLM_HEDGE_PERCENTILE: float = 95.0  # 对冲延迟取端点首字延迟的该分位数
+    LLM_HEDGE_DEFAULT_DELAY_MS: float = 1500.0  # 首字延迟样本不足时使用的对冲延迟
+    LLM_HEDGE_MIN_DELAY_MS: float = 200.0  # 对冲延迟下限
+    LLM_HEDGE_MAX_DELAY_MS: float = 5000.0  # 对冲延迟上限
+
+    # Chat streaming
+    CHAT_OUTPUT_MODE: Literal["text", "structured"] = "structured"  # structured: 输出 ChatResponse 并逐块校验; text: 直接流式输出文本增量（首字延迟更低）
+    SSE_COALESCE_MS: float = 30.0  # 合并 delta 的最长等待时间，0 表示逐个发送
+    SSE_COALESCE_MAX_BYTES: int = 4096  # 单个 SSE 帧合并的最大字节数
+    SSE_DISCONNECT_POLL_SECONDS: float = 0.5  # 检查客户端是否断开的间隔；断开后取消生成并保存已生成的部分
+    SSE_RESUME_GRACE_SECONDS: float = 5.0  # 客户端断开后等待重连（Last-Event-ID 续传）的时间，超时取消生成；0 表示立即取消
+    SSE_RESUME_TTL_SECONDS: float = 60.0  # 生成结束后续传缓冲区保留的时间
+    SSE_RESUME_MAX_FRAMES: int = 2048  # 每轮生成最多保留的 SSE 帧数（环形缓冲区）
+    SSE_RESUME_MAX_BYTES: int = 64 * 1024 * 1024  # 所有续传缓冲区的总字节上限
+
+    # 合并相同的并发生成（fan-out）
+    STREAM_FANOUT_ENABLED: bool = True  # 上下文相同的生成进行中时，新请求订阅它而不是再调用一次模型
+    STREAM_FANOUT_SINGLE_TURN_ONLY: bool = True  # 只合并没有历史的单轮请求
+    STREAM_FANOUT_ALLOW_TOOLS: bool = False  # 是否合并带工具的请求
+
+    # 准入控制（每个 worker 进程）
+    ADMISSION_MAX_PER_USER: int = 4  # 单用户同时进行的 chat / agent 运行数上限，超出返回 429；0 表示不限制
+    ADMISSION_MAX_GLOBAL: int = 64  # 同时进行的上游生成数上限，超出排队；0 表示不限制
+    ADMISSION_MAX_QUEUE: int = 256  # 等待队列长度上限，超出返回 503
+    ADMISSION_QUEUE_TIMEOUT_SECONDS: float = 10.0  # 排队等待的最长时间，超时返回 503
+    ADMISSION_RETRY_AFTER_SECONDS: int = 2  # 429 / 503 响应的 Retry-After
+    SCHEDULER_CLASS_WEIGHTS: str = "interactive:8,agent:3,batch:1"  # 排队时各优先级类别的权重（对话 > agent 工具运行 > 后台批处理）
+    SCHEDULER_USER_QUANTUM: int = 1  # 同一类别内每个用户每轮可连续拿到的名额数
+
+    # 按负载自动降级：压力越过阈值时依次限制输出 token、限制历史、停用搜索工具、拒绝新请求
+    DEGRADE_ENABLED: bool = True
+    DEGRADE_LEVEL_THRESHOLDS: str = "0.75,0.9,1.0,1.25"  # 进入 cap_output / cap_history / no_tools / shed 所需的压力值
+    DEGRADE_HYSTERESIS: float = 0.1  # 压力低于当前级阈值减去该值才开始计时降级
+    DEGRADE_MIN_DWELL_SECONDS: float = 10.0  # 每一级至少保持的时间，压力持续回落该时间后才降一级
+    DEGRADE_INFLIGHT_HIGH: int = 0  # 进行中（含排队）的生成数达到该值时压力为 1；0 表示使用 ADMISSION_MAX_GLOBAL
+    DEGRADE_LOOP_LAG_MS_HIGH: float = 200.0  # 事件循环延迟（EWMA）达到该值时压力为 1
+    DEGRADE_TTFT_MS_HIGH: float = 8000.0  # 最优端点的 EWMA 首字延迟达到该值时压力为 1
+    DEGRADE_TTFT_MAX_AGE_SECONDS: float = 30.0  # 超过该时间没有新样本的首字延迟不再计入压力（shed 时没有新请求，避免卡在 shed）
+    DEGRADE_LOOP_LAG_SAMPLE_SECONDS: float = 0.5  # 事件循环延迟采样间隔，0 表示不采样
+    DEGRADE_MAX_OUTPUT_TOKENS: int = 512  # cap_output 级别的最大输出 token
+    DEGRADE_HISTORY_MAX_MESSAGES: int = 6  # cap_history 级别发送给模型的最大历史消息数
+
+    # LLM response cache（精确匹配）
+    RESPONSE_CACHE_ENABLED: bool = True
+    RESPONSE_CACHE_TTL_SECONDS: float = 3600.0  # 缓存条目有效期
+    RESPONSE_CACHE_MAX_ENTRIES: int = 1000  # 内存层最多条目数（LRU）
+    RESPONSE_CACHE_MAX_BYTES: int = 16 * 1024 * 1024  # 内存层最大总字节数
+    RESPONSE_CACHE_DISK_DIR: str = ""  # 本地磁盘层目录，留空表示不启用
+    RESPONSE_CACHE_ALLOW_HISTORY: bool = False  # 是否缓存带历史（或摘要）的请求
+    NEAR_DUP_CACHE_ENABLED: bool = False  # 单轮提示词的近似重复匹配（MinHash/LSH，需要 numpy）；只看词集合，否定词等细微差别可能命中错误的回答，默认关闭
+    NEAR_DUP_THRESHOLD: float = 0.9  # 估算 Jaccard 相似度达到该值才返回缓存的回答
+    NEAR_DUP_MAX_ENTRIES: int = 10000  # 索引条目上限（LRU 淘汰），决定索引内存占用
+    NEAR_DUP_NUM_PERM: int = 64  # MinHash 签名长度
+    NEAR_DUP_BANDS: int = 8  # LSH 分段数，须整除 NEAR_DUP_NUM_PERM
+
+    # Web search tool
+    SEARCH_CACHE_TTL_SECONDS: float = 300.0  # 搜索结果缓存有效期
+    SEARCH_CACHE_MAX_ENTRIES: int = 1000  # 搜索结果缓存条目上限（LRU）
+    SEARCH_MAX_CONCURRENT: int = 4  # 每个进程同时进行的搜索数（即搜索线程池大小）
+    SEARCH_TIMEOUT_SECONDS: float = 8.0  # 单次搜索的截止时间（含排队等待）
+    SEARCH_BACKENDS: str = "auto"  # DDGS 后端，逗号分隔，按顺序对冲（如 duckduckgo,bing,brave）
+    SEARCH_HEDGE_DELAY_MS: float = 300.0  # 前一个后端超过该时间未返回时，请求下一个后端
+    SEARCH_HEDGE_FANOUT: int = 2  # 单次搜索最多请求的后端数
+    SEARCH_MERGE_WINDOW_MS: float = 0.0  # 胜出后再等待该时间合并其他后端的结果，0 表示不合并
+    SEARCH_MAX_RESULTS: int = 8  # 单次搜索结果数上限（模型传入的 max_results 不会超过它）
+    SEARCH_SNIPPET_MAX_CHARS: int = 300  # 单条摘要在句子边界截断的长度
+    SEARCH_RESULT_MAX_CHARS: int = 3000  # 单次工具返回的总字符数预算，0 表示不限制
+    SEARCH_RESULT_MAX_TOKENS: int = 0  # 单次工具返回的估算 token 预算，0 表示不限制
+
     class Config:
         env_file = ".env"
 
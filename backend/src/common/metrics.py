@@ -0,0 +1,105 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import bisect
+import math
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Sequence
+
+# 默认桶边界（毫秒），覆盖从亚毫秒级的连接获取到数十秒的 LLM 生成
+DEFAULT_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class LatencyHistogram:
+    """
+    固定桶边界的延迟直方图（单位：毫秒）。
+
+    内存占用恒定，observe 为 O(log 桶数)；百分位按桶上界估算，足够用于容量调优。
+    可能在线程池（同步引擎）和事件循环中同时被调用，内部加锁。
+    """
+
+    def __init__(self, buckets_ms: Optional[Sequence[float]] = None):
+        self.bounds = tuple(sorted(buckets_ms or DEFAULT_BUCKETS_MS))
+        self._counts = [0] * (len(self.bounds) + 1)  # 最后一个桶为 +Inf
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value_ms: float) -> None:
+        idx = bisect.bisect_left(self.bounds, value_ms)
+        with self._lock:
+            self._counts[idx] += 1
+            self._count += 1
+            self._sum += value_ms
+            if value_ms > self._max:
+                self._max = value_ms
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def percentile(self, q: float) -> Optional[float]:
+        """估算第 q 百分位（0-100），返回所在桶的上界；无样本时返回 None"""
+        with self._lock:
+            if not self._count:
+                return None
+            rank = max(1, int(round(self._count * q / 100.0)))
+            seen = 0
+            for idx, n in enumerate(self._counts):
+                seen += n
+                if seen >= rank:
+                    return self.bounds[idx] if idx < len(self.bounds) else self._max
+            return self._max
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counts = [0] * (len(self.bounds) + 1)
+            self._count = 0
+            self._sum = 0.0
+            self._max = 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        p50, p95, p99 = self.percentile(50), self.percentile(95), self.percentile(99)
+        with self._lock:
+            buckets = {f"le_{b:g}": n for b, n in zip(self.bounds, self._counts)}
+            buckets["le_inf"] = self._counts[-1]
+            return {
+                "count": self._count,
+                "sum_ms": round(self._sum, 3),
+                "avg_ms": round(self._sum / self._count, 3) if self._count else None,
+                "max_ms": round(self._max, 3),
+                "p50_ms": p50,
+                "p95_ms": p95,
+                "p99_ms": p99,
+                "buckets": buckets,
+            }
+
+
+class SampleWindow:
+    """
+    最近 size 个样本的滑动窗口，百分位按样本精确计算（nearest-rank）。
+    用于需要真实分位数的场景（例如对冲延迟）；LatencyHistogram 的百分位只能给出桶上界。
+    """
+
+    def __init__(self, size: int = 256):
+        self._samples: Deque[float] = deque(maxlen=max(1, size))
+        self._lock = threading.Lock()
+
+    def observe(self, value_ms: float) -> None:
+        with self._lock:
+            self._samples.append(value_ms)
+
+    @property
+    def count(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """第 q 百分位（0-100）；无样本时返回 None"""
+        with self._lock:
+            ordered = sorted(self._samples)
+        if not ordered:
+            return None
+        rank = max(1, math.ceil(len(ordered) * q / 100.0))
+        return ordered[min(rank, len(ordered)) - 1]
@@ -0,0 +1,65 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import asyncio
+from typing import Any, AsyncIterable
+
+
+class _Failure:
+    """上游异常，经队列交给消费方重新抛出"""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+_END = object()
+
+
+class StreamPump:
+    """
+    在单独的一个任务中完整迭代异步流（包括关闭），把元素放入队列，消费方用 get() 读取。
+
+    pydantic-ai 的 run_stream 在迭代它的任务中进入 anyio cancel scope，必须在同一个任务中退出；
+    需要带超时等待、或在多个流之间竞争（对冲）时，不能把 __anext__ 分散到不同的任务里，
+    改为等待 get()：取消一次 get() 只是放弃这次读取，不会打断上游。
+    """
+
+    def __init__(self, source: AsyncIterable[Any]):
+        self.queue: "asyncio.Queue[Any]" = asyncio.Queue()
+        self.task = asyncio.ensure_future(self._run(source))
+
+    async def _run(self, source: AsyncIterable[Any]) -> None:
+        iterator = source.__aiter__()
+        try:
+            async for item in iterator:
+                self.queue.put_nowait(item)
+        except Exception as ex:
+            self.queue.put_nowait(_Failure(ex))
+        else:
+            self.queue.put_nowait(_END)
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    async def get(self) -> Any:
+        """返回下一个元素；上游结束时抛出 StopAsyncIteration，上游出错时抛出同一个异常"""
+        item = await self.queue.get()
+        if item is _END:
+            self.queue.put_nowait(_END)  # 之后的 get() 仍然返回结束
+            raise StopAsyncIteration
+        if isinstance(item, _Failure):
+            self.queue.put_nowait(item)
+            raise item.error
+        return item
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Any:
+        return await self.get()
+
+    async def aclose(self) -> None:
+        """取消上游（在它自己的任务中取消并关闭）并等待其退出"""
+        if not self.task.done():
+            self.task.cancel()
+            await asyncio.wait({self.task})
@@ -2,6 +2,7 @@
 # @Author  : Leon
 # @Email   : pi.apple.lab@gmail.com
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from typing import Generic, TypeVar, Type, List, Any
 
@@ -34,3 +35,30 @@ class CRUDBase(Generic[ModelType]):
         db.commit()
         db.refresh(obj)
         return obj
+
+
+class AsyncCRUDBase(Generic[ModelType]):
+    """CRUDBase 的异步版本，基于 AsyncSession"""
+
+    def __init__(self, model: Type[ModelType]):
+        self.model = model
+
+    async def get(self, db: AsyncSession, id: Any) -> ModelType | None:
+        """Get a single record by primary key (id)."""
+        query = select(self.model).filter_by(id=id)
+        result = await db.execute(query)
+        return result.scalar_one_or_none()
+
+    async def get_multi(self, db: AsyncSession) -> List[ModelType]:
+        """Get all records as list[ModelType]."""
+        query = select(self.model)
+        result = await db.execute(query)
+        return list(result.scalars().all())
+
+    async def create(self, db: AsyncSession, obj_in: dict) -> ModelType:
+        """Create a new record."""
+        obj = self.model(**obj_in)
+        db.add(obj)
+        await db.commit()
+        await db.refresh(obj)
+        return obj
@@ -3,9 +3,10 @@
 # @Email   : pi.apple.lab@gmail.com
 import logging
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from src.crud.base import CRUDBase
+from src.crud.base import CRUDBase, AsyncCRUDBase
 from src.models.conversation import Conversation
 from typing import List, Optional
 
@@ -88,5 +89,89 @@ class CRUDConversation(CRUDBase[Conversation]):
             raise
 
 
+class AsyncCRUDConversation(AsyncCRUDBase[Conversation]):
+    """CRUDConversation 的异步版本，供 async 路由使用"""
+
+    async def get_conversations(
+            self,
+            db: AsyncSession,
+            user_id: Optional[int] = None,
+            skip: int = 0,
+            limit: int = 100
+    ) -> List[Conversation]:
+        try:
+            # 异步会话不支持懒加载，ConversationResponse 需要 messages，这里预先加载
+            query = select(self.model).options(selectinload(Conversation.messages))
+            if user_id is not None:
+                query = query.where(Conversation.user_id == user_id)
+            query = query.order_by(Conversation.created_at.desc()).offset(skip).limit(limit)
+            result = await db.execute(query)
+            return list(result.scalars().all())
+        except Exception as e:
+            logger.error(f"Error getting conversations: {str(e)}")
+            raise
+
+    async def get_conversation(self, db: AsyncSession, conv_id: int,
+                               user_id: Optional[int] = None) -> Optional[Conversation]:
+        try:
+            query = select(self.model).where(self.model.id == conv_id)
+            if user_id is not None:
+                query = query.where(Conversation.user_id == user_id)
+            result = await db.execute(query)
+            return result.scalar_one_or_none()
+        except Exception as e:
+            logger.error(f"Error getting conversation with id {conv_id}: {str(e)}")
+            raise
+
+    async def create_conversation(self, db: AsyncSession, user_id: Optional[int] = None) -> Conversation:
+        try:
+            obj_in = {}
+            if user_id is not None:
+                obj_in["user_id"] = user_id
+            conv = await self.create(db=db, obj_in=obj_in)
+            # 同上：显式加载 messages 关系，避免序列化时触发懒加载
+            await db.refresh(conv, attribute_names=["messages"])
+            return conv
+        except Exception as e:
+            logger.error(f"Error creating conversation: {str(e)}")
+            raise
+
+    async def create_conversation_if_not_exists(self, db: AsyncSession, conv_id: Optional[int],
+                                                user_id: Optional[int] = None) -> int:
+        try:
+            if conv_id is not None:
+                conv = await self.get_conversation(db, conv_id, user_id=user_id)
+                if conv:
+                    return conv.id
+            # 只需要 id，直接 create，省去 messages 关系的加载
+            obj_in = {"user_id": user_id} if user_id is not None else {}
+            return (await self.create(db=db, obj_in=obj_in)).id
+        except Exception as e:
+            logger.error(f"Error in create_conversation_if_not_exists: {str(e)}")
+            raise
+
+    async def get_by_user(
+            self,
+            db: AsyncSession,
+            *,
+            user_id: int,
+            skip: int = 0,
+            limit: int = 100
+    ) -> List[Conversation]:
+        try:
+            return await self.get_conversations(db, user_id=user_id, skip=skip, limit=limit)
+        except Exception as e:
+            logger.error(f"Error getting conversations for user {user_id}: {str(e)}")
+            raise
+
+    async def create_for_user(self, db: AsyncSession, *, user_id: int) -> Conversation:
+        try:
+            return await self.create_conversation(db, user_id=user_id)
+        except Exception as e:
+            logger.error(f"Error creating conversation for user {user_id}: {str(e)}")
+            raise
+
+
 # 实例化
 conversation = CRUDConversation(Conversation)
+async_conversation = AsyncCRUDConversation(Conversation)
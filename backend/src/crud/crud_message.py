@@ -4,9 +4,10 @@
 import logging
 
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from src.models.message import Message
 from src.models.conversation import Conversation
-from typing import List
+from typing import List, Tuple
 from sqlalchemy import select
 
 logger = logging.getLogger(__name__)
@@ -14,7 +15,7 @@ logger = logging.getLogger(__name__)
 
 def get_messages_by_conversation(db: Session, conv_id: int) -> List[Message]:
     try:
-        query = select(Message).where(Message.conversation_id == conv_id).order_by(Message.created_at.asc())
+        query = select(Message).where(Message.conversation_id == conv_id).order_by(Message.created_at.asc(), Message.id.asc())
         result = db.execute(query)
         return list(result.scalars().all())
     except Exception as e:
@@ -57,3 +58,78 @@ def create_message(
         logger.error(f"Error creating message for conversation {conv_id}: {str(e)}")
         db.rollback()
         raise
+
+
+# ============================== 异步版本 ==============================
+async def async_get_messages_by_conversation(db: AsyncSession, conv_id: int) -> List[Message]:
+    try:
+        query = select(Message).where(Message.conversation_id == conv_id).order_by(Message.created_at.asc(), Message.id.asc())
+        result = await db.execute(query)
+        return list(result.scalars().all())
+    except Exception as e:
+        logger.error(f"Error fetching messages for conversation {conv_id}: {str(e)}")
+        raise
+
+
+async def async_get_recent_messages(
+        db: AsyncSession,
+        conv_id: int,
+        limit: int,
+        after_id: int = 0
+) -> List[Tuple[int, str, str]]:
+    """
+    按 id 倒序取最近 limit 条消息，返回 (id, role, content) 元组（最新的在前）。
+    只查询需要的列，不构造 ORM 对象；配合 (conversation_id, id) 索引，代价与会话长度无关。
+    after_id > 0 时只取 id 大于它的消息（已并入摘要的消息不再重复加载）。
+    """
+    try:
+        query = (
+            select(Message.id, Message.role, Message.content)
+            .where(Message.conversation_id == conv_id)
+            .order_by(Message.id.desc())
+            .limit(limit)
+        )
+        if after_id:
+            query = query.where(Message.id > after_id)
+        result = await db.execute(query)
+        return [(row[0], row[1], row[2]) for row in result.all()]
+    except Exception as e:
+        logger.error(f"Error fetching recent messages for conversation {conv_id}: {str(e)}")
+        raise
+
+
+async def async_create_message(
+        db: AsyncSession,
+        conv_id: int,
+        role: str,
+        content: str
+) -> Message:
+    try:
+        # 验证 role 是否有效
+        valid_roles = ["user", "assistant", "system"]
+        if role not in valid_roles:
+            raise ValueError(f"Invalid role '{role}'. Must be one of: {valid_roles}")
+
+        # 验证 conversation 存在
+        conv_query = select(Conversation.id).where(Conversation.id == conv_id)
+        conv = (await db.execute(conv_query)).scalar_one_or_none()
+        if not conv:
+            raise ValueError(f"Conversation {conv_id} not found")
+
+        # 创建消息
+        msg = Message(
+            conversation_id=conv_id,
+            role=role,
+            content=content,
+        )
+        db.add(msg)
+        await db.commit()
+        await db.refresh(msg)
+        return msg
+    except ValueError as ve:
+        logger.error(f"Validation error in async_create_message: {str(ve)}")
+        raise
+    except Exception as e:
+        logger.error(f"Error creating message for conversation {conv_id}: {str(e)}")
+        await db.rollback()
+        raise
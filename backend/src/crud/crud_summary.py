@@ -0,0 +1,93 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import logging
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.models.conversation_summary import ConversationSummary
+from src.models.message import Message
+
+logger = logging.getLogger(__name__)
+
+
+async def async_get_summary(db: AsyncSession, conv_id: int) -> Optional[Tuple[str, int, int]]:
+    """返回 (summary, last_message_id, version)，尚无摘要时返回 None"""
+    try:
+        query = select(
+            ConversationSummary.summary,
+            ConversationSummary.last_message_id,
+            ConversationSummary.version,
+        ).where(ConversationSummary.conversation_id == conv_id)
+        row = (await db.execute(query)).first()
+        return (row[0], row[1], row[2]) if row else None
+    except Exception as e:
+        logger.error(f"Error fetching summary for conversation {conv_id}: {str(e)}")
+        raise
+
+
+async def async_get_messages_after(
+        db: AsyncSession,
+        conv_id: int,
+        after_id: int,
+        limit: int
+) -> List[Tuple[int, str, str]]:
+    """按时间正序返回水位线之后（id > after_id）的最多 limit 条 (id, role, content)"""
+    try:
+        query = (
+            select(Message.id, Message.role, Message.content)
+            .where(Message.conversation_id == conv_id, Message.id > after_id)
+            .order_by(Message.id.asc())
+            .limit(limit)
+        )
+        result = await db.execute(query)
+        return [(row[0], row[1], row[2]) for row in result.all()]
+    except Exception as e:
+        logger.error(f"Error fetching messages after {after_id} for conversation {conv_id}: {str(e)}")
+        raise
+
+
+async def async_save_summary(
+        db: AsyncSession,
+        conv_id: int,
+        summary: str,
+        last_message_id: int,
+        expected_version: int
+) -> bool:
+    """
+    以乐观锁写入新版本摘要：只有当前版本仍为 expected_version 时才更新。
+    返回 False 表示期间已有其他任务写入了更新的版本。
+    """
+    try:
+        if expected_version == 0:
+            db.add(ConversationSummary(
+                conversation_id=conv_id,
+                summary=summary,
+                last_message_id=last_message_id,
+                version=1,
+            ))
+            await db.commit()
+            return True
+
+        stmt = (
+            update(ConversationSummary)
+            .where(
+                ConversationSummary.conversation_id == conv_id,
+                ConversationSummary.version == expected_version,
+            )
+            .values(summary=summary, last_message_id=last_message_id, version=expected_version + 1)
+        )
+        result = await db.execute(stmt)
+        await db.commit()
+        return result.rowcount == 1
+    except IntegrityError:
+        # 首个版本被并发插入
+        await db.rollback()
+        return False
+    except Exception as e:
+        logger.error(f"Error saving summary for conversation {conv_id}: {str(e)}")
+        await db.rollback()
+        raise
@@ -4,8 +4,9 @@
 import logging
 
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from src.crud.base import CRUDBase
+from src.crud.base import CRUDBase, AsyncCRUDBase
 from src.models.user import User
 from typing import Optional, List, Dict, Any
 
@@ -107,5 +108,93 @@ class CRUDUser(CRUDBase[User]):
         }
 
 
+class AsyncCRUDUser(AsyncCRUDBase[User]):
+    """CRUDUser 的异步版本，返回值约定与 CRUDUser 保持一致"""
+
+    async def get_by_email(self, db: AsyncSession, *, email: str) -> Optional[Dict[str, Any]]:
+        try:
+            query = select(self.model).where(self.model.email == email)
+            result = await db.execute(query)
+            user = result.scalar_one_or_none()
+            return CRUDUser._to_dict(user) if user else None
+        except Exception as e:
+            logger.error(f"Error getting user by email {email}: {str(e)}")
+            return None
+
+    async def email_exists(self, db: AsyncSession, email: str, exclude_user_id: Optional[int] = None) -> bool:
+        try:
+            query = select(self.model.id).where(self.model.email == email)
+            if exclude_user_id:
+                query = query.where(self.model.id != exclude_user_id)
+            result = await db.execute(query)
+            return result.scalar_one_or_none() is not None
+        except Exception as e:
+            logger.error(f"Error checking if email {email} exists: {str(e)}")
+            return False
+
+    async def get_by_id(self, db: AsyncSession, user_id: int) -> Optional[Dict[str, Any]]:
+        try:
+            query = select(self.model).where(self.model.id == user_id)
+            result = await db.execute(query)
+            user = result.scalar_one_or_none()
+            return CRUDUser._to_dict(user) if user else None
+        except Exception as e:
+            logger.error(f"Error getting user by id {user_id}: {str(e)}")
+            return None
+
+    async def list_all(self, db: AsyncSession, skip: int = 0, limit: int = 100) -> List[Dict[str, Any]]:
+        try:
+            query = select(self.model).offset(skip).limit(limit)
+            result = await db.execute(query)
+            return [CRUDUser._to_dict(row) for row in result.scalars().all()]
+        except Exception as e:
+            logger.error(f"Error listing users with skip {skip} and limit {limit}: {str(e)}")
+            return []
+
+    async def create(self, db: AsyncSession, obj_in: Dict[str, Any]) -> int:
+        try:
+            obj = self.model(**obj_in)
+            db.add(obj)
+            await db.commit()
+            await db.refresh(obj)
+            return obj.id
+        except Exception as e:
+            logger.error(f"Error creating user with data {obj_in}: {str(e)}")
+            await db.rollback()
+            return 0
+
+    async def update(self, db: AsyncSession, user_id: int, update_data: Dict[str, Any]) -> bool:
+        try:
+            query = select(self.model).where(self.model.id == user_id)
+            result = await db.execute(query)
+            user = result.scalar_one_or_none()
+            if not user:
+                return False
+            for key, value in update_data.items():
+                setattr(user, key, value)
+            await db.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error updating user {user_id} with data {update_data}: {str(e)}")
+            await db.rollback()
+            return False
+
+    async def delete(self, db: AsyncSession, user_id: int) -> bool:
+        try:
+            query = select(self.model).where(self.model.id == user_id)
+            result = await db.execute(query)
+            user = result.scalar_one_or_none()
+            if not user:
+                return False
+            await db.delete(user)
+            await db.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error deleting user {user_id}: {str(e)}")
+            await db.rollback()
+            return False
+
+
 # 全局实例
 user_crud = CRUDUser(User)
+async_user_crud = AsyncCRUDUser(User)
@@ -0,0 +1,143 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import logging
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from src.common.metrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStats:
+    """
+    连接池遥测：checkout 等待时间、当前/峰值 checked-out、overflow 与超时次数。
+
+    计数来自池事件（connect/checkout/checkin/invalidate），等待时间和超时
+    由 TimedQueuePool.connect() 记录（池事件只在拿到连接之后触发，无法测量等待）。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.checkout_latency = LatencyHistogram()
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.timeouts = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.peak_overflow = 0
+        self._pool = None
+
+    # ---------------- 事件回调 ----------------
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            if self.checked_out > self.peak_checked_out:
+                self.peak_checked_out = self.checked_out
+            overflow = self._current_overflow()
+            if overflow is not None and overflow > self.peak_overflow:
+                self.peak_overflow = overflow
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+            self.checked_out = max(0, self.checked_out - 1)
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    # ---------------- 由 TimedQueuePool 调用 ----------------
+    def record_wait(self, elapsed_ms: float) -> None:
+        self.checkout_latency.observe(elapsed_ms)
+
+    def record_timeout(self) -> None:
+        with self._lock:
+            self.timeouts += 1
+
+    def attach(self, engine: Engine) -> None:
+        """在引擎（同步引擎或 AsyncEngine.sync_engine）上注册池事件监听"""
+        event.listen(engine, "connect", self._on_connect)
+        event.listen(engine, "checkout", self._on_checkout)
+        event.listen(engine, "checkin", self._on_checkin)
+        event.listen(engine, "invalidate", self._on_invalidate)
+        self._pool = engine.pool
+        if isinstance(engine.pool, _TimedPoolMixin):
+            engine.pool._stats = self
+
+    def _current_overflow(self) -> Optional[int]:
+        overflow = getattr(self._pool, "overflow", None)
+        return overflow() if callable(overflow) else None
+
+    def snapshot(self) -> Dict[str, Any]:
+        live: Dict[str, Any] = {"pool_class": type(self._pool).__name__ if self._pool is not None else None}
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            fn = getattr(self._pool, name, None)
+            if callable(fn):
+                live[name] = fn()
+        with self._lock:
+            counters = {
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "invalidations": self.invalidations,
+                "timeouts": self.timeouts,
+                "checked_out": self.checked_out,
+                "peak_checked_out": self.peak_checked_out,
+                "peak_overflow": self.peak_overflow,
+            }
+        return {
+            "name": self.name,
+            "live": live,
+            "counters": counters,
+            "checkout_wait": self.checkout_latency.snapshot(),
+        }
+
+
+class _TimedPoolMixin:
+    """为 QueuePool 计时：记录 connect()（即 checkout）等待时长与 pool_timeout 超时"""
+
+    _stats: Optional[PoolStats] = None
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            conn = super().connect()
+        except exc.TimeoutError:
+            if self._stats is not None:
+                self._stats.record_timeout()
+            logger.warning(f"数据库连接池获取连接超时: {self.status()}")
+            raise
+        if self._stats is not None:
+            self._stats.record_wait((time.perf_counter() - start) * 1000.0)
+        return conn
+
+    def recreate(self):
+        # engine.dispose() 会重建连接池，遥测对象需要跟随
+        new_pool = super().recreate()
+        new_pool._stats = self._stats
+        if self._stats is not None:
+            self._stats._pool = new_pool
+        return new_pool
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
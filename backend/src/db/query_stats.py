@@ -0,0 +1,179 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import hashlib
+import logging
+import re
+import sys
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# 慢查询日志中用于定位调用方的模块前缀
+CALLER_MODULE_PREFIXES = ("src.crud", "src.services")
+
+# 聚合超出上限后，新指纹统一计入该桶，保证内存有界
+OTHER_FINGERPRINT = "<other>"
+
+_NORMALIZE_RULES = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),  # 字符串字面量
+    (re.compile(r"(?<!:):\w+|%\(\w+\)s|%s|\$\d+"), "?"),  # 绑定参数（:name / %(name)s / %s / $1）
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),  # 数字字面量
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(?+)"),  # IN (?, ?, ...) 折叠，避免列表长度产生不同指纹
+    (re.compile(r"\s+"), " "),
+]
+
+
+@lru_cache(maxsize=2048)
+def normalize_sql(statement: str) -> str:
+    """将 SQL 归一化为指纹文本：去掉字面量与参数、折叠空白。同一语句文本结果被缓存"""
+    normalized = statement
+    for pattern, repl in _NORMALIZE_RULES:
+        normalized = pattern.sub(repl, normalized)
+    return normalized.strip()
+
+
+def _scan_for_caller(frame) -> Optional[str]:
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith(CALLER_MODULE_PREFIXES):
+            code = frame.f_code
+            return f"{module}.{getattr(code, 'co_qualname', code.co_name)}"
+        frame = frame.f_back
+    return None
+
+
+def find_caller() -> Optional[str]:
+    """
+    找到发起查询的 CRUD/Service 函数。
+
+    AsyncSession 的查询在 greenlet 中执行，协程调用栈挂在父 greenlet 上，
+    当前栈找不到时沿父 greenlet 继续查找。只在记录慢查询时调用。
+    """
+    caller = _scan_for_caller(sys._getframe(1))
+    if caller:
+        return caller
+    try:
+        import greenlet
+        parent = greenlet.getcurrent().parent
+        while parent is not None and caller is None:
+            caller = _scan_for_caller(parent.gr_frame)
+            parent = parent.parent
+    except Exception:
+        return None
+    return caller
+
+
+class _FingerprintStats:
+    __slots__ = ("sql", "count", "total_ms", "max_ms", "rows", "samples")
+
+    def __init__(self, sql: str, sample_size: int):
+        self.sql = sql
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.samples = deque(maxlen=sample_size)  # 最近 N 次耗时，用于 p50/p95
+
+    def add(self, elapsed_ms: float, rowcount: int) -> None:
+        self.count += 1
+        self.total_ms += elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+        if rowcount > 0:
+            self.rows += rowcount
+        self.samples.append(elapsed_ms)
+
+    def to_dict(self) -> Dict[str, Any]:
+        ordered = sorted(self.samples)
+
+        def pct(q: float) -> Optional[float]:
+            if not ordered:
+                return None
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * q / 100.0))], 3)
+
+        return {
+            "fingerprint": hashlib.sha1(self.sql.encode("utf-8")).hexdigest()[:12],
+            "sql": self.sql,
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": pct(50),
+            "p95_ms": pct(95),
+            "rows": self.rows,
+        }
+
+
+class QueryStats:
+    """
+    基于 before/after_cursor_execute 的查询计时。
+
+    - 所有语句按归一化指纹聚合（count/total/p50/p95），可随时 snapshot 导出；
+    - 只有耗时超过 slow_query_ms 的语句才写日志（归一化 SQL、耗时、行数、调用方），
+      不记录参数，也不会像 echo=True 那样同步打印每一条语句。
+    """
+
+    def __init__(self, slow_query_ms: float = 200.0, max_fingerprints: int = 500, sample_size: int = 256):
+        self.slow_query_ms = slow_query_ms
+        self.max_fingerprints = max_fingerprints
+        self.sample_size = sample_size
+        self.slow_queries = 0
+        self._stats: Dict[str, _FingerprintStats] = {}
+        self._lock = threading.Lock()
+
+    def attach(self, engine: Engine) -> None:
+        """注册到同步引擎（异步引擎传入 AsyncEngine.sync_engine）"""
+        event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    @staticmethod
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._query_start_time = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_start_time", None)
+        if start is None:
+            return
+        self.record(statement, (time.perf_counter() - start) * 1000.0, getattr(cursor, "rowcount", -1))
+
+    def record(self, statement: str, elapsed_ms: float, rowcount: int = -1) -> None:
+        sql = normalize_sql(statement)
+        with self._lock:
+            stats = self._stats.get(sql)
+            if stats is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    sql = OTHER_FINGERPRINT
+                    stats = self._stats.get(sql)
+                if stats is None:
+                    stats = self._stats[sql] = _FingerprintStats(sql, self.sample_size)
+            stats.add(elapsed_ms, rowcount)
+
+        if elapsed_ms >= self.slow_query_ms:
+            self.slow_queries += 1
+            logger.warning(f"Slow query {elapsed_ms:.1f}ms rows={rowcount} caller={find_caller() or '-'} sql={sql}")
+
+    def snapshot(self, top: int = 20, order_by: str = "total_ms") -> Dict[str, Any]:
+        """按 order_by（total_ms / count / max_ms / avg_ms）导出前 top 个指纹"""
+        with self._lock:
+            items: List[Dict[str, Any]] = [s.to_dict() for s in self._stats.values()]
+        items.sort(key=lambda d: d.get(order_by) or 0, reverse=True)
+        return {
+            "slow_query_ms": self.slow_query_ms,
+            "slow_queries": self.slow_queries,
+            "fingerprints": len(items),
+            "queries": items[:top],
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self.slow_queries = 0
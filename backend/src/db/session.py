@@ -2,18 +2,77 @@
 # @Author  : Leon
 # @Email   : pi.apple.lab@gmail.com
 import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from src.common.config import settings
+from src.db.pool_stats import PoolStats, TimedAsyncAdaptedQueuePool, TimedQueuePool
+from src.db.query_stats import QueryStats
 
 logger = logging.getLogger(__name__)
+
+# 同步驱动 -> 异步驱动 的映射（psycopg3 同时支持同步与异步）
+_ASYNC_DRIVERS = {
+    "postgresql": "postgresql+psycopg",
+    "postgresql+psycopg2": "postgresql+psycopg",
+    "postgresql+psycopg": "postgresql+psycopg",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+
+def _to_async_url(database_url: str) -> str:
+    """将 DATABASE_URL 转换为异步驱动的 URL（已是异步驱动则原样返回）"""
+    url = make_url(database_url)
+    drivername = _ASYNC_DRIVERS.get(url.drivername, url.drivername)
+    return url.set(drivername=drivername).render_as_string(hide_password=False)
+
+
+def _engine_options(database_url: str, *, use_async: bool = False) -> Dict[str, Any]:
+    """根据 Settings 构造引擎参数；sqlite 使用 SQLAlchemy 默认池（不支持 pool_size 等参数）"""
+    options: Dict[str, Any] = {"echo": settings.DB_ECHO, "pool_pre_ping": settings.DB_POOL_PRE_PING}
+    if make_url(database_url).get_backend_name() != "sqlite":
+        options.update(
+            poolclass=TimedAsyncAdaptedQueuePool if use_async else TimedQueuePool,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+        )
+    return options
+
+
 # 同步引擎
-engine = create_engine(settings.DATABASE_URL, echo=True)
+engine = create_engine(settings.DATABASE_URL, **_engine_options(settings.DATABASE_URL))
 
 # 同步 Session
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 异步引擎（供 async 路由使用，避免数据库 IO 阻塞事件循环）
+_async_url = _to_async_url(settings.DATABASE_URL)
+async_engine = create_async_engine(_async_url, **_engine_options(_async_url, use_async=True))
+
+# 连接池遥测
+sync_pool_stats = PoolStats("sync")
+sync_pool_stats.attach(engine)
+async_pool_stats = PoolStats("async")
+async_pool_stats.attach(async_engine.sync_engine)
+
+# 查询计时 / 慢查询日志（替代 echo=True）
+query_stats = QueryStats(
+    slow_query_ms=settings.DB_SLOW_QUERY_MS,
+    max_fingerprints=settings.DB_QUERY_STATS_MAX_FINGERPRINTS,
+)
+query_stats.attach(engine)
+query_stats.attach(async_engine.sync_engine)
+
+# 异步 Session；expire_on_commit=False 避免 commit 后访问属性触发隐式 IO
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 
 # 依赖注入
 def get_db():
@@ -27,3 +86,62 @@ def get_db():
             raise
     finally:
         db.close()
+
+
+# 异步依赖注入
+async def get_async_db():
+    db: AsyncSession = AsyncSessionLocal()
+    try:
+        try:
+            yield db
+        except Exception as e:
+            logger.error(f"数据库操作出错: {str(e)}")
+            await db.rollback()
+            raise
+    finally:
+        await db.close()
+
+
+@asynccontextmanager
+async def async_session_scope() -> AsyncIterator[AsyncSession]:
+    """
+    短生命周期的异步 Session。
+
+    流式接口不应通过 Depends(get_async_db) 持有 Session：依赖在响应结束后才释放，
+    连接会在整个 LLM 生成期间被占用。用该上下文把数据库操作限定在最小范围内，
+    退出时立即把连接归还连接池。
+    """
+    db: AsyncSession = AsyncSessionLocal()
+    try:
+        yield db
+    except Exception as e:
+        logger.error(f"数据库操作出错: {str(e)}")
+        await db.rollback()
+        raise
+    finally:
+        await db.close()
+
+
+def get_pool_status() -> Dict[str, Any]:
+    """返回异步引擎连接池的当前占用情况（checked-out / checked-in / overflow）"""
+    pool = async_engine.pool
+    status: Dict[str, Any] = {"pool_class": type(pool).__name__}
+    # StaticPool 等不提供这些统计方法，按需读取
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        fn = getattr(pool, name, None)
+        if callable(fn):
+            status[name] = fn()
+    return status
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """同步/异步两个引擎的连接池遥测（等待时间、占用峰值、overflow、超时）"""
+    return {
+        "sync": sync_pool_stats.snapshot(),
+        "async": async_pool_stats.snapshot(),
+    }
+
+
+def get_query_stats(top: int = 20, order_by: str = "total_ms") -> Dict[str, Any]:
+    """按语句指纹聚合的查询耗时统计"""
+    return query_stats.snapshot(top=top, order_by=order_by)
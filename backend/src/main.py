@@ -2,9 +2,15 @@
 # @Author  : Leon
 # @Email   : pi.apple.lab@gmail.com
 import logging
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI
 from src.api.v1.api import api_router
+from src.services.degradation import degradation_controller
+from src.services.llm_providers import provider_registry
+from src.services.message_writer import message_writer
+from src.services.search_service import search_executor
 
 # 配置日志
 logging.basicConfig(
@@ -17,7 +23,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="GenAI Backend")
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # 采样事件循环延迟，驱动负载降级等级
+    degradation_controller.start()
+    yield
+    await degradation_controller.stop()
+    # 关闭前把 write-behind 队列中尚未落库的消息写完
+    logger.info("Draining message writer before shutdown")
+    await message_writer.drain()
+    search_executor.shutdown()
+    await provider_registry.aclose()
+
+
+app = FastAPI(title="GenAI Backend", lifespan=lifespan)
 app.include_router(api_router)
 
 logger.info("GenAI Backend API initialized")
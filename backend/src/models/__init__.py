@@ -3,6 +3,7 @@
 # @Email   : pi.apple.lab@gmail.com
 
 from .conversation import Conversation
+from .conversation_summary import ConversationSummary
 from .message import Message
 
-__all__ = ["Conversation", "Message"]
+__all__ = ["Conversation", "ConversationSummary", "Message"]
@@ -0,0 +1,25 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, func
+from src.db.base import Base
+
+
+class ConversationSummary(Base):
+    """会话的滚动摘要：id <= last_message_id 的消息已并入 summary"""
+    __tablename__ = "conversation_summaries"
+
+    conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"), primary_key=True)
+    summary = Column(String, nullable=False, default="")
+    last_message_id = Column(Integer, nullable=False, default=0)  # 水位线
+    version = Column(Integer, nullable=False, default=0)  # 乐观并发控制，每次重新生成 +1
+    updated_at = Column(
+        DateTime(timezone=True),
+        server_default=func.now(),
+        onupdate=func.now(),
+        nullable=False
+    )
+
+    def __repr__(self) -> str:
+        return (f"<ConversationSummary conversation_id={self.conversation_id} "
+                f"last_message_id={self.last_message_id} version={self.version}>")
@@ -3,7 +3,7 @@
 # @Email   : pi.apple.lab@gmail.com
 import logging
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, func
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, func
 from sqlalchemy.orm import relationship
 from src.db.base import Base
 
@@ -12,6 +12,10 @@ logger = logging.getLogger(__name__)
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # 支撑 “某会话最近 N 条消息” 的倒序 LIMIT 查询
+        Index("ix_messages_conversation_id_id", "conversation_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     conversation_id = Column(Integer, ForeignKey("conversations.id", ondelete="CASCADE"), nullable=False, index=True)
@@ -0,0 +1,200 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+from src.common.config import settings
+from src.common.metrics import LatencyHistogram
+from src.services.scheduler import PRIORITY_BATCH, PRIORITY_INTERACTIVE, FairScheduler, parse_class_weights
+
+logger = logging.getLogger(__name__)
+
+REJECT_PER_USER = "per_user_limit"
+REJECT_QUEUE_FULL = "queue_full"
+REJECT_QUEUE_TIMEOUT = "queue_timeout"
+
+
+class AdmissionRejected(Exception):
+    """请求未被接纳：超过单用户并发上限返回 429，等待队列已满或等待超时返回 503"""
+
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def detail(self) -> str:
+        if self.reason == REJECT_PER_USER:
+            return "Too many concurrent requests for this user"
+        return "Server is busy, please retry later"
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {"Retry-After": str(self.retry_after)}
+
+
+class AdmissionLease:
+    """一次被接纳的运行：持有单用户名额，以及（需要调用上游时）一个全局名额；release 可重复调用"""
+
+    def __init__(self, controller: "AdmissionController", user_id: Any, counted: bool = True):
+        self.controller = controller
+        self.user_id = user_id
+        self.counted = counted  # 是否占用单用户名额
+        self.upstream = False
+        self.released = False
+
+    async def acquire_upstream(self, priority: str = PRIORITY_INTERACTIVE) -> None:
+        await self.controller._acquire_global(self, priority)
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    chat / agent 运行的准入控制（每个 worker 进程一份）。
+
+    - 单用户进行中的运行数不超过 max_per_user，超出立即 429；
+    - 同时进行的上游生成不超过 max_global，超出时进入等待队列，
+      队列长度超过 max_queue 立即 503，等待超过 queue_timeout 秒同样 503；
+    - 等待队列由 FairScheduler 调度：优先级类别之间加权公平排队，类别内按用户轮转；
+    - 名额释放时直接交给调度出的下一个等待者，不会被新来的请求插队。
+    max_per_user / max_global 为 0 表示不限制。
+    """
+
+    def __init__(
+            self,
+            max_per_user: int = 4,
+            max_global: int = 64,
+            max_queue: int = 256,
+            queue_timeout: float = 10.0,
+            retry_after: int = 2,
+            scheduler: Optional[FairScheduler] = None,
+    ):
+        self.max_per_user = max_per_user
+        self.max_global = max_global
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.retry_after = max(1, retry_after)
+        self.active = 0
+        self._per_user: Dict[Any, int] = defaultdict(int)
+        self.scheduler = scheduler if scheduler is not None else FairScheduler()
+        # 统计
+        self.admitted = 0
+        self.queued = 0
+        self.rejected: Dict[str, int] = {REJECT_PER_USER: 0, REJECT_QUEUE_FULL: 0, REJECT_QUEUE_TIMEOUT: 0}
+        self.wait = LatencyHistogram()
+
+    def admit(self, user_id: Any) -> AdmissionLease:
+        """占用一个单用户名额（不等待）；需要调用上游时再 await lease.acquire_upstream()"""
+        if self.max_per_user > 0 and self._per_user[user_id] >= self.max_per_user:
+            self._reject(REJECT_PER_USER, 429)
+        self._per_user[user_id] += 1
+        return AdmissionLease(self, user_id)
+
+    @asynccontextmanager
+    async def upstream_slot(self, priority: str = PRIORITY_BATCH, user_id: Any = None) -> AsyncIterator[AdmissionLease]:
+        """后台任务（例如摘要）使用：只占用全局上游名额，不计入单用户并发"""
+        lease = AdmissionLease(self, user_id, counted=False)
+        await lease.acquire_upstream(priority)
+        try:
+            yield lease
+        finally:
+            lease.release()
+
+    async def _acquire_global(self, lease: AdmissionLease, priority: str) -> None:
+        start = time.perf_counter()
+        if self.max_global <= 0 or (self.active < self.max_global and not len(self.scheduler)):
+            self.active += 1
+        else:
+            if len(self.scheduler) >= self.max_queue:
+                self._reject(REJECT_QUEUE_FULL, 503)
+            await self._wait_for_slot(lease.user_id, priority)
+        lease.upstream = True
+        self.admitted += 1
+        wait_ms = (time.perf_counter() - start) * 1000.0
+        self.wait.observe(wait_ms)
+        self.scheduler.observe_wait(priority, wait_ms)
+
+    async def _wait_for_slot(self, user_id: Any, priority: str) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self.scheduler.push(future, user_id, priority)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return  # 超时的同时拿到了名额
+            self._drop_waiter(future, user_id, priority)
+            self._reject(REJECT_QUEUE_TIMEOUT, 503)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release_global()  # 名额已交接但请求被取消，转交下一个
+            else:
+                self._drop_waiter(future, user_id, priority)
+            raise
+
+    def _drop_waiter(self, future: asyncio.Future, user_id: Any, priority: str) -> None:
+        future.cancel()
+        self.scheduler.remove(future, user_id, priority)
+
+    def _release(self, lease: AdmissionLease) -> None:
+        if lease.counted:
+            remaining = self._per_user[lease.user_id] - 1
+            if remaining > 0:
+                self._per_user[lease.user_id] = remaining
+            else:
+                self._per_user.pop(lease.user_id, None)
+        if lease.upstream:
+            self._release_global()
+
+    def _release_global(self) -> None:
+        while True:
+            future = self.scheduler.pop()
+            if future is None:
+                break
+            if not future.done():
+                future.set_result(None)  # 名额直接交给调度出的等待者，active 不变
+                return
+        self.active = max(0, self.active - 1)
+
+    def _reject(self, reason: str, status_code: int) -> None:
+        self.rejected[reason] += 1
+        raise AdmissionRejected(status_code, reason, self.retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_per_user": self.max_per_user,
+            "max_global": self.max_global,
+            "max_queue": self.max_queue,
+            "active": self.active,
+            "waiting": len(self.scheduler),
+            "users_in_flight": len(self._per_user),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": dict(self.rejected),
+            "wait": self.wait.snapshot(),
+            "classes": self.scheduler.stats(),
+        }
+
+
+admission_controller = AdmissionController(
+    max_per_user=settings.ADMISSION_MAX_PER_USER,
+    max_global=settings.ADMISSION_MAX_GLOBAL,
+    max_queue=settings.ADMISSION_MAX_QUEUE,
+    queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT_SECONDS,
+    retry_after=settings.ADMISSION_RETRY_AFTER_SECONDS,
+    scheduler=FairScheduler(
+        weights=parse_class_weights(settings.SCHEDULER_CLASS_WEIGHTS),
+        quantum=settings.SCHEDULER_USER_QUANTUM,
+    ),
+)
@@ -3,10 +3,11 @@
 # @Email   : pi.apple.lab@gmail.com
 from __future__ import annotations
 import logging
-from typing import Any
+from typing import TYPE_CHECKING, Any, Optional
 from pydantic_ai import Agent, RunContext
-from pydantic_ai.models.openai import OpenAIChatModel
-from pydantic_ai.providers.openai import OpenAIProvider
+
+if TYPE_CHECKING:
+    from pydantic_ai.tools import ToolDefinition
 
 logger = logging.getLogger(__name__)
 try:
@@ -20,10 +21,51 @@ except Exception as e:
         DDGS = None
 
 from src.common.config import settings
+from src.services.degradation import degradation_controller
+from src.services.llm_router import provider_router
+from src.services.search_service import result_shaper, search_cache, search_executor, search_orchestrator
 
 _agent_singleton = None
 
 
+def _ddgs_backend(backend: str):
+    """DDGS 的一个后端：在搜索线程池中调用（每个线程复用一个客户端），并把结果统一为 title/url/snippet 字段"""
+
+    def call(client, query: str, max_results: int) -> list:
+        if backend == "auto":
+            return list(client.text(query, max_results=max_results))
+        return list(client.text(query, max_results=max_results, backend=backend))
+
+    async def fetch(query: str, max_results: int) -> list:
+        raw_results = await search_executor.run(DDGS, lambda client: call(client, query, max_results))
+        logger.info(f"Raw results ({backend}): {raw_results}")
+        return [
+            {
+                "title": r.get("title") or r.get("heading") or "",
+                "url": r.get("href") or r.get("url") or r.get("link") or "",
+                "snippet": r.get("body") or r.get("snippet") or r.get("text") or "",
+            }
+            for r in raw_results
+        ]
+
+    return fetch
+
+
+SEARCH_BACKENDS = [
+    (name, _ddgs_backend(name)) for name in (b.strip() for b in settings.SEARCH_BACKENDS.split(",")) if name
+]
+
+
+async def _fetch_search_results(query: str, max_results: int) -> list:
+    """按配置对多个后端做对冲搜索，返回第一个可接受的结果"""
+    return await search_orchestrator.search(query, max_results, SEARCH_BACKENDS)
+
+
+async def _prepare_tool_search(ctx: RunContext[Any], tool_def: ToolDefinition) -> Optional[ToolDefinition]:
+    """每一步模型请求前调用：返回 None 时本步不提供 tool_search"""
+    return tool_def if degradation_controller.tools_enabled() else None
+
+
 # ============================== 工具函数定义 ==============================
 def get_or_create_agent() -> Agent:
     """获取或创建 Agent 实例"""
@@ -32,14 +74,8 @@ def get_or_create_agent() -> Agent:
         logger.debug("Reusing existing AG-UI Agent")
         return _agent_singleton
 
-    provider = OpenAIProvider(
-        base_url='https://api.deepseek.com',
-        api_key=settings.OPENAI_API_KEY
-    )
-    model = OpenAIChatModel(
-        model_name="deepseek-chat",
-        provider=provider,
-    )
+    # 默认端点；每次运行由 agui 接口通过 provider_router 选择实际端点（与对话服务共用连接池）
+    model = provider_router.model_for(provider_router.default)
     agent = Agent(
         model=model,
         system_prompt=(
@@ -48,8 +84,8 @@ def get_or_create_agent() -> Agent:
         ),
     )
 
-    # 关键：使用正确的工具名称注册
-    @agent.tool(name='tool_search')
+    # 关键：使用正确的工具名称注册；负载降级到 no_tools 级别时不向模型提供该工具
+    @agent.tool(name='tool_search', prepare=_prepare_tool_search)
     async def tool_search(ctx: RunContext[Any], query: str, max_results: int = 5) -> str:
         """使用 DuckDuckGo 搜索引擎进行网络搜索"""
         logger.info(f"duckduckgo_search called with query: '{query}' (max_results: {max_results})")
@@ -58,26 +94,15 @@ def get_or_create_agent() -> Agent:
             return "DDGS library not installed on server"
 
         try:
-            raw_results = DDGS().text(query, max_results=max_results)
-            if not isinstance(raw_results, list):
-                raw_results = list(raw_results)
-
-            logger.info(f"Raw results: {raw_results}")
-
-            formatted_results = [
-                {
-                    "title": r.get("title") or r.get("heading") or "",
-                    "url": r.get("href") or r.get("url") or r.get("link") or "",
-                    "snippet": r.get("body") or r.get("snippet") or r.get("text") or "",
-                }
-                for r in raw_results
-            ]
-
-            # 重要：返回格式化的字符串而不是字典列表
-            result_text = "\n\n".join([
-                f"标题: {r['title']}\n链接: {r['url']}\n摘要: {r['snippet']}"
-                for r in formatted_results[:max_results]
-            ])
+            # 模型给出的 max_results 不超过配置上限
+            max_results = result_shaper.cap(max_results)
+            # 相同查询命中缓存；并发的相同查询只抓取一次
+            formatted_results = await search_cache.get_or_fetch(
+                query, max_results, lambda: _fetch_search_results(query, max_results)
+            )
+
+            # 重要：返回格式化的字符串而不是字典列表；去重、截断、排序并控制在预算内
+            result_text = result_shaper.shape(query, formatted_results, max_results)
 
             logger.info(f"DDGS returned {len(formatted_results)} results for '{query}'")
             return result_text if result_text else "未找到相关结果"
@@ -3,13 +3,17 @@
 # @Email   : pi.apple.lab@gmail.com
 import json
 import logging
-from typing import List, Dict, AsyncIterable, Any
+import time
+from typing import List, Dict, AsyncIterable, Any, Optional
 
 from pydantic import BaseModel, Field
 from pydantic_ai import Agent
-from pydantic_ai.models.openai import OpenAIChatModel
-from pydantic_ai.providers.openai import OpenAIProvider
 from src.common.config import settings
+from src.services.degradation import degradation_controller
+from src.services.llm_hedging import llm_hedger
+from src.services.llm_router import provider_router
+from src.services.near_dup_cache import near_dup_cache
+from src.services.response_cache import cache_key, replay_chunks, response_cache
 
 debug = False
 
@@ -18,17 +22,24 @@ class ChatResponse(BaseModel):
     content: str = Field(..., description="Assistant's response")
 
 
-# 初始化 provider / model（你原来的配置）
-deepseek_provider = OpenAIProvider(
-    base_url='https://api.deepseek.com',
-    api_key=settings.OPENAI_API_KEY
-)
-deepseek_model = OpenAIChatModel(model_name="deepseek-chat", provider=deepseek_provider)
+SYSTEM_PROMPT = "You are a helpful AI assistant."
+
+# 默认 model 为第一个配置的端点（AI_PROVIDER / LLM_ENDPOINTS）；每次对话由 provider_router 选择实际端点
+MODEL_NAME = provider_router.default.model_name
+deepseek_model = provider_router.model_for(provider_router.default)
 agent = Agent(
     model=deepseek_model,
-    system_prompt="You are a helpful AI assistant.",
+    system_prompt=SYSTEM_PROMPT,
     output_type=ChatResponse,
 )
+# 纯文本输出：不经过结构化输出的 JSON 解析与校验，直接转发模型的文本增量
+text_agent = Agent(
+    model=deepseek_model,
+    system_prompt=SYSTEM_PROMPT,
+)
+
+OUTPUT_MODE_TEXT = "text"
+OUTPUT_MODE_STRUCTURED = "structured"
 
 
 def _extract_text_from_partial(partial: Any) -> str:
@@ -59,8 +70,61 @@ def _extract_text_from_partial(partial: Any) -> str:
         return str(partial)
 
 
+class StreamDeltaTracker:
+    """
+    有状态的流式增量跟踪器：把模型返回的 partial 转换为“仅新增的后缀”。
+
+    partial 可能是累计全文（stream_output 的常见情况），也可能是增量片段：
+    partial 以已发送文本开头则视为累计全文，只发送新增部分；否则视为增量片段，原样追加
+    （片段可能正好与已发送文本的结尾相同，例如 "hel" 之后的 "l"，不能当作重复去掉）。
+    判断累计全文时只比较已发送文本最后 window 个字符是否对齐，而不是对全文做 startswith，
+    每个 chunk 的开销为 O(window + len(delta))，与已生成的文本长度无关。
+    已发送文本存放在分段缓冲区中，只在需要完整文本时 join 一次，避免反复字符串拼接。
+    """
+
+    def __init__(self, window: int = 64):
+        self.window = max(1, window)
+        self._parts: List[str] = []
+        self._length = 0
+        self._tail = ""
+        self._joined: Optional[str] = None
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def text(self) -> str:
+        """已发送的完整文本"""
+        if self._joined is None:
+            self._joined = "".join(self._parts)
+            self._parts = [self._joined] if self._joined else []
+        return self._joined
+
+    def feed(self, partial: str) -> str:
+        """输入一个 partial，返回需要发送的新增文本（可能为空串）"""
+        if not partial:
+            return ""
+        n = self._length
+        if n and len(partial) >= n:
+            # 累计全文：partial 在 [n-k, n) 处与已发送文本的尾部对齐，则新增部分为 partial[n:]
+            k = len(self._tail)
+            if partial[n - k:n] == self._tail:
+                return self._emit(partial[n:])
+        # 增量片段：原样追加
+        return self._emit(partial)
+
+    def _emit(self, delta: str) -> str:
+        if delta:
+            self._parts.append(delta)
+            self._length += len(delta)
+            self._tail = (self._tail + delta)[-self.window:]
+            self._joined = None
+        return delta
+
+
 def _compute_delta(prev: str, new: str) -> str:
     """
+    无状态版本，保留用于兼容；流式路径请使用 StreamDeltaTracker（每个 chunk 为线性开销）。
     计算 new 相对于 prev 的最小新增后缀（避免重复）。
     算法：寻找 prev 的最大后缀等于 new 的前缀的长度 k，返回 new[k:].
     另外处理 new 中包含 prev 的情况（直接去掉 prev 前缀）。
@@ -85,80 +149,160 @@ def _compute_delta(prev: str, new: str) -> str:
     return new
 
 
+def _build_prompt(messages: List[Dict[str, str]]) -> str:
+    """聚合用户输入（原有逻辑）；system 消息（滚动摘要）作为前置背景。没有用户消息时返回空串"""
+    user_content = ""
+    system_content = ""
+    for msg in messages:
+        if msg.get("role") == "user":
+            user_content += (msg.get("content", "") or "") + "\n"
+        elif msg.get("role") == "system":
+            system_content += (msg.get("content", "") or "") + "\n"
+    user_content = user_content.strip()
+    if user_content and system_content.strip():
+        user_content = f"以下是此前对话的摘要：\n{system_content.strip()}\n\n{user_content}"
+    return user_content
+
+
+async def _stream_text(prompt: str, model: Any = None, model_settings: Optional[Dict[str, Any]] = None) -> AsyncIterable[str]:
+    """文本模式：模型返回的文本增量原样转发，没有逐块的解析/校验/序列化，也没有二次遍历"""
+    async with text_agent.run_stream(prompt, model=model, model_settings=model_settings) as result:
+        async for delta in result.stream_text(delta=True, debounce_by=None):
+            if delta:
+                if debug: print("Yield delta (text):", delta)
+                yield delta
+
+
+async def _stream_structured(prompt: str, model: Any = None, model_settings: Optional[Dict[str, Any]] = None) -> AsyncIterable[str]:
+    """
+    结构化模式：兼容多种 agent 流接口；对每次从模型得到的“片段”，合成 current_text（最新完整文本），
+    然后由 StreamDeltaTracker 计算相对于已发送文本的 delta 并取出发送。
+    """
+    tracker = StreamDeltaTracker()  # 两条路径共享，降级时不会重复发送已发出的文本
+    async with agent.run_stream(prompt, model=model, model_settings=model_settings) as result:
+        # 直接使用结构化流（stream_output）处理DeepSeek API的结构化响应
+        try:
+            if debug: print("使用结构化流 (stream_output)")
+            async for partial in result.stream_output():
+                text = _extract_text_from_partial(partial)
+                if text is None:
+                    continue
+                # partial 可能是累计全文，也可能是增量片段，由 tracker 统一处理
+                delta = tracker.feed(text)
+                if delta:
+                    if debug: print("Yield delta (output):", delta)
+                    yield delta
+            return
+        except Exception as e:
+            logging.warning(f"结构化流处理异常: {e}")
+
+        # 降级到 stream_responses + validate_response_output；失败时向上抛出
+        if debug: print("尝试 stream_responses + validate_response_output")
+        async for model_response, last in result.stream_responses(debounce_by=0.01):
+            try:
+                validated = await result.validate_response_output(model_response, allow_partial=not last)
+            except Exception as e:
+                logging.warning(f"validate_response_output 失败: {e}")
+                continue
+            text = _extract_text_from_partial(validated)
+            if text is None:
+                continue
+            # 合并逻辑同上
+            delta = tracker.feed(text)
+            if delta:
+                if debug: print("Yield delta (validated):", delta)
+                yield delta
+
+
+async def _stream_routed(prompt: str, endpoint=None, served: Optional[list] = None) -> AsyncIterable[str]:
+    """
+    由 provider_router 选择端点（或使用指定端点）执行一次流式生成，把首字延迟与成败反馈给路由器。
+    负载降级到 cap_output 及以上时限制最大输出 token。首字到达时把 (端点, 使用的 model_settings) 记入 served
+    （对冲时第一个即胜出者）。
+    """
+    endpoint = endpoint or provider_router.choose()
+    stream_fn = _stream_structured if settings.CHAT_OUTPUT_MODE == OUTPUT_MODE_STRUCTURED else _stream_text
+    model_settings = degradation_controller.model_settings()
+    start = time.perf_counter()
+    first = True
+    provider_router.begin(endpoint)
+    try:
+        async for delta in stream_fn(prompt, provider_router.model_for(endpoint), model_settings):
+            if first:
+                first = False
+                provider_router.record_ttft(endpoint, (time.perf_counter() - start) * 1000.0)
+                if served is not None:
+                    served.append((endpoint, model_settings))
+            yield delta
+    except Exception:
+        provider_router.record_failure(endpoint)
+        raise
+    else:
+        provider_router.record_success(endpoint)
+    finally:
+        provider_router.end(endpoint)
+
+
+def _stream_hedged(prompt: str, primary, served: Optional[list] = None) -> AsyncIterable[str]:
+    """LLM_HEDGE_ENABLED 时对冲：主请求首字超时后向另一个端点（只有一个端点时为同一端点）再发一次"""
+    if not llm_hedger.enabled:
+        return _stream_routed(prompt, primary, served)
+    return llm_hedger.stream(
+        lambda: _stream_routed(prompt, primary, served),
+        lambda: _stream_routed(prompt, provider_router.choose(exclude=[primary]), served),
+        llm_hedger.delay_ms(primary.ttft_window),
+    )
+
+
+def _cache_scope(endpoint) -> str:
+    """缓存按实际生成回答的模型与输出模式区分：路由到不同模型的请求不会复用彼此的回答"""
+    return f"{endpoint.model_name}|{settings.CHAT_OUTPUT_MODE}"
+
+
 async def stream_chat_response(messages: List[Dict[str, str]]) -> AsyncIterable[str]:
     """
     返回 AsyncIterable[str]，每次 yield 一个**仅新增的文本后缀（delta）**（不带 data: 前缀）。
-    兼容多种 agent 流接口；对每次从模型得到的“片段”，我们会合成 current_text（最新完整文本），
-    然后计算相对于 last_sent_text 的 delta 并取出发送。
+    settings.CHAT_OUTPUT_MODE 选择结构化模式（默认，ChatResponse）或文本模式（首字延迟最低）。
+    可缓存的请求先查 response_cache（精确匹配），单轮请求再查 near_dup_cache（近似重复），
+    命中时按 delta 格式回放；只有完整结束的回答才写入缓存。
+    缓存键包含本次路由到的端点的模型（_cache_scope），写入时使用实际产出回答（对冲胜出）的端点；
+    负载降级时限制了最大输出 token 的回答可能被截断，不写入缓存。
     """
-    last_sent = ""
-    last_full = ""  # 跟踪模型当前的“完整文本”状态
     try:
-        # 聚合用户输入（原有逻辑）
-        user_content = ""
-        for msg in messages:
-            if msg.get("role") == "user":
-                user_content += (msg.get("content", "") or "") + "\n"
-        user_content = user_content.strip()
-
-        if not user_content:
+        prompt = _build_prompt(messages)
+        if not prompt:
             yield "错误：没有有效的用户消息"
             return
 
-        async with agent.run_stream(user_content) as result:
-            # 直接使用结构化流（stream_output）处理DeepSeek API的结构化响应
-            try:
-                if debug: print("使用结构化流 (stream_output)")
-                async for partial in result.stream_output():
-                    text = _extract_text_from_partial(partial)
-                    if text is None:
-                        continue
-                    # candidate full text 判断（如果 partial 看起来是累计文本则直接用 text，否则 append）
-                    if text.startswith(last_full):
-                        candidate_full = text
-                    else:
-                        candidate_full = last_full + text
-
-                    delta = _compute_delta(last_sent, candidate_full)
-                    if delta:
-                        if debug: print("Yield delta (output):", delta)
-                        yield delta
-                        last_sent += delta
-                    last_full = candidate_full
+        primary = provider_router.choose()
+        cacheable = response_cache.is_cacheable(messages)
+        single_turn = len(messages) == 1
+        if cacheable:
+            scope = _cache_scope(primary)
+            cached = await response_cache.get(cache_key(messages, scope, SYSTEM_PROMPT))
+            if cached is None and single_turn:
+                near = near_dup_cache.lookup(prompt, scope)
+                if near is not None:
+                    cached = near[0]
+                    logging.debug(f"近似重复提示词命中，相似度 {near[1]:.2f}")
+            if cached is not None:
+                for delta in replay_chunks(cached):
+                    yield delta
                 return
-            except Exception as e:
-                logging.warning(f"结构化流处理异常: {e}")
 
-            # 3) 降级到 stream_responses + validate_response_output
-            try:
-                if debug: print("尝试 stream_responses + validate_response_output")
-                async for model_response, last in result.stream_responses(debounce_by=0.01):
-                    try:
-                        validated = await result.validate_response_output(model_response, allow_partial=not last)
-                    except Exception as e:
-                        logging.warning(f"validate_response_output 失败: {e}")
-                        continue
-                    text = _extract_text_from_partial(validated)
-                    if text is None:
-                        continue
-                    # 合并逻辑同上
-                    if text.startswith(last_full):
-                        candidate_full = text
-                    else:
-                        candidate_full = last_full + text
-
-                    delta = _compute_delta(last_sent, candidate_full)
-                    if delta:
-                        if debug: print("Yield delta (validated):", delta)
-                        yield delta
-                        last_sent += delta
-                    last_full = candidate_full
-                return
-            except Exception as e:
-                logging.warning(f"stream_responses 路径失败: {e}")
-                yield f"请求失败: {e}"
-                return
+        parts: List[str] = []
+        served: list = []
+        async for delta in _stream_hedged(prompt, primary, served):
+            parts.append(delta)
+            yield delta
+
+        if cacheable and served and served[0][1] is None:
+            answer = "".join(parts)
+            scope = _cache_scope(served[0][0])
+            await response_cache.set(cache_key(messages, scope, SYSTEM_PROMPT), answer)
+            if single_turn:
+                near_dup_cache.add(prompt, answer, scope)
 
     except Exception as outer:
-        logging.warning(f"stream_chat_response 最外层异常: {outer}")
+        logging.warning(f"stream_chat_response 异常: {outer}")
         yield f"请求失败: {outer}"
@@ -0,0 +1,102 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.common.config import settings
+from src.crud.crud_message import async_get_recent_messages
+from src.crud.crud_summary import async_get_summary
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算 token 数：CJK 字符约 1 token/字，其余约 4 字符/token。
+    只用于预算控制，不追求与 tokenizer 完全一致。
+    """
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if '\u4e00' <= ch <= '\u9fff' or '\u3040' <= ch <= '\u30ff')
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _fit_budget(
+        newest_first: Iterable[Tuple[str, str]],
+        max_chars: int,
+        max_tokens: int,
+) -> List[Tuple[str, str]]:
+    """从最新消息开始累加，直到超出字符/token 预算（0 表示不限），返回按时间正序的 (role, content)"""
+    selected: List[Tuple[str, str]] = []
+    chars = tokens = 0
+    for role, content in newest_first:
+        content = content or ""
+        chars += len(content)
+        if max_chars and chars > max_chars:
+            break
+        if max_tokens:
+            tokens += estimate_tokens(content)
+            if tokens > max_tokens:
+                break
+        selected.append((role, content))
+    selected.reverse()
+    return selected
+
+
+async def load_context_window(
+        db: AsyncSession,
+        conv_id: int,
+        max_messages: Optional[int] = None,
+        max_chars: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        after_id: int = 0,
+) -> List[Tuple[str, str]]:
+    """
+    加载会话最近的、满足条数与字符/token 预算的消息，返回按时间正序的 (role, content) 元组。
+    通过倒序 LIMIT 查询实现，每轮开销只取决于预算，与会话总长度无关。
+    """
+    max_messages = settings.CHAT_HISTORY_MAX_MESSAGES if max_messages is None else max_messages
+    max_chars = settings.CHAT_HISTORY_MAX_CHARS if max_chars is None else max_chars
+    max_tokens = settings.CHAT_HISTORY_MAX_TOKENS if max_tokens is None else max_tokens
+    if max_messages <= 0:
+        return []
+
+    rows = await async_get_recent_messages(db, conv_id, max_messages, after_id=after_id)
+    return _fit_budget(((role, content) for _, role, content in rows), max_chars, max_tokens)
+
+
+async def load_conversation_context(db: AsyncSession, conv_id: int) -> List[Dict[str, str]]:
+    """
+    组装发送给模型的历史：已有滚动摘要时，以 system 消息的形式放在最前，
+    后面只跟水位线之后的最近消息。读取的是最近一次提交的摘要版本，
+    后台正在重新生成摘要时不会等待。
+    """
+    summary_row = await async_get_summary(db, conv_id)
+    summary, watermark = (summary_row[0], summary_row[1]) if summary_row else ("", 0)
+
+    window = await load_context_window(db, conv_id, after_id=watermark)
+    history = [{"role": role, "content": content} for role, content in window]
+    if summary:
+        history.insert(0, {"role": "system", "content": summary})
+    return history
+
+
+def trim_history(
+        history: List[Dict[str, str]],
+        max_messages: Optional[int] = None,
+        max_chars: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+) -> List[Dict[str, str]]:
+    """对客户端传入的 history 应用同样的预算，只保留最新的部分"""
+    max_messages = settings.CHAT_HISTORY_MAX_MESSAGES if max_messages is None else max_messages
+    max_chars = settings.CHAT_HISTORY_MAX_CHARS if max_chars is None else max_chars
+    max_tokens = settings.CHAT_HISTORY_MAX_TOKENS if max_tokens is None else max_tokens
+    if max_messages <= 0:
+        return []
+
+    recent = history[-max_messages:]
+    newest_first = ((m.get("role"), m.get("content")) for m in reversed(recent))
+    return [{"role": role, "content": content} for role, content in _fit_budget(newest_first, max_chars, max_tokens)]
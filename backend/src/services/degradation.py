@@ -0,0 +1,250 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from src.common.config import settings
+from src.services.admission import AdmissionRejected, admission_controller
+from src.services.llm_router import provider_router
+
+logger = logging.getLogger(__name__)
+
+SERVICE_LEVEL_HEADER = "X-Service-Level"
+REJECT_LOAD_SHED = "load_shed"
+
+# 服务等级逐级叠加：每一级保留上一级的所有限制
+LEVEL_NORMAL = 0
+LEVEL_CAP_OUTPUT = 1  # 限制模型最大输出 token
+LEVEL_CAP_HISTORY = 2  # 限制 chat_api 发送给模型的历史消息数
+LEVEL_NO_TOOLS = 3  # AG-UI agent 不再提供 tool_search
+LEVEL_SHED = 4  # 拒绝新的生成请求（503），续传不受影响
+LEVEL_NAMES = ("normal", "cap_output", "cap_history", "no_tools", "shed")
+
+
+def parse_level_thresholds(raw: str) -> List[float]:
+    """解析 "0.75,0.9,1.0,1.25" 形式的配置：依次为进入 1~4 级所需的压力值，必须递增"""
+    thresholds = [float(x) for x in (raw or "").split(",") if x.strip()]
+    if len(thresholds) != len(LEVEL_NAMES) - 1:
+        raise ValueError(f"Expected {len(LEVEL_NAMES) - 1} degradation thresholds, got {len(thresholds)}")
+    if any(b <= a for a, b in zip(thresholds, thresholds[1:])):
+        raise ValueError(f"Degradation thresholds must be increasing: {thresholds}")
+    return thresholds
+
+
+def _endpoint_ttfts() -> List[Tuple[float, float]]:
+    """各端点的 (EWMA 首字延迟, 最近一次样本的 time.monotonic)，没有样本的端点不计入"""
+    return [(e.ewma_ttft_ms, e.last_ttft_at) for e in provider_router.endpoints if e.ewma_ttft_ms is not None]
+
+
+class DegradationController:
+    """
+    按负载自动降级（每个 worker 进程一份）。
+
+    压力 = max(进行中的生成数 / inflight_high, 事件循环延迟 / loop_lag_high_ms, 上游首字延迟 / ttft_high_ms)，
+    上游首字延迟取最近 ttft_max_age 秒内有样本的端点中最低的 EWMA（路由器会优先选择它）；
+    过期的样本不计入，因为 shed 级别不再调用上游、不会产生新样本，否则旧的高延迟会让等级永远降不下来。
+    压力达到 thresholds[i] 时进入 i+1 级（可以一次升多级，尽快卸载压力）；
+    降级需要压力低于当前级阈值减去 hysteresis 并持续 min_dwell 秒，且每次只降一级，避免等级来回抖动。
+    事件循环延迟由后台任务按 sample_interval 采样 sleep 的超时部分，做 EWMA 平滑。
+    """
+
+    def __init__(
+            self,
+            enabled: bool = True,
+            thresholds: Sequence[float] = (0.75, 0.9, 1.0, 1.25),
+            hysteresis: float = 0.1,
+            min_dwell: float = 10.0,
+            inflight_high: float = 64,
+            loop_lag_high_ms: float = 200.0,
+            ttft_high_ms: float = 8000.0,
+            ttft_max_age: float = 30.0,
+            max_output_tokens: int = 512,
+            history_max_messages: int = 6,
+            sample_interval: float = 0.5,
+            alpha: float = 0.3,
+            retry_after: int = 2,
+            inflight_fn: Optional[Callable[[], float]] = None,
+            ttft_fn: Optional[Callable[[], Sequence[Tuple[float, float]]]] = None,
+    ):
+        self.enabled = enabled
+        self.thresholds = list(thresholds)
+        self.hysteresis = max(0.0, hysteresis)
+        self.min_dwell = max(0.0, min_dwell)
+        self.inflight_high = inflight_high
+        self.loop_lag_high_ms = loop_lag_high_ms
+        self.ttft_high_ms = ttft_high_ms
+        self.ttft_max_age = ttft_max_age
+        self.max_output_tokens = max_output_tokens
+        self.history_max_messages = history_max_messages
+        self.sample_interval = sample_interval
+        self.alpha = alpha
+        self.retry_after = max(1, retry_after)
+        self.inflight_fn = inflight_fn or (lambda: 0)
+        self.ttft_fn = ttft_fn or (lambda: [])
+        self.level = LEVEL_NORMAL
+        self.pressure = 0.0
+        self.signals: Dict[str, Any] = {}
+        self.loop_lag_ms = 0.0
+        self._changed_at = time.monotonic()
+        self._below_since: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        # 统计
+        self.transitions = 0
+        self.shed = 0
+        self.time_in_level = [0.0] * len(LEVEL_NAMES)
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=20)
+
+    # ------------------------------ 信号 ------------------------------
+    def record_loop_lag(self, lag_ms: float) -> None:
+        self.loop_lag_ms = self.alpha * max(0.0, lag_ms) + (1 - self.alpha) * self.loop_lag_ms
+
+    @staticmethod
+    def _ratio(value: Optional[float], high: float) -> float:
+        if value is None or high <= 0:
+            return 0.0
+        return value / high
+
+    def _pressure(self, now: float) -> float:
+        inflight = self.inflight_fn()
+        fresh = [ttft for ttft, sampled_at in self.ttft_fn() if now - sampled_at <= self.ttft_max_age]
+        ttft_ms = min(fresh) if fresh else None
+        ratios = {
+            "inflight": self._ratio(inflight, self.inflight_high),
+            "loop_lag": self._ratio(self.loop_lag_ms, self.loop_lag_high_ms),
+            "ttft": self._ratio(ttft_ms, self.ttft_high_ms),
+        }
+        self.signals = {
+            "inflight": inflight,
+            "loop_lag_ms": round(self.loop_lag_ms, 3),
+            "ttft_ms": round(ttft_ms, 3) if ttft_ms is not None else None,
+            "ratios": {k: round(v, 3) for k, v in ratios.items()},
+        }
+        return max(ratios.values())
+
+    # ------------------------------ 等级 ------------------------------
+    def evaluate(self, now: Optional[float] = None) -> int:
+        """根据当前压力更新并返回服务等级"""
+        if not self.enabled:
+            return LEVEL_NORMAL
+        now = time.monotonic() if now is None else now
+        self.pressure = self._pressure(now)
+        target = sum(1 for t in self.thresholds if self.pressure >= t)
+        if target > self.level:
+            self._set_level(target, now)
+        elif self.level > LEVEL_NORMAL and self.pressure < self.thresholds[self.level - 1] - self.hysteresis:
+            if self._below_since is None:
+                self._below_since = now
+            if now - self._below_since >= self.min_dwell and now - self._changed_at >= self.min_dwell:
+                self._set_level(self.level - 1, now)
+        else:
+            self._below_since = None
+        return self.level
+
+    def _set_level(self, level: int, now: float) -> None:
+        previous = self.level
+        self.time_in_level[previous] += now - self._changed_at
+        self.level = level
+        self._changed_at = now
+        self._below_since = None
+        self.transitions += 1
+        self.history.append({
+            "at": time.time(), "from": LEVEL_NAMES[previous], "to": LEVEL_NAMES[level],
+            "pressure": round(self.pressure, 3),
+        })
+        log = logger.warning if level > previous else logger.info
+        log(f"Service level {LEVEL_NAMES[previous]} -> {LEVEL_NAMES[level]} (pressure={self.pressure:.2f}, "
+            f"signals={self.signals})")
+
+    # ------------------------------ 各级效果 ------------------------------
+    def check_admission(self) -> int:
+        """新的生成请求入口调用：shed 级别直接 503，否则返回当前等级"""
+        level = self.evaluate()
+        if level >= LEVEL_SHED:
+            self.shed += 1
+            raise AdmissionRejected(503, REJECT_LOAD_SHED, self.retry_after)
+        return level
+
+    def model_settings(self) -> Optional[Dict[str, Any]]:
+        """cap_output 及以上：限制模型最大输出 token；正常时返回 None（不覆盖 agent 的设置）"""
+        if self.level >= LEVEL_CAP_OUTPUT and self.max_output_tokens > 0:
+            return {"max_tokens": self.max_output_tokens}
+        return None
+
+    def history_limit(self) -> Optional[int]:
+        """cap_history 及以上：发送给模型的历史消息数上限"""
+        if self.level >= LEVEL_CAP_HISTORY and self.history_max_messages > 0:
+            return self.history_max_messages
+        return None
+
+    def tools_enabled(self) -> bool:
+        return self.level < LEVEL_NO_TOOLS
+
+    def headers(self) -> Dict[str, str]:
+        return {SERVICE_LEVEL_HEADER: str(self.level)}
+
+    # ------------------------------ 事件循环延迟采样 ------------------------------
+    def start(self) -> None:
+        if not self.enabled or self.sample_interval <= 0 or self._task is not None:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._monitor())
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _monitor(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.sample_interval)
+            self.record_loop_lag((loop.time() - start - self.sample_interval) * 1000.0)
+            try:
+                self.evaluate()
+            except Exception as ex:
+                logger.exception(f"Degradation evaluate failed: {ex}")
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        time_in_level = list(self.time_in_level)
+        time_in_level[self.level] += now - self._changed_at
+        return {
+            "enabled": self.enabled,
+            "level": self.level,
+            "name": LEVEL_NAMES[self.level],
+            "pressure": round(self.pressure, 3),
+            "signals": self.signals,
+            "thresholds": dict(zip(LEVEL_NAMES[1:], self.thresholds)),
+            "hysteresis": self.hysteresis,
+            "min_dwell_seconds": self.min_dwell,
+            "transitions": self.transitions,
+            "shed": self.shed,
+            "seconds_in_level": {name: round(t, 3) for name, t in zip(LEVEL_NAMES, time_in_level)},
+            "recent_transitions": list(self.history),
+        }
+
+
+degradation_controller = DegradationController(
+    enabled=settings.DEGRADE_ENABLED,
+    thresholds=parse_level_thresholds(settings.DEGRADE_LEVEL_THRESHOLDS),
+    hysteresis=settings.DEGRADE_HYSTERESIS,
+    min_dwell=settings.DEGRADE_MIN_DWELL_SECONDS,
+    inflight_high=settings.DEGRADE_INFLIGHT_HIGH or settings.ADMISSION_MAX_GLOBAL,
+    loop_lag_high_ms=settings.DEGRADE_LOOP_LAG_MS_HIGH,
+    ttft_high_ms=settings.DEGRADE_TTFT_MS_HIGH,
+    ttft_max_age=settings.DEGRADE_TTFT_MAX_AGE_SECONDS,
+    max_output_tokens=settings.DEGRADE_MAX_OUTPUT_TOKENS,
+    history_max_messages=settings.DEGRADE_HISTORY_MAX_MESSAGES,
+    sample_interval=settings.DEGRADE_LOOP_LAG_SAMPLE_SECONDS,
+    retry_after=settings.ADMISSION_RETRY_AFTER_SECONDS,
+    inflight_fn=lambda: admission_controller.active + len(admission_controller.scheduler),
+    ttft_fn=_endpoint_ttfts,
+)
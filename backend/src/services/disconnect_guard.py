@@ -0,0 +1,122 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# 客户端中途断开时，已生成的部分回答带此标记落库
+TRUNCATED_MARKER = "\n\n[回答已中断]"
+
+
+class ClientDisconnected(Exception):
+    """SSE 客户端已断开，生成应立即停止"""
+
+
+class DisconnectStats:
+    """
+    按路由统计中途断开的流：取消次数、取消时已产出的 token，以及估算节省的 token。
+
+    节省量 = 该路由完整回答的平均 token 数（EWMA）- 取消时已产出的 token 数，不足 0 记为 0。
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.completed = 0
+        self.cancelled = 0
+        self.emitted_tokens = 0
+        self.tokens_saved = 0
+        self.avg_completion_tokens: Optional[float] = None
+
+    def record_completed(self, tokens: int) -> None:
+        self.completed += 1
+        if self.avg_completion_tokens is None:
+            self.avg_completion_tokens = float(tokens)
+        else:
+            self.avg_completion_tokens = self.alpha * tokens + (1 - self.alpha) * self.avg_completion_tokens
+
+    def record_cancelled(self, tokens: int) -> int:
+        self.cancelled += 1
+        self.emitted_tokens += tokens
+        saved = max(0, int(round((self.avg_completion_tokens or 0.0) - tokens)))
+        self.tokens_saved += saved
+        return saved
+
+    def snapshot(self) -> Dict[str, Any]:
+        total = self.completed + self.cancelled
+        return {
+            "completed": self.completed,
+            "cancelled": self.cancelled,
+            "cancel_ratio": round(self.cancelled / total, 4) if total else None,
+            "emitted_tokens_before_cancel": self.emitted_tokens,
+            "estimated_tokens_saved": self.tokens_saved,
+            "avg_completion_tokens": round(self.avg_completion_tokens, 1) if self.avg_completion_tokens is not None else None,
+        }
+
+
+disconnect_stats: Dict[str, DisconnectStats] = {"chat": DisconnectStats(), "agui": DisconnectStats()}
+
+
+async def cancel_on_disconnect(
+        source: AsyncIterable[Any],
+        is_disconnected: Callable[[], Awaitable[bool]],
+        poll_interval: float = 0.5,
+) -> AsyncIterator[Any]:
+    """
+    转发 source，同时每隔 poll_interval 秒检查一次客户端是否已断开（等待上游期间也会检查）。
+    断开时取消正在等待的上游 __anext__、关闭上游生成器（连带结束 agent 运行与工具调用），
+    然后抛出 ClientDisconnected。
+    """
+    iterator = source.__aiter__()
+    pending: Optional[asyncio.Future] = None
+    last_check = time.monotonic()
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = max(0.0, last_check + poll_interval - time.monotonic())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if time.monotonic() - last_check >= poll_interval:
+                last_check = time.monotonic()
+                if await is_disconnected():
+                    raise ClientDisconnected()
+            if not done:
+                continue
+            task, pending = pending, None
+            try:
+                item = task.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+        if hasattr(iterator, "aclose"):
+            try:
+                await iterator.aclose()
+            except Exception as e:
+                logger.debug(f"关闭上游流异常: {e}")
+
+
+_background: Set[asyncio.Task] = set()
+
+
+def run_detached(coro: Awaitable[Any], description: str) -> asyncio.Task:
+    """
+    在独立任务中执行收尾工作（例如保存被中断的回答）：请求任务可能已被取消，
+    不能在其中继续 await。
+    """
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+
+    def _done(t: asyncio.Task) -> None:
+        _background.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logger.error(f"{description} 失败（非致命）: {t.exception()}")
+
+    task.add_done_callback(_done)
+    return task
@@ -0,0 +1,186 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from src.common.config import settings
+from src.common.metrics import LatencyHistogram, SampleWindow
+from src.common.stream_pump import StreamPump
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = "primary"
+HEDGE = "hedge"
+
+
+class HedgeStats:
+    def __init__(self):
+        self.requests = 0
+        self.hedged = 0
+        self.primary_wins = 0
+        self.hedge_wins = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.delay = LatencyHistogram()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_rate": round(self.hedged / self.requests, 4) if self.requests else None,
+            "primary_wins": self.primary_wins,
+            "hedge_wins": self.hedge_wins,
+            "hedge_win_rate": round(self.hedge_wins / self.hedged, 4) if self.hedged else None,
+            "failures": self.failures,
+            "cancelled": self.cancelled,
+            "delay": self.delay.snapshot(),
+        }
+
+
+class LLMHedger:
+    """
+    流式生成的请求对冲：主请求在 hedge 延迟内没有产出第一个 token 时，再发起一个相同的请求
+    （同一端点或另一个端点），谁先产出 token 谁胜出，另一个立即取消（关闭其 HTTP 流，不再消耗 token）。
+
+    延迟取最近首字延迟样本的 percentile 分位数（样本不足 min_samples 时用 default_delay_ms），
+    并限制在 [min_delay_ms, max_delay_ms] 之间。主请求在首字前失败时立即发起对冲请求。
+    """
+
+    def __init__(
+            self,
+            enabled: bool = False,
+            percentile: float = 95.0,
+            default_delay_ms: float = 1500.0,
+            min_delay_ms: float = 200.0,
+            max_delay_ms: float = 5000.0,
+            min_samples: int = 20,
+    ):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.default_delay_ms = default_delay_ms
+        self.min_delay_ms = min_delay_ms
+        self.max_delay_ms = max_delay_ms
+        self.min_samples = min_samples
+        self.counters = HedgeStats()
+
+    def delay_ms(self, ttft: Optional[SampleWindow]) -> float:
+        delay = self.default_delay_ms
+        if ttft is not None and ttft.count >= self.min_samples:
+            delay = ttft.percentile(self.percentile) or delay
+        return min(max(delay, self.min_delay_ms), self.max_delay_ms)
+
+    async def stream(
+            self,
+            start_primary: Callable[[], AsyncIterator[str]],
+            start_hedge: Callable[[], AsyncIterator[str]],
+            delay_ms: float,
+    ) -> AsyncIterator[str]:
+        """
+        返回胜出请求的 delta 流；两个请求都在首字前失败时抛出最后一个异常。
+        每个请求从头到尾在自己的 StreamPump 任务中迭代（pydantic-ai 的 cancel scope 不能跨任务），
+        这里只竞争读取它们的队列；落败的请求在它自己的任务中被取消。
+        """
+        self.counters.requests += 1
+        streams: Dict[asyncio.Task, Tuple[str, StreamPump]] = {}  # 等待首个 delta 的读取 -> (label, pump)
+
+        def launch(label: str, factory: Callable[[], AsyncIterator[str]]) -> None:
+            pump = StreamPump(factory())
+            streams[asyncio.ensure_future(pump.get())] = (label, pump)
+
+        launch(PRIMARY, start_primary)
+        hedge_started = False
+        winner: Optional[Tuple[str, StreamPump]] = None
+        first: Optional[str] = None
+        finished = False  # 胜出的流没有任何输出就结束了
+        last_error: Optional[BaseException] = None
+        start = time.perf_counter()
+        try:
+            while winner is None and streams:
+                timeout = None
+                if not hedge_started:
+                    timeout = max(0.0, delay_ms / 1000.0 - (time.perf_counter() - start))
+                done, _ = await asyncio.wait(streams, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_started = True
+                    self.counters.hedged += 1
+                    self.counters.delay.observe(delay_ms)
+                    logger.info(f"首字超过 {delay_ms:.0f}ms 未到达，发起对冲请求")
+                    launch(HEDGE, start_hedge)
+                    continue
+                # 同时完成时优先主请求
+                for task in sorted(done, key=lambda t: streams[t][0] != PRIMARY):
+                    label, pump = streams.pop(task)
+                    if winner is not None:
+                        streams[task] = (label, pump)  # 留给下面统一关闭
+                        continue
+                    try:
+                        first = task.result()
+                        winner = (label, pump)
+                    except StopAsyncIteration:
+                        winner = (label, pump)
+                        finished = True
+                    except Exception as e:
+                        last_error = e
+                        logger.warning(f"{label} 请求在首字前失败: {e}")
+                if winner is None and not hedge_started:
+                    # 主请求首字前失败，不必等待延迟
+                    hedge_started = True
+                    self.counters.hedged += 1
+                    launch(HEDGE, start_hedge)
+        finally:
+            await self._cancel(streams)
+
+        if winner is None:
+            self.counters.failures += 1
+            raise last_error
+        label, pump = winner
+        if label == PRIMARY:
+            self.counters.primary_wins += 1
+        else:
+            self.counters.hedge_wins += 1
+        try:
+            if finished:
+                return
+            yield first
+            async for delta in pump:
+                yield delta
+        finally:
+            await pump.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "percentile": self.percentile,
+            "min_delay_ms": self.min_delay_ms,
+            "max_delay_ms": self.max_delay_ms,
+            **self.counters.snapshot(),
+        }
+
+    async def _cancel(self, streams: Dict[asyncio.Task, Tuple[str, StreamPump]]) -> None:
+        """取消落败的请求：放弃尚未完成的读取，再在各自的任务中取消上游并等待其退出"""
+        if not streams:
+            return
+        tasks: List[asyncio.Task] = list(streams)
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                self.counters.cancelled += 1
+            elif not task.cancelled() and task.exception() is None:
+                self.counters.cancelled += 1
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for task in tasks:
+            _, pump = streams[task]
+            await pump.aclose()
+        streams.clear()
+
+
+llm_hedger = LLMHedger(
+    enabled=settings.LLM_HEDGE_ENABLED,
+    percentile=settings.LLM_HEDGE_PERCENTILE,
+    default_delay_ms=settings.LLM_HEDGE_DEFAULT_DELAY_MS,
+    min_delay_ms=settings.LLM_HEDGE_MIN_DELAY_MS,
+    max_delay_ms=settings.LLM_HEDGE_MAX_DELAY_MS,
+)
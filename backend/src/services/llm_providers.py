@@ -0,0 +1,164 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import logging
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from src.common.config import settings
+from src.common.metrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionStats:
+    """
+    通过 httpcore 的 trace 扩展统计连接复用：每个请求是否新建了 TCP 连接、是否做了 TLS 握手，
+    以及建连和握手耗时。复用的请求不会出现 connect_tcp / start_tls 事件。
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+        self.http2_requests = 0
+        self.connect_latency = LatencyHistogram()
+        self.tls_latency = LatencyHistogram()
+
+    async def on_request(self, request: httpx.Request) -> None:
+        self.requests += 1
+        started: Dict[str, float] = {}
+
+        async def trace(name: str, info: Dict[str, Any]) -> None:
+            if name.endswith(".started"):
+                started[name[:-8]] = time.perf_counter()
+                return
+            if not name.endswith(".complete"):
+                return
+            event = name[:-9]
+            begin = started.pop(event, None)
+            elapsed_ms = (time.perf_counter() - begin) * 1000.0 if begin is not None else 0.0
+            if event == "connection.connect_tcp":
+                self.new_connections += 1
+                self.connect_latency.observe(elapsed_ms)
+            elif event == "connection.start_tls":
+                self.tls_handshakes += 1
+                self.tls_latency.observe(elapsed_ms)
+            elif event == "http2.send_request_headers":
+                self.http2_requests += 1
+
+        request.extensions["trace"] = trace
+
+    def snapshot(self) -> Dict[str, Any]:
+        reused = max(0, self.requests - self.new_connections)
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reused_connections": reused,
+            "reuse_ratio": round(reused / self.requests, 4) if self.requests else None,
+            "tls_handshakes": self.tls_handshakes,
+            "http2_requests": self.http2_requests,
+            "connect_latency": self.connect_latency.snapshot(),
+            "tls_latency": self.tls_latency.snapshot(),
+        }
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+class ProviderRegistry:
+    """
+    所有 LLM provider 共用一个显式配置的 httpx.AsyncClient：连接池上限、keep-alive 过期时间、
+    连接/读取超时以及可选的 HTTP/2。同一 (base_url, api_key) 只创建一个 provider，
+    同一 provider 上的同名模型只创建一个 model，连接在各服务之间复用，避免重复 TLS 握手。
+    """
+
+    def __init__(
+            self,
+            max_connections: int = 100,
+            max_keepalive_connections: int = 20,
+            keepalive_expiry: float = 60.0,
+            connect_timeout: float = 5.0,
+            read_timeout: float = 60.0,
+            http2: bool = False,
+    ):
+        self.connection_stats = ConnectionStats()
+        if http2 and not _http2_available():
+            logger.warning("LLM_HTTP2 已开启但未安装 h2，回退到 HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._http_client: Optional[httpx.AsyncClient] = None
+        self._providers: Dict[Tuple[str, str], OpenAIProvider] = {}
+        self._models: Dict[Tuple[str, str, str], OpenAIChatModel] = {}
+
+    @property
+    def http_client(self) -> httpx.AsyncClient:
+        if self._http_client is None or self._http_client.is_closed:
+            self._http_client = httpx.AsyncClient(
+                limits=self.limits,
+                timeout=self.timeout,
+                http2=self.http2,
+                event_hooks={"request": [self.connection_stats.on_request]},
+            )
+        return self._http_client
+
+    def get_provider(self, base_url: str, api_key: str) -> OpenAIProvider:
+        key = (base_url, api_key)
+        provider = self._providers.get(key)
+        if provider is None:
+            provider = self._providers[key] = OpenAIProvider(
+                base_url=base_url,
+                api_key=api_key,
+                http_client=self.http_client,
+            )
+        return provider
+
+    def get_model(self, model_name: str, base_url: str, api_key: str) -> OpenAIChatModel:
+        key = (model_name, base_url, api_key)
+        model = self._models.get(key)
+        if model is None:
+            model = self._models[key] = OpenAIChatModel(
+                model_name=model_name,
+                provider=self.get_provider(base_url, api_key),
+            )
+        return model
+
+    async def aclose(self) -> None:
+        if self._http_client is not None and not self._http_client.is_closed:
+            await self._http_client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "providers": len(self._providers),
+            "models": len(self._models),
+            "http2": self.http2,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "keepalive_expiry": self.limits.keepalive_expiry,
+            "connections": self.connection_stats.snapshot(),
+        }
+
+
+provider_registry = ProviderRegistry(
+    max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+    max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE,
+    keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY,
+    connect_timeout=settings.LLM_HTTP_CONNECT_TIMEOUT,
+    read_timeout=settings.LLM_HTTP_READ_TIMEOUT,
+    http2=settings.LLM_HTTP2,
+)
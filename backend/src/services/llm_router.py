@@ -0,0 +1,212 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import json
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence
+
+from src.common.config import settings
+from src.common.metrics import LatencyHistogram, SampleWindow
+from src.services.llm_providers import provider_registry
+
+logger = logging.getLogger(__name__)
+
+# AI_PROVIDER 对应的默认端点（OPENAI_BASE_URL 有值时覆盖 base_url）
+PROVIDER_DEFAULTS = {
+    "deepseek": ("https://api.deepseek.com", "deepseek-chat"),
+    "openai": ("https://api.openai.com/v1", "gpt-4o-mini"),
+}
+
+STRATEGY_LEAST_LATENCY = "least_latency"
+STRATEGY_WEIGHTED = "weighted"
+
+
+@dataclass
+class LLMEndpoint:
+    """一个 OpenAI 兼容端点及其运行时健康数据"""
+    name: str
+    base_url: str
+    api_key: str
+    model_name: str
+    weight: float = 1.0
+    # 运行时状态
+    ewma_ttft_ms: Optional[float] = None
+    last_ttft_at: float = 0.0  # 最近一次首字延迟样本的时间（time.monotonic）
+    ewma_error: float = 0.0
+    in_flight: int = 0
+    requests: int = 0
+    errors: int = 0
+    consecutive_failures: int = 0
+    cooldown_until: float = 0.0
+    ttft: LatencyHistogram = field(default_factory=LatencyHistogram)
+    ttft_window: SampleWindow = field(default_factory=SampleWindow)  # 最近的首字延迟样本，用于对冲延迟的分位数
+
+    def healthy(self, now: float) -> bool:
+        return self.cooldown_until <= now
+
+    def to_dict(self, now: float) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "base_url": self.base_url,
+            "model": self.model_name,
+            "weight": self.weight,
+            "healthy": self.healthy(now),
+            "cooldown_remaining_s": round(max(0.0, self.cooldown_until - now), 3),
+            "ewma_ttft_ms": round(self.ewma_ttft_ms, 3) if self.ewma_ttft_ms is not None else None,
+            "ewma_error": round(self.ewma_error, 4),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ttft": self.ttft.snapshot(),
+        }
+
+
+def parse_endpoints(raw: str, ai_provider: str, base_url: Optional[str], api_key: str) -> List[LLMEndpoint]:
+    """
+    LLM_ENDPOINTS 为 JSON 数组，例如
+    [{"name": "ds-1", "base_url": "https://api.deepseek.com", "model": "deepseek-chat", "weight": 2}]，
+    api_key 缺省时使用 OPENAI_API_KEY。为空时按 AI_PROVIDER（"deepseek" / "openai"，可写成 provider:model）生成单个端点。
+    """
+    if raw and raw.strip():
+        items = json.loads(raw)
+        endpoints = []
+        for i, item in enumerate(items):
+            endpoints.append(LLMEndpoint(
+                name=item.get("name") or f"endpoint-{i}",
+                base_url=item["base_url"],
+                api_key=item.get("api_key") or api_key,
+                model_name=item["model"],
+                weight=float(item.get("weight", 1.0)),
+            ))
+        if not endpoints:
+            raise ValueError("LLM_ENDPOINTS must contain at least one endpoint")
+        return endpoints
+
+    provider, _, model = (ai_provider or "deepseek").partition(":")
+    provider = provider.strip().lower()
+    if provider not in PROVIDER_DEFAULTS:
+        raise ValueError(f"Invalid AI_PROVIDER '{provider}'. Must be one of: {list(PROVIDER_DEFAULTS)}")
+    default_url, default_model = PROVIDER_DEFAULTS[provider]
+    return [LLMEndpoint(
+        name=provider,
+        base_url=base_url or default_url,
+        api_key=api_key,
+        model_name=model.strip() or default_model,
+    )]
+
+
+class ProviderRouter:
+    """
+    在多个 OpenAI 兼容端点之间为每次对话 / agent 运行选择端点。
+
+    - 每个端点维护首字延迟（TTFT）与错误率的 EWMA，以及进行中的请求数；
+    - 失败后错误率超过 error_threshold 或连续失败 max_consecutive_failures 次，端点进入 cooldown，
+      冷却期内不参与选择；全部端点都在冷却时选择最早恢复的那个，不会直接拒绝请求；
+    - least_latency：选择 EWMA TTFT ×（1 + 进行中请求数）/ weight 最小的健康端点，
+      还没有样本的端点优先（用于探测）；weighted：按 weight 随机选择健康端点；
+    - 慢端点在 least_latency 下分不到请求，EWMA 不会再更新：超过 ttft_stale_seconds 没有新样本的端点
+      在没有进行中请求时优先获得一次探测请求，过期后的第一个样本直接替换 EWMA，恢复的端点能重新赢回流量。
+    """
+
+    def __init__(
+            self,
+            endpoints: Sequence[LLMEndpoint],
+            strategy: str = STRATEGY_LEAST_LATENCY,
+            alpha: float = 0.3,
+            error_threshold: float = 0.5,
+            max_consecutive_failures: int = 3,
+            cooldown_seconds: float = 30.0,
+            ttft_stale_seconds: float = 30.0,
+    ):
+        if not endpoints:
+            raise ValueError("at least one LLM endpoint is required")
+        if strategy not in (STRATEGY_LEAST_LATENCY, STRATEGY_WEIGHTED):
+            raise ValueError(f"Invalid routing strategy '{strategy}'")
+        self.endpoints = list(endpoints)
+        self.strategy = strategy
+        self.alpha = alpha
+        self.error_threshold = error_threshold
+        self.max_consecutive_failures = max(1, max_consecutive_failures)
+        self.cooldown = cooldown_seconds
+        self.ttft_stale = ttft_stale_seconds
+
+    @property
+    def default(self) -> LLMEndpoint:
+        return self.endpoints[0]
+
+    def choose(self, exclude: Sequence[LLMEndpoint] = ()) -> LLMEndpoint:
+        now = time.monotonic()
+        pool = [e for e in self.endpoints if e not in exclude] or list(self.endpoints)
+        healthy = [e for e in pool if e.healthy(now)]
+        if not healthy:
+            return min(pool, key=lambda e: e.cooldown_until)
+        if len(healthy) == 1:
+            return healthy[0]
+        if self.strategy == STRATEGY_WEIGHTED:
+            return random.choices(healthy, weights=[max(e.weight, 0.0) or 1e-9 for e in healthy])[0]
+        return min(healthy, key=lambda e: self._score(e, now))
+
+    def _stale(self, endpoint: LLMEndpoint, now: float) -> bool:
+        return self.ttft_stale > 0 and now - endpoint.last_ttft_at > self.ttft_stale
+
+    def _score(self, endpoint: LLMEndpoint, now: float) -> float:
+        if endpoint.ewma_ttft_ms is None:
+            return -1.0 / (1 + endpoint.in_flight)
+        if endpoint.in_flight == 0 and self._stale(endpoint, now):
+            return 0.0  # 排在有新鲜样本的端点之前，探测一次
+        return endpoint.ewma_ttft_ms * (1 + endpoint.in_flight) / max(endpoint.weight, 1e-9)
+
+    def model_for(self, endpoint: LLMEndpoint):
+        return provider_registry.get_model(endpoint.model_name, endpoint.base_url, endpoint.api_key)
+
+    # ---------------- 结果反馈 ----------------
+    def begin(self, endpoint: LLMEndpoint) -> None:
+        endpoint.in_flight += 1
+        endpoint.requests += 1
+
+    def end(self, endpoint: LLMEndpoint) -> None:
+        endpoint.in_flight = max(0, endpoint.in_flight - 1)
+
+    def record_ttft(self, endpoint: LLMEndpoint, ttft_ms: float) -> None:
+        now = time.monotonic()
+        endpoint.ttft.observe(ttft_ms)
+        endpoint.ttft_window.observe(ttft_ms)
+        stale = self._stale(endpoint, now)
+        endpoint.last_ttft_at = now
+        if endpoint.ewma_ttft_ms is None or stale:
+            endpoint.ewma_ttft_ms = ttft_ms
+        else:
+            endpoint.ewma_ttft_ms = self.alpha * ttft_ms + (1 - self.alpha) * endpoint.ewma_ttft_ms
+
+    def record_success(self, endpoint: LLMEndpoint) -> None:
+        endpoint.ewma_error = (1 - self.alpha) * endpoint.ewma_error
+        endpoint.consecutive_failures = 0
+
+    def record_failure(self, endpoint: LLMEndpoint) -> None:
+        endpoint.errors += 1
+        endpoint.consecutive_failures += 1
+        endpoint.ewma_error = self.alpha + (1 - self.alpha) * endpoint.ewma_error
+        if endpoint.ewma_error >= self.error_threshold or endpoint.consecutive_failures >= self.max_consecutive_failures:
+            endpoint.cooldown_until = time.monotonic() + self.cooldown
+            logger.warning(
+                f"LLM 端点 {endpoint.name} 进入冷却 {self.cooldown}s"
+                f"（错误率 {endpoint.ewma_error:.2f}，连续失败 {endpoint.consecutive_failures} 次）"
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "strategy": self.strategy,
+            "endpoints": [e.to_dict(now) for e in self.endpoints],
+        }
+
+
+provider_router = ProviderRouter(
+    parse_endpoints(settings.LLM_ENDPOINTS, settings.AI_PROVIDER, settings.OPENAI_BASE_URL, settings.OPENAI_API_KEY),
+    strategy=settings.LLM_ROUTING_STRATEGY,
+    cooldown_seconds=settings.LLM_ENDPOINT_COOLDOWN_SECONDS,
+    ttft_stale_seconds=settings.LLM_TTFT_STALE_SECONDS,
+)
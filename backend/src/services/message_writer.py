@@ -0,0 +1,199 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import insert
+
+from src.common.config import settings
+from src.crud.crud_message import async_create_message
+from src.db.session import async_session_scope
+from src.models.message import Message
+
+logger = logging.getLogger(__name__)
+
+VALID_ROLES = ("user", "assistant", "system")
+
+# 写入模式
+MODE_DIRECT = "direct"  # 每条消息独立事务（原有行为）
+MODE_ACK = "ack"  # 批量写入，调用方等待所在批次提交后返回
+MODE_ASYNC = "async"  # 批量写入，入队即返回；进程崩溃会丢失尚未提交的消息
+WRITE_MODES = (MODE_DIRECT, MODE_ACK, MODE_ASYNC)
+
+
+@dataclass
+class _PendingMessage:
+    row: Dict[str, Any]
+    future: Optional[asyncio.Future]
+
+
+class MessageWriter:
+    """
+    消息写入的 write-behind 队列。
+
+    多个会话并发产生的消息先进入进程内队列，由后台任务按数量（batch_size）或
+    时间窗口（flush_interval_ms）聚合成一条多行 INSERT，在一个事务中提交，
+    把每轮对话多次 select/commit/refresh 的往返压缩为每批一次提交。
+    批量失败时逐条重试，定位出错的那一条，其余消息照常落库。
+    """
+
+    def __init__(
+            self,
+            session_scope: Callable = async_session_scope,
+            mode: str = MODE_ACK,
+            batch_size: int = 200,
+            flush_interval_ms: float = 20.0,
+            max_queue_size: int = 10000,
+    ):
+        if mode not in WRITE_MODES:
+            raise ValueError(f"Invalid message write mode '{mode}'. Must be one of: {list(WRITE_MODES)}")
+        self.session_scope = session_scope
+        self.mode = mode
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.0, flush_interval_ms) / 1000.0
+        self.max_queue_size = max_queue_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._closing = False
+        # 统计
+        self.enqueued = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.fallback_batches = 0
+        self.last_flush_ms = 0.0
+
+    # ---------------- 对外接口 ----------------
+    async def write(self, conv_id: int, role: str, content: str) -> None:
+        """写入一条消息；direct/ack 模式下返回即已提交，失败时抛出异常"""
+        if role not in VALID_ROLES:
+            raise ValueError(f"Invalid role '{role}'. Must be one of: {list(VALID_ROLES)}")
+
+        if self.mode == MODE_DIRECT or self._closing:
+            # 关闭过程中不再入队，直接同步写入，保证不丢消息
+            async with self.session_scope() as db:
+                await async_create_message(db, conv_id, role, content)
+            return
+
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future() if self.mode == MODE_ACK else None
+        row = {"conversation_id": conv_id, "role": role, "content": content}
+        await self._queue.put(_PendingMessage(row, future))
+        self.enqueued += 1
+        if future is not None:
+            await future
+
+    async def drain(self, timeout: float = 10.0) -> None:
+        """关闭时调用：停止接收新消息并把队列中的消息全部落库"""
+        self._closing = True
+        if self._worker is None or self._queue is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"消息写入队列未能在 {timeout}s 内清空，剩余 {self._queue.qsize()} 条")
+        self._worker.cancel()
+        try:
+            await self._worker
+        except (asyncio.CancelledError, Exception):
+            pass
+        self._worker = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "mode": self.mode,
+            "batch_size": self.batch_size,
+            "flush_interval_ms": self.flush_interval * 1000.0,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "failed": self.failed,
+            "batches": self.batches,
+            "fallback_batches": self.fallback_batches,
+            "avg_batch_size": round(self.written / self.batches, 2) if self.batches else None,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+        }
+
+    # ---------------- 后台任务 ----------------
+    def _ensure_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._worker is not None and not self._worker.done() and self._loop is loop:
+            return
+        # 首次使用，或事件循环已更换（例如测试中），重新创建队列与后台任务
+        self._loop = loop
+        self._closing = False
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._worker = loop.create_task(self._run(self._queue))
+
+    async def _run(self, queue: asyncio.Queue) -> None:
+        while True:
+            batch = [await queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                # _flush 内部已处理异常，这里兜底避免后台任务退出
+                logger.exception(f"消息批量写入异常: {e}")
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _flush(self, batch: List[_PendingMessage]) -> None:
+        start = time.perf_counter()
+        try:
+            async with self.session_scope() as db:
+                # 单条多行 INSERT，一个事务提交
+                await db.execute(insert(Message).values([p.row for p in batch]))
+                await db.commit()
+            self.batches += 1
+            self.written += len(batch)
+            for p in batch:
+                if p.future is not None and not p.future.done():
+                    p.future.set_result(None)
+        except Exception as e:
+            logger.warning(f"批量写入 {len(batch)} 条消息失败，改为逐条写入: {e}")
+            self.fallback_batches += 1
+            await self._flush_one_by_one(batch)
+        finally:
+            self.last_flush_ms = (time.perf_counter() - start) * 1000.0
+
+    async def _flush_one_by_one(self, batch: List[_PendingMessage]) -> None:
+        for p in batch:
+            try:
+                async with self.session_scope() as db:
+                    await db.execute(insert(Message).values(p.row))
+                    await db.commit()
+                self.written += 1
+                if p.future is not None and not p.future.done():
+                    p.future.set_result(None)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Error creating message for conversation {p.row.get('conversation_id')}: {str(e)}")
+                if p.future is not None and not p.future.done():
+                    p.future.set_exception(e)
+
+
+message_writer = MessageWriter(
+    mode=settings.MESSAGE_WRITE_MODE,
+    batch_size=settings.MESSAGE_WRITE_BATCH_SIZE,
+    flush_interval_ms=settings.MESSAGE_WRITE_FLUSH_MS,
+    max_queue_size=settings.MESSAGE_WRITE_QUEUE_SIZE,
+)
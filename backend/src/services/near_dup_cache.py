@@ -0,0 +1,261 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.common.config import settings
+
+try:
+    import numpy as np
+except ImportError:  # numpy 缺失时近似缓存不可用，精确缓存不受影响
+    np = None
+
+logger = logging.getLogger(__name__)
+
+_MERSENNE_61 = (1 << 61) - 1
+_MAX_HASH = 0xFFFFFFFF
+_SHINGLE_BASE = 1000003
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def normalize_prompt(text: str) -> str:
+    """小写、去标点、折叠空白。只用于计算相似度，不影响发送给模型的内容"""
+    text = _PUNCTUATION.sub(" ", (text or "").lower())
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def _numbers_key(text: str, scope: str = "") -> int:
+    """
+    提示词中出现的数字序列（加上 scope）；数字不同的两个提示词（例如 2+2 与 2+3）永远不视为重复，
+    不同 scope（例如不同模型）的条目互不命中。
+    """
+    return hash((scope, tuple(_NUMBER.findall(text))))
+
+
+class MinHasher:
+    """
+    基于字符 k-gram 的 MinHash 签名，shingle 哈希与签名计算均由 NumPy 向量化完成。
+
+    哈希族为 (a * x + b) mod (2^61 - 1)，x 与 a、b 均小于 2^32，uint64 内不会溢出。
+    字符级 shingle 对中英文都适用，不依赖分词。
+    """
+
+    def __init__(self, num_perm: int = 64, shingle_size: int = 4, seed: int = 1):
+        if np is None:
+            raise RuntimeError("numpy is required for MinHash signatures")
+        self.num_perm = num_perm
+        self.shingle_size = max(1, shingle_size)
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _MAX_HASH, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _MAX_HASH, size=num_perm, dtype=np.uint64)
+        self._powers = np.array(
+            [pow(_SHINGLE_BASE, self.shingle_size - 1 - i, 1 << 32) for i in range(self.shingle_size)],
+            dtype=np.uint64,
+        )
+
+    def shingle_hashes(self, text: str) -> "np.ndarray":
+        """每个字符 k-gram 的 32 位多项式哈希（去重后）"""
+        codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        k = self.shingle_size
+        if len(codes) < k:
+            codes = np.concatenate([codes, np.zeros(k - len(codes), dtype=np.uint64)])
+        windows = np.lib.stride_tricks.sliding_window_view(codes, k)
+        return np.unique((windows * self._powers).sum(axis=1) & _MAX_HASH)
+
+    def signature(self, text: str) -> "np.ndarray":
+        hashes = self.shingle_hashes(text)
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_61
+        return (permuted & _MAX_HASH).min(axis=1).astype(np.uint32)
+
+
+class NearDuplicateCache:
+    """
+    近似重复提示词缓存：MinHash 签名 + LSH 分桶索引。
+
+    - 签名切成 bands 段，每段哈希为一个桶键；任一段完全相同的条目成为候选，
+      再用签名逐位比较（向量化）估算 Jaccard 相似度，超过 threshold 才算命中；
+    - 条目存放在预分配的槽位中（签名矩阵、过期时间、桶链表均为 NumPy 数组），
+      内存占用由 max_entries 决定，满了按 LRU 淘汰，条目带 TTL；
+    - 提示词中的数字必须完全一致，避免把 “2+2” 的答案返回给 “2+3”。
+    - 条目带 scope（调用方传入生成回答的模型等），不同 scope 的条目互不命中。
+    """
+
+    def __init__(
+            self,
+            enabled: bool = True,
+            threshold: float = 0.9,
+            max_entries: int = 10000,
+            ttl_seconds: float = 3600.0,
+            num_perm: int = 64,
+            bands: int = 8,
+            shingle_size: int = 4,
+    ):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be divisible by bands ({bands})")
+        self.enabled = enabled and np is not None
+        self.threshold = threshold
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl_seconds
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        # 统计
+        self.hits = 0
+        self.misses = 0
+        self.inserts = 0
+        self.evictions = 0
+        self.candidates_checked = 0
+        if not self.enabled:
+            if enabled:
+                logger.warning("numpy 未安装，近似重复提示词缓存已禁用")
+            return
+
+        self.hasher = MinHasher(num_perm=num_perm, shingle_size=shingle_size)
+        rng = np.random.default_rng(2)
+        self._band_mult = rng.integers(1, 1 << 63, size=(self.rows,), dtype=np.uint64) | np.uint64(1)
+        capacity = self.max_entries
+        self._sigs = np.zeros((capacity, num_perm), dtype=np.uint32)
+        self._expires = np.zeros(capacity, dtype=np.float64)
+        self._numbers = np.zeros(capacity, dtype=np.int64)
+        self._band_keys = np.zeros((capacity, bands), dtype=np.uint64)
+        self._next = np.full((capacity, bands), -1, dtype=np.int64)  # 桶内单链表
+        self._heads: List[Dict[int, int]] = [{} for _ in range(bands)]  # band -> {桶键: 链表头槽位}
+        self._values: List[Optional[str]] = [None] * capacity
+        self._lru: "OrderedDict[int, None]" = OrderedDict()
+        self._free = list(range(capacity - 1, -1, -1))
+
+    def __len__(self) -> int:
+        return len(self._lru) if self.enabled else 0
+
+    # ---------------- 对外接口 ----------------
+    def lookup(self, prompt: str, scope: str = "") -> Optional[Tuple[str, float]]:
+        """返回 (缓存的回答, 估算相似度)；未命中返回 None。只匹配同一 scope 下加入的条目"""
+        if not self.enabled:
+            return None
+        normalized = normalize_prompt(prompt)
+        sig = self.hasher.signature(normalized)
+        result = self._query(sig, _numbers_key(normalized, scope))
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def add(self, prompt: str, answer: str, scope: str = "") -> None:
+        if not self.enabled or not answer:
+            return
+        normalized = normalize_prompt(prompt)
+        self.add_signature(self.hasher.signature(normalized), _numbers_key(normalized, scope), answer)
+
+    def add_signature(self, sig: "np.ndarray", numbers_key: int, answer: str) -> None:
+        """按已计算好的签名插入（基准测试也用它批量构建索引）"""
+        if not self._free:
+            self._remove(next(iter(self._lru)))
+            self.evictions += 1
+        slot = self._free.pop()
+        keys = self._band_hashes(sig)
+        self._sigs[slot] = sig
+        self._expires[slot] = time.time() + self.ttl
+        self._numbers[slot] = numbers_key
+        self._band_keys[slot] = keys
+        self._values[slot] = answer
+        for band, key in enumerate(keys.tolist()):
+            head = self._heads[band]
+            self._next[slot, band] = head.get(key, -1)
+            head[key] = slot
+        self._lru[slot] = None
+        self.inserts += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        index_bytes = 0
+        if self.enabled:
+            index_bytes = sum(a.nbytes for a in (self._sigs, self._expires, self._numbers, self._band_keys, self._next))
+        return {
+            "enabled": self.enabled,
+            "entries": len(self),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "num_perm": self.num_perm,
+            "bands": self.bands,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "inserts": self.inserts,
+            "evictions": self.evictions,
+            "candidates_checked": self.candidates_checked,
+            "index_bytes": index_bytes,
+        }
+
+    # ---------------- 内部实现 ----------------
+    def _band_hashes(self, sig: "np.ndarray") -> "np.ndarray":
+        return (sig.reshape(self.bands, self.rows).astype(np.uint64) * self._band_mult).sum(axis=1)
+
+    def _query(self, sig: "np.ndarray", numbers_key: int) -> Optional[Tuple[str, float]]:
+        candidates = set()
+        for band, key in enumerate(self._band_hashes(sig).tolist()):
+            slot = self._heads[band].get(key, -1)
+            while slot != -1:
+                candidates.add(slot)
+                slot = int(self._next[slot, band])
+        if not candidates:
+            return None
+
+        slots = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        self.candidates_checked += len(slots)
+        now = time.time()
+        expired = slots[self._expires[slots] <= now]
+        for slot in expired.tolist():
+            self._remove(slot)
+        valid = slots[(self._expires[slots] > now) & (self._numbers[slots] == numbers_key)]
+        if not len(valid):
+            return None
+        similarity = (self._sigs[valid] == sig).sum(axis=1) / self.num_perm
+        best = int(similarity.argmax())
+        if similarity[best] < self.threshold:
+            return None
+        slot = int(valid[best])
+        self._lru.move_to_end(slot)
+        return self._values[slot], float(similarity[best])
+
+    def _remove(self, slot: int) -> None:
+        if slot not in self._lru:
+            return
+        del self._lru[slot]
+        for band, key in enumerate(self._band_keys[slot].tolist()):
+            head = self._heads[band]
+            nxt = int(self._next[slot, band])
+            current = head.get(key, -1)
+            if current == slot:
+                if nxt == -1:
+                    del head[key]
+                else:
+                    head[key] = nxt
+            else:
+                while current != -1:
+                    following = int(self._next[current, band])
+                    if following == slot:
+                        self._next[current, band] = nxt
+                        break
+                    current = following
+            self._next[slot, band] = -1
+        self._values[slot] = None
+        self._expires[slot] = 0.0
+        self._free.append(slot)
+
+
+near_dup_cache = NearDuplicateCache(
+    enabled=settings.NEAR_DUP_CACHE_ENABLED,
+    threshold=settings.NEAR_DUP_THRESHOLD,
+    max_entries=settings.NEAR_DUP_MAX_ENTRIES,
+    ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+    num_perm=settings.NEAR_DUP_NUM_PERM,
+    bands=settings.NEAR_DUP_BANDS,
+)
@@ -0,0 +1,237 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from src.common.config import settings
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_messages(messages: List[Dict[str, str]]) -> List[Tuple[str, str]]:
+    """归一化消息列表：只保留 role/content，去掉首尾空白并折叠连续空白"""
+    normalized = []
+    for msg in messages:
+        content = _WHITESPACE.sub(" ", (msg.get("content", "") or "")).strip()
+        normalized.append((msg.get("role", ""), content))
+    return normalized
+
+
+def cache_key(messages: List[Dict[str, str]], model: str, system_prompt: str) -> str:
+    payload = json.dumps(
+        {"model": model, "system": system_prompt, "messages": normalize_messages(messages)},
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def replay_chunks(text: str, chunk_size: int = 32) -> Iterator[str]:
+    """把缓存的完整回答切成 delta 回放，客户端看到的 SSE 格式与实时生成一致"""
+    for i in range(0, len(text), chunk_size):
+        yield text[i:i + chunk_size]
+
+
+class ResponseCache:
+    """
+    LLM 回答的精确匹配缓存。
+
+    - key 为归一化消息列表 + 模型名 + 系统提示词的 sha256；
+    - 内存层按 LRU 淘汰，同时受条目数与总字节数限制，条目带 TTL；
+    - 可选本地磁盘层（disk_dir），内存未命中时读取，命中后回填内存；
+    - 策略：默认只缓存没有历史的单轮请求（allow_history）；chat 的 agent 不带工具，回答只取决于消息本身。
+    只在生成完整结束后写入，出错或被中断的回答不会进入缓存。
+    """
+
+    def __init__(
+            self,
+            enabled: bool = True,
+            ttl_seconds: float = 3600.0,
+            max_entries: int = 1000,
+            max_bytes: int = 16 * 1024 * 1024,
+            disk_dir: Optional[str] = None,
+            disk_max_entries: int = 10000,
+            allow_history: bool = False,
+    ):
+        self.enabled = enabled
+        self.ttl = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self.max_bytes = max(1, max_bytes)
+        self.disk_dir = disk_dir or None
+        self.disk_max_entries = disk_max_entries
+        self.allow_history = allow_history
+        self._entries: "OrderedDict[str, Tuple[float, str, int]]" = OrderedDict()  # key -> (expires_at, text, size)
+        self._bytes = 0
+        self._disk_writes = 0
+        # 统计
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bypassed = 0
+        self.bytes_served = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    # ---------------- 策略 ----------------
+    def is_cacheable(self, messages: List[Dict[str, str]]) -> bool:
+        if not self.enabled:
+            return False
+        # 除本轮 user 消息外还有其他消息（历史或摘要）即视为带历史
+        if len(messages) > 1 and not self.allow_history:
+            self.bypassed += 1
+            return False
+        return True
+
+    # ---------------- 读写 ----------------
+    async def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.bytes_served += entry[2]
+                return entry[1]
+            self._remove(key)
+
+        if self.disk_dir:
+            loaded = await asyncio.to_thread(self._disk_read, key, now)
+            if loaded is not None:
+                expires_at, text = loaded
+                self._put(key, text, expires_at)
+                self.hits += 1
+                self.disk_hits += 1
+                self.bytes_served += len(text.encode("utf-8"))
+                return text
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, text: str) -> None:
+        if not self.enabled or not text:
+            return
+        expires_at = time.time() + self.ttl
+        self._put(key, text, expires_at)
+        self.stores += 1
+        if self.disk_dir:
+            try:
+                await asyncio.to_thread(self._disk_write, key, text, expires_at)
+            except Exception as e:
+                logger.warning(f"写入响应缓存磁盘层失败（非致命）: {e}")
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl,
+            "disk_enabled": bool(self.disk_dir),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "bypassed": self.bypassed,
+            "bytes_served": self.bytes_served,
+        }
+
+    # ---------------- 内存层 ----------------
+    def _put(self, key: str, text: str, expires_at: float) -> None:
+        size = len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, text, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    # ---------------- 磁盘层（在线程中执行） ----------------
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_read(self, key: str, now: float) -> Optional[Tuple[float, str]]:
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("expires_at", 0) <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return data["expires_at"], data["text"]
+
+    def _disk_write(self, key: str, text: str, expires_at: float) -> None:
+        path = self._disk_path(key)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"expires_at": expires_at, "text": text}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self._disk_writes += 1
+        if self._disk_writes % 100 == 0:
+            self._disk_prune()
+
+    def _disk_prune(self) -> None:
+        """删除过期文件；超过 disk_max_entries 时按修改时间删除最旧的文件"""
+        now = time.time()
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.disk_dir, name)
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        files.sort()
+        excess = len(files) - self.disk_max_entries
+        for mtime, path in files:
+            if excess <= 0 and mtime + self.ttl > now:
+                continue
+            try:
+                os.remove(path)
+                excess -= 1
+            except OSError:
+                pass
+
+
+response_cache = ResponseCache(
+    enabled=settings.RESPONSE_CACHE_ENABLED,
+    ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+    max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=settings.RESPONSE_CACHE_MAX_BYTES,
+    disk_dir=settings.RESPONSE_CACHE_DISK_DIR,
+    allow_history=settings.RESPONSE_CACHE_ALLOW_HISTORY,
+)
@@ -0,0 +1,146 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import logging
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Hashable, Optional, Sequence
+
+from src.common.metrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_AGENT = "agent"
+PRIORITY_BATCH = "batch"
+PRIORITY_CLASSES = (PRIORITY_INTERACTIVE, PRIORITY_AGENT, PRIORITY_BATCH)
+
+
+def parse_class_weights(raw: str, classes: Sequence[str] = PRIORITY_CLASSES) -> Dict[str, float]:
+    """
+    解析 "interactive:8,agent:3,batch:1" 形式的权重配置；未配置的类别权重为 1。
+    权重越大，拥塞时分到的上游名额比例越高。
+    """
+    weights = {c: 1.0 for c in classes}
+    for item in (raw or "").split(","):
+        name, sep, value = item.partition(":")
+        name = name.strip()
+        if not sep or not name:
+            continue
+        if name not in weights:
+            raise ValueError(f"Unknown priority class '{name}'. Must be one of: {list(classes)}")
+        weights[name] = max(float(value), 1e-6)
+    return weights
+
+
+class _ClassQueue:
+    """一个优先级类别：按用户分队列，用户之间 deficit round-robin（每个请求成本为 1）"""
+
+    def __init__(self, name: str, weight: float, quantum: int):
+        self.name = name
+        self.weight = weight
+        self.quantum = max(1, quantum)
+        self.users: "OrderedDict[Hashable, Deque[Any]]" = OrderedDict()  # 活跃用户的轮转顺序
+        self.deficit: Dict[Hashable, int] = {}
+        self.size = 0
+        self.passes = 0.0  # WFQ 虚拟时间：每调度一个请求前进 1 / weight
+        self.queue_delay = LatencyHistogram()
+        self.dispatched = 0
+
+    def push(self, user: Hashable, item: Any) -> None:
+        queue = self.users.get(user)
+        if queue is None:
+            queue = self.users[user] = deque()
+            self.deficit[user] = 0
+        queue.append(item)
+        self.size += 1
+
+    def pop(self) -> Any:
+        """队首用户用完 quantum 个额度后移到轮转末尾"""
+        user, queue = next(iter(self.users.items()))
+        if self.deficit[user] <= 0:
+            self.deficit[user] += self.quantum
+        item = queue.popleft()
+        self.size -= 1
+        self.deficit[user] -= 1
+        if not queue:
+            del self.users[user]
+            del self.deficit[user]
+        elif self.deficit[user] <= 0:
+            self.users.move_to_end(user)
+        return item
+
+    def remove(self, user: Hashable, item: Any) -> bool:
+        queue = self.users.get(user)
+        if queue is None:
+            return False
+        try:
+            queue.remove(item)
+        except ValueError:
+            return False
+        self.size -= 1
+        if not queue:
+            del self.users[user]
+            del self.deficit[user]
+        return True
+
+
+class FairScheduler:
+    """
+    上游名额的排队调度：类别之间加权公平排队（WFQ，按虚拟时间选择，权重可配置），
+    同一类别内按用户 deficit round-robin，重度用户不会饿死轻度用户。
+
+    - 类别默认权重 interactive > agent > batch，拥塞时交互式对话优先拿到名额，
+      但低优先级类别仍按权重比例前进，不会被完全饿死；
+    - 空闲后重新排队的类别虚拟时间追平到当前值，不能攒下额度一次性抢占；
+    - 记录每个类别的排队等待时间分布。
+    """
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None, quantum: int = 1):
+        weights = weights or {c: 1.0 for c in PRIORITY_CLASSES}
+        self.classes: Dict[str, _ClassQueue] = {name: _ClassQueue(name, w, quantum) for name, w in weights.items()}
+        self.order = list(self.classes)  # 虚拟时间相同时按声明顺序（优先级）
+        self.virtual_time = 0.0
+
+    def __len__(self) -> int:
+        return sum(c.size for c in self.classes.values())
+
+    def _class(self, name: str) -> _ClassQueue:
+        klass = self.classes.get(name)
+        if klass is None:
+            raise ValueError(f"Unknown priority class '{name}'. Must be one of: {self.order}")
+        return klass
+
+    def push(self, item: Any, user: Hashable, priority: str) -> None:
+        klass = self._class(priority)
+        if klass.size == 0:
+            klass.passes = max(klass.passes, self.virtual_time)
+        klass.push(user, item)
+
+    def pop(self) -> Optional[Any]:
+        """按调度顺序取出下一个等待者；队列为空返回 None"""
+        candidates = [c for c in (self.classes[n] for n in self.order) if c.size]
+        if not candidates:
+            return None
+        klass = min(candidates, key=lambda c: c.passes + 1.0 / c.weight)
+        klass.passes += 1.0 / klass.weight
+        self.virtual_time = max(self.virtual_time, klass.passes - 1.0 / klass.weight)
+        klass.dispatched += 1
+        return klass.pop()
+
+    def remove(self, item: Any, user: Hashable, priority: str) -> bool:
+        return self._class(priority).remove(user, item)
+
+    def observe_wait(self, priority: str, wait_ms: float) -> None:
+        self._class(priority).queue_delay.observe(wait_ms)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            name: {
+                "weight": c.weight,
+                "waiting": c.size,
+                "waiting_users": len(c.users),
+                "dispatched": c.dispatched,
+                "queue_delay": c.queue_delay.snapshot(),
+            }
+            for name, c in self.classes.items()
+        }
@@ -0,0 +1,521 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+from src.common.config import settings
+from src.common.metrics import LatencyHistogram
+from src.services.context_service import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+_TERMS = re.compile(r"[\u4e00-\u9fff\u3040-\u30ff]|[^\W_]+")  # CJK 按单字，其余按单词
+_SENTENCE_END = re.compile(r"[.!?。！？](?=\s|$)|[。！？]")
+
+SearchResults = List[Dict[str, str]]
+SearchBackend = Callable[[str, int], Awaitable[SearchResults]]
+T = TypeVar("T")
+
+
+def normalize_query(query: str) -> str:
+    """小写并折叠空白，作为缓存键的一部分"""
+    return _WHITESPACE.sub(" ", (query or "").lower()).strip()
+
+
+class SearchCache:
+    """
+    网络搜索结果缓存：按 (归一化查询, max_results) 缓存，LRU + TTL。
+
+    相同 key 的并发请求合并为一次抓取（single-flight）：抓取在单独的任务中运行，所有调用方
+    （包括发起抓取的那个）都通过 shield 等待它，任何一个调用方被取消（例如客户端断开取消了 agent 运行）
+    都不会取消抓取，也不会把取消传给其他等待者。抓取失败时所有等待者收到同一个异常，失败结果不进入缓存。
+    """
+
+    def __init__(self, ttl_seconds: float = 300.0, max_entries: int = 1000):
+        self.ttl = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[float, SearchResults]]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, int], asyncio.Task] = {}
+        # 统计
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.evictions = 0
+
+    async def get_or_fetch(
+            self,
+            query: str,
+            max_results: int,
+            fetch: Callable[[], Awaitable[SearchResults]],
+    ) -> SearchResults:
+        key = (normalize_query(query), max_results)
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._entries[key]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            inflight = self._inflight[key] = asyncio.ensure_future(self._fetch(key, fetch))
+            # 所有等待者都已取消时避免 “exception was never retrieved” 警告
+            inflight.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return await asyncio.shield(inflight)
+
+    async def _fetch(self, key: Tuple[str, int], fetch: Callable[[], Awaitable[SearchResults]]) -> SearchResults:
+        try:
+            results = await fetch()
+        except Exception:
+            self.errors += 1
+            raise
+        else:
+            self._put(key, results)
+            return results
+        finally:
+            self._inflight.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "in_flight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 4) if lookups else None,
+        }
+
+    def _put(self, key: Tuple[str, int], results: SearchResults) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+class SearchExecutor:
+    """
+    在专用的有界线程池中执行同步的搜索客户端调用，不阻塞事件循环。
+
+    - 每个线程复用自己的客户端实例（按 client_factory 区分），保留其连接池与 keep-alive，
+      不再每次调用新建客户端和连接；
+    - 信号量限制本进程同时进行的搜索数；槽位在线程真正结束时才释放，
+      超时的调用不会让排队的搜索越过上限；
+    - 每次调用有截止时间（包括等待槽位的时间），超时抛出 TimeoutError。
+    """
+
+    def __init__(self, max_concurrent: int = 4, timeout: float = 8.0):
+        self.max_concurrent = max(1, max_concurrent)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="web-search")
+        self._local = threading.local()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.latency = LatencyHistogram()
+        # 统计
+        self.calls = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.in_flight = 0
+        self.clients_created = 0
+
+    async def run(self, client_factory: Callable[[], Any], call: Callable[[Any], T], timeout: Optional[float] = None) -> T:
+        """在线程池中执行 call(client)，client 为当前线程复用的 client_factory() 实例"""
+        timeout = self.timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # 首次使用或事件循环已更换（例如测试中），重建信号量
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        semaphore = self._semaphore
+        self.calls += 1
+        start = time.perf_counter()
+        deadline = loop.time() + timeout
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise TimeoutError(f"search timed out after {timeout}s waiting for a free slot")
+
+        self.in_flight += 1
+        future = self._executor.submit(self._call, client_factory, call)
+
+        def _release(_f):
+            try:
+                loop.call_soon_threadsafe(self._on_done, semaphore)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+
+        future.add_done_callback(_release)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise TimeoutError(f"search timed out after {timeout}s")
+        except Exception:
+            self.failed += 1
+            raise
+        self.completed += 1
+        self.latency.observe((time.perf_counter() - start) * 1000.0)
+        return result
+
+    def _on_done(self, semaphore: asyncio.Semaphore) -> None:
+        self.in_flight -= 1
+        semaphore.release()
+
+    def _call(self, client_factory: Callable[[], Any], call: Callable[[Any], T]) -> T:
+        clients = getattr(self._local, "clients", None)
+        if clients is None:
+            clients = self._local.clients = {}
+        client = clients.get(client_factory)
+        if client is None:
+            client = clients[client_factory] = client_factory()
+            self.clients_created += 1
+        return call(client)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "timeout_seconds": self.timeout,
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "clients_created": self.clients_created,
+            "latency": self.latency.snapshot(),
+        }
+
+
+class SearchOrchestrator:
+    """
+    对冲式多后端搜索：同一查询按顺序发往多个后端，取第一个可接受的结果。
+
+    - 先请求第一个后端；hedge_delay_ms 内未返回可接受结果（或已失败）时再请求下一个，最多 fanout 个，
+      hedge_delay_ms 为 0 时同时请求；
+    - 结果数不少于 min_results 即为可接受；拿到后可再等待 merge_window_ms，
+      把窗口内到达的其他结果按 URL 去重后合并到胜出结果之后；
+    - 其余仍在进行的请求被取消（线程中的阻塞调用会自然结束，只是结果被丢弃）；
+    - 每个后端记录延迟直方图、胜出次数、失败与取消次数，用于调整对冲参数。
+    """
+
+    def __init__(self, hedge_delay_ms: float = 300.0, fanout: int = 2, merge_window_ms: float = 0.0, min_results: int = 1):
+        self.hedge_delay = max(0.0, hedge_delay_ms) / 1000.0
+        self.fanout = max(1, fanout)
+        self.merge_window = max(0.0, merge_window_ms) / 1000.0
+        self.min_results = max(0, min_results)
+        self._backend_stats: Dict[str, Dict[str, Any]] = {}
+        self.searches = 0
+        self.hedged = 0
+
+    async def search(self, query: str, max_results: int, backends: List[Tuple[str, SearchBackend]]) -> SearchResults:
+        if not backends:
+            raise ValueError("no search backends configured")
+        self.searches += 1
+        candidates = backends[:self.fanout]
+        tasks: Dict[asyncio.Task, str] = {}
+        winner: Optional[SearchResults] = None
+        fallback: Optional[SearchResults] = None
+        last_error: Optional[BaseException] = None
+        next_index = 0
+
+        def launch() -> None:
+            nonlocal next_index
+            name, backend = candidates[next_index]
+            next_index += 1
+            tasks[asyncio.ensure_future(self._timed(name, backend, query, max_results))] = name
+
+        launch()
+        try:
+            while tasks and winner is None:
+                can_hedge = next_index < len(candidates)
+                if can_hedge and not self.hedge_delay:
+                    # 对冲延迟为 0：所有后端同时发出
+                    self.hedged += 1
+                    launch()
+                    continue
+                done, _ = await asyncio.wait(
+                    tasks, timeout=self.hedge_delay if can_hedge else None, return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    # 对冲：当前请求超过延迟仍未返回，追加下一个后端
+                    self.hedged += 1
+                    launch()
+                    continue
+                for task in done:
+                    name = tasks.pop(task)
+                    try:
+                        results = task.result()
+                    except Exception as e:
+                        last_error = e
+                        continue
+                    if winner is None and len(results) >= self.min_results:
+                        winner = results
+                        self._stat(name)["wins"] += 1
+                    elif fallback is None:
+                        fallback = results
+                if winner is None and not tasks and next_index < len(candidates):
+                    # 已发出的请求都失败或结果不足，不必再等对冲延迟
+                    launch()
+
+            if winner is not None and tasks and self.merge_window:
+                done, _ = await asyncio.wait(tasks, timeout=self.merge_window)
+                for task in done:
+                    tasks.pop(task)
+                    if not task.exception():
+                        winner = self._merge(winner, task.result(), max_results)
+        finally:
+            for task, name in tasks.items():
+                task.cancel()
+                self._stat(name)["cancelled"] += 1
+
+        if winner is not None:
+            return winner
+        if fallback is not None:
+            return fallback
+        raise last_error
+
+    async def _timed(self, name: str, backend: SearchBackend, query: str, max_results: int) -> SearchResults:
+        stat = self._stat(name)
+        stat["requests"] += 1
+        start = time.perf_counter()
+        try:
+            results = await backend(query, max_results)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            stat["errors"] += 1
+            logger.warning(f"搜索后端 {name} 失败: {e}")
+            raise
+        stat["latency"].observe((time.perf_counter() - start) * 1000.0)
+        return results
+
+    @staticmethod
+    def _merge(primary: SearchResults, extra: SearchResults, max_results: int) -> SearchResults:
+        seen = {r.get("url") for r in primary}
+        merged = list(primary)
+        for r in extra:
+            if len(merged) >= max_results:
+                break
+            if r.get("url") not in seen:
+                seen.add(r.get("url"))
+                merged.append(r)
+        return merged
+
+    def _stat(self, name: str) -> Dict[str, Any]:
+        stat = self._backend_stats.get(name)
+        if stat is None:
+            stat = self._backend_stats[name] = {
+                "requests": 0, "wins": 0, "errors": 0, "cancelled": 0, "latency": LatencyHistogram(),
+            }
+        return stat
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hedge_delay_ms": self.hedge_delay * 1000.0,
+            "fanout": self.fanout,
+            "merge_window_ms": self.merge_window * 1000.0,
+            "searches": self.searches,
+            "hedged": self.hedged,
+            "backends": {
+                name: {**{k: v for k, v in stat.items() if k != "latency"}, "latency": stat["latency"].snapshot()}
+                for name, stat in self._backend_stats.items()
+            },
+        }
+
+
+def format_results(results: SearchResults) -> str:
+    """工具返回给模型的文本格式"""
+    return "\n\n".join(f"标题: {r['title']}\n链接: {r['url']}\n摘要: {r['snippet']}" for r in results)
+
+
+def _terms(text: str) -> set:
+    return set(_TERMS.findall((text or "").lower()))
+
+
+def _url_key(url: str) -> str:
+    url = (url or "").strip().lower().split("#", 1)[0]
+    url = re.sub(r"^https?://(www\.)?", "", url)
+    return url.rstrip("/")
+
+
+def truncate_at_sentence(text: str, limit: int) -> str:
+    """截断到 limit 个字符以内的最后一个句子边界；找不到时在词边界截断并加省略号"""
+    text = _WHITESPACE.sub(" ", text or "").strip()
+    if len(text) <= limit:
+        return text
+    if limit <= 1:
+        return "…" if limit == 1 else ""
+    head = text[:limit]
+    ends = [m.end() for m in _SENTENCE_END.finditer(head)]
+    if ends and ends[-1] >= limit // 3:
+        return head[:ends[-1]]
+    cut = head[:limit - 1]
+    space = cut.rfind(" ")
+    if space >= limit // 2:
+        cut = cut[:space]
+    return cut.rstrip() + "…"
+
+
+class ResultShaper:
+    """
+    搜索结果整形：在结果进入模型上下文之前压缩体积。
+
+    - max_results 设上限，模型传入更大的值也不会多取；
+    - 按 URL（忽略协议、www、末尾斜杠、锚点）和近似重复摘要（词集合 Jaccard）去重；
+    - 摘要在句子边界截断到 snippet_chars；
+    - 按与查询词的重合度排序，重合度相同保持后端原有顺序；
+    - 整体受 max_chars / max_tokens 预算限制，放不下的结果截短或丢弃。
+    """
+
+    def __init__(
+            self,
+            max_results: int = 8,
+            snippet_chars: int = 300,
+            max_chars: int = 3000,
+            max_tokens: int = 0,
+            duplicate_similarity: float = 0.8,
+    ):
+        self.max_results = max(1, max_results)
+        self.snippet_chars = max(20, snippet_chars)
+        self.max_chars = max_chars
+        self.max_tokens = max_tokens
+        self.duplicate_similarity = duplicate_similarity
+        # 统计
+        self.calls = 0
+        self.results_in = 0
+        self.results_out = 0
+        self.chars_in = 0
+        self.chars_out = 0
+
+    def cap(self, max_results: int) -> int:
+        return max(1, min(max_results or self.max_results, self.max_results))
+
+    def shape(self, query: str, results: SearchResults, max_results: int) -> str:
+        self.calls += 1
+        self.results_in += len(results)
+        self.chars_in += len(format_results(results))
+        limit = self.cap(max_results)
+
+        unique: List[Tuple[Dict[str, str], set]] = []
+        seen_urls = set()
+        for r in results:
+            key = _url_key(r.get("url", ""))
+            if key and key in seen_urls:
+                continue
+            terms = _terms(r.get("snippet", ""))
+            if terms and any(self._similar(terms, other) for _, other in unique):
+                continue
+            seen_urls.add(key)
+            unique.append((r, terms))
+
+        query_terms = _terms(query)
+        scored = []
+        for index, (r, snippet_terms) in enumerate(unique):
+            overlap = len(query_terms & (snippet_terms | _terms(r.get("title", "")))) if query_terms else 0
+            scored.append((-overlap, index, r))
+        scored.sort(key=lambda item: (item[0], item[1]))
+
+        blocks: List[str] = []
+        used_chars = 0
+        used_tokens = 0
+        for _, _, r in scored[:limit]:
+            snippet = truncate_at_sentence(r.get("snippet", ""), self.snippet_chars)
+            shaped = {"title": r.get("title", ""), "url": r.get("url", ""), "snippet": snippet}
+            block = format_results([shaped])
+            separator = 2 if blocks else 0
+            if not self._fits(used_chars + separator + len(block), used_tokens + estimate_tokens(block)):
+                # 预算不足：尝试缩短摘要，仍放不下则停止
+                overhead = len(format_results([{**shaped, "snippet": ""}])) + separator
+                room = (self.max_chars - used_chars - overhead) if self.max_chars else len(snippet)
+                if self.max_tokens:
+                    room = min(room, (self.max_tokens - used_tokens - estimate_tokens(block) + estimate_tokens(snippet)) * 2)
+                if room < 40:
+                    break
+                shaped["snippet"] = truncate_at_sentence(snippet, room)
+                block = format_results([shaped])
+                if not self._fits(used_chars + separator + len(block), used_tokens + estimate_tokens(block)):
+                    break
+            blocks.append(block)
+            used_chars += separator + len(block)
+            used_tokens += estimate_tokens(block)
+
+        text = "\n\n".join(blocks)
+        self.results_out += len(blocks)
+        self.chars_out += len(text)
+        return text
+
+    def _similar(self, a: set, b: set) -> bool:
+        if not b:
+            return False
+        return len(a & b) / len(a | b) >= self.duplicate_similarity
+
+    def _fits(self, chars: int, tokens: int) -> bool:
+        if self.max_chars and chars > self.max_chars:
+            return False
+        if self.max_tokens and tokens > self.max_tokens:
+            return False
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_results": self.max_results,
+            "snippet_chars": self.snippet_chars,
+            "max_chars": self.max_chars,
+            "max_tokens": self.max_tokens,
+            "calls": self.calls,
+            "results_in": self.results_in,
+            "results_out": self.results_out,
+            "chars_in": self.chars_in,
+            "chars_out": self.chars_out,
+            "compression_ratio": round(self.chars_out / self.chars_in, 4) if self.chars_in else None,
+        }
+
+
+search_cache = SearchCache(
+    ttl_seconds=settings.SEARCH_CACHE_TTL_SECONDS,
+    max_entries=settings.SEARCH_CACHE_MAX_ENTRIES,
+)
+
+search_executor = SearchExecutor(
+    max_concurrent=settings.SEARCH_MAX_CONCURRENT,
+    timeout=settings.SEARCH_TIMEOUT_SECONDS,
+)
+
+search_orchestrator = SearchOrchestrator(
+    hedge_delay_ms=settings.SEARCH_HEDGE_DELAY_MS,
+    fanout=settings.SEARCH_HEDGE_FANOUT,
+    merge_window_ms=settings.SEARCH_MERGE_WINDOW_MS,
+)
+
+result_shaper = ResultShaper(
+    max_results=settings.SEARCH_MAX_RESULTS,
+    snippet_chars=settings.SEARCH_SNIPPET_MAX_CHARS,
+    max_chars=settings.SEARCH_RESULT_MAX_CHARS,
+    max_tokens=settings.SEARCH_RESULT_MAX_TOKENS,
+)
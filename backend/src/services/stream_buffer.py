@@ -0,0 +1,335 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import asyncio
+import itertools
+import logging
+import secrets
+import time
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from src.common.config import settings
+from src.services.response_cache import cache_key
+
+logger = logging.getLogger(__name__)
+
+
+class ReplayGap(Exception):
+    """请求重放的帧已被环形缓冲区淘汰，无法续传"""
+
+
+class TurnBuffer:
+    """
+    一次生成（一个会话中的一轮回答）的 SSE 帧环形缓冲区。
+
+    生产者（后台生成任务）追加帧，订阅者（SSE 响应）从任意序号之后读取：先重放缓冲区中的帧，
+    再等待新帧。帧序号从 1 开始，事件 id 为 "<key>:<seq>"。
+    """
+
+    def __init__(self, key: str, conversation_id: int, user_id: Any, max_frames: int):
+        self.key = key
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.max_frames = max(1, max_frames)
+        self.frames: Deque[Tuple[int, str]] = deque()
+        self.first_seq = 1
+        self.last_seq = 0
+        self.bytes = 0
+        self.done = False
+        self.subscribers = 0
+        self.expires_at = 0.0
+        self.producer: Optional[asyncio.Task] = None
+        self.context_key: Optional[str] = None  # 合并相同请求时的上下文键
+        self.fanout_subscribers = 0  # 订阅本生成的其他请求数
+        self._changed = asyncio.Event()
+        self._abandon_timer: Optional[asyncio.TimerHandle] = None
+
+    def event_id(self, seq: int) -> str:
+        return f"{self.key}:{seq}"
+
+    def can_replay(self, after: int) -> bool:
+        return after + 1 >= self.first_seq
+
+    def _append(self, data: str) -> int:
+        """追加一帧，返回超出 max_frames 后被淘汰的字节数"""
+        self.last_seq += 1
+        self.frames.append((self.last_seq, data))
+        self.bytes += len(data)
+        freed = 0
+        while len(self.frames) > self.max_frames:
+            freed += self._drop_oldest()
+        self._notify()
+        return freed
+
+    def _drop_oldest(self) -> int:
+        seq, data = self.frames.popleft()
+        self.first_seq = seq + 1
+        self.bytes -= len(data)
+        return len(data)
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self, after: int = 0) -> AsyncIterator[Tuple[int, str]]:
+        """返回序号大于 after 的帧 (seq, data)：先重放，再跟随实时生成，直到生成结束"""
+        seq = after
+        while True:
+            if not self.can_replay(seq):
+                raise ReplayGap(f"{self.key}: frames after {seq} were evicted (oldest kept: {self.first_seq})")
+            start = seq + 1 - self.first_seq
+            for frame_seq, data in list(itertools.islice(self.frames, max(0, start), None)):
+                yield frame_seq, data
+                seq = frame_seq
+            if self.done and seq >= self.last_seq:
+                return
+            if seq >= self.last_seq:
+                await self._changed.wait()
+
+
+class StreamBufferRegistry:
+    """
+    进行中生成的缓冲区注册表，支持断线后用 Last-Event-ID 续传。
+
+    - 生成在独立任务中运行，写入 TurnBuffer；SSE 响应只是订阅者，客户端断开不会立刻终止生成；
+    - 最后一个订阅者离开后 grace_seconds 内没有人重新订阅，取消生成任务（grace 为 0 时立即取消）；
+    - 生成结束后缓冲区保留 ttl_seconds 供续传，过期删除；
+    - 所有缓冲区总字节数超过 max_bytes 时，先淘汰最早结束的缓冲区，仍超出则丢弃当前缓冲区最早的帧；
+    - 合并相同请求（fan-out）：上下文键相同的生成正在进行时，新请求订阅它而不是再发起一次上游调用，
+      先拿到已生成的前缀，再跟随实时输出。默认只合并单轮、不带工具的请求。
+    """
+
+    def __init__(
+            self,
+            ttl_seconds: float = 60.0,
+            grace_seconds: float = 5.0,
+            max_frames_per_turn: int = 2048,
+            max_bytes: int = 64 * 1024 * 1024,
+            fanout_enabled: bool = True,
+            fanout_single_turn_only: bool = True,
+            fanout_allow_tools: bool = False,
+    ):
+        self.ttl = max(0.0, ttl_seconds)
+        self.grace = max(0.0, grace_seconds)
+        self.max_frames = max_frames_per_turn
+        self.max_bytes = max(1, max_bytes)
+        self.fanout_enabled = fanout_enabled
+        self.fanout_single_turn_only = fanout_single_turn_only
+        self.fanout_allow_tools = fanout_allow_tools
+        self._buffers: "OrderedDict[str, TurnBuffer]" = OrderedDict()
+        self._inflight: Dict[str, TurnBuffer] = {}  # 上下文键 -> 进行中的生成
+        self.bytes = 0
+        # 统计
+        self.turns = 0
+        self.resumes = 0
+        self.replayed_frames = 0
+        self.replay_gaps = 0
+        self.abandoned = 0
+        self.evicted_buffers = 0
+        self.evicted_frames = 0
+        self.fanout_joins = 0
+        self.fanout_streams = 0
+        self.fanout_max_subscribers = 0
+        self._fanout_recent: Deque[Dict[str, Any]] = deque(maxlen=20)
+
+    # ---------------- 相同请求合并 ----------------
+    def fanout_key(self, messages: List[Dict[str, str]], model: str, system_prompt: str, uses_tools: bool = False) -> Optional[str]:
+        """按策略返回请求的上下文键（与响应缓存同一规范化方式）；不允许合并时返回 None"""
+        if not self.fanout_enabled or not messages:
+            return None
+        if uses_tools and not self.fanout_allow_tools:
+            return None
+        if self.fanout_single_turn_only and len(messages) != 1:
+            return None
+        return cache_key(messages, model, system_prompt)
+
+    def find_inflight(self, context_key: Optional[str]) -> Optional[TurnBuffer]:
+        if context_key is None:
+            return None
+        buffer = self._inflight.get(context_key)
+        # 前缀已被环形缓冲区淘汰的生成无法完整转发，不再合并
+        if buffer is None or buffer.done or not buffer.can_replay(0):
+            return None
+        return buffer
+
+    # ---------------- 生产者 ----------------
+    def start(
+            self,
+            conversation_id: int,
+            user_id: Any,
+            produce: Callable[[TurnBuffer], Awaitable[None]],
+            context_key: Optional[str] = None,
+    ) -> TurnBuffer:
+        """
+        创建缓冲区并在后台任务中运行 produce(buffer)；produce 通过 append 写帧，结束时缓冲区自动关闭。
+        给出 context_key 时登记为进行中的生成，供相同请求 find_inflight 合并。
+        """
+        self._prune()
+        key = f"{conversation_id}.{secrets.token_hex(6)}"
+        buffer = TurnBuffer(key, conversation_id, user_id, self.max_frames)
+        self._buffers[key] = buffer
+        self.turns += 1
+        if context_key is not None:
+            buffer.context_key = context_key
+            self._inflight[context_key] = buffer
+
+        async def run() -> None:
+            try:
+                await produce(buffer)
+            finally:
+                self._finish(buffer)
+
+        buffer.producer = asyncio.get_running_loop().create_task(run())
+        return buffer
+
+    def append(self, buffer: TurnBuffer, data: str) -> int:
+        """追加一帧 SSE data，返回帧序号"""
+        size = len(data)
+        freed = buffer._append(data)
+        self.bytes += size - freed
+        if freed:
+            self.evicted_frames += 1
+        self._enforce_memory(buffer)
+        return buffer.last_seq
+
+    def _finish(self, buffer: TurnBuffer) -> None:
+        if buffer.context_key is not None and self._inflight.get(buffer.context_key) is buffer:
+            del self._inflight[buffer.context_key]
+        if buffer.fanout_subscribers:
+            self.fanout_streams += 1
+            self.fanout_max_subscribers = max(self.fanout_max_subscribers, buffer.fanout_subscribers + 1)
+            self._fanout_recent.append({"turn": buffer.key, "subscribers": buffer.fanout_subscribers + 1})
+        buffer.done = True
+        buffer.expires_at = time.monotonic() + self.ttl
+        if buffer._abandon_timer is not None:
+            buffer._abandon_timer.cancel()
+            buffer._abandon_timer = None
+        buffer._notify()
+        if self.ttl <= 0 and buffer.subscribers == 0:
+            self._remove(buffer.key)
+
+    # ---------------- 订阅者 ----------------
+    def get(self, key: str) -> Optional[TurnBuffer]:
+        self._prune()
+        return self._buffers.get(key)
+
+    @staticmethod
+    def parse_event_id(event_id: str) -> Optional[Tuple[str, int]]:
+        key, sep, seq = (event_id or "").strip().rpartition(":")
+        if not sep or not key or not seq.isdigit():
+            return None
+        return key, int(seq)
+
+    async def subscribe(
+            self,
+            buffer: TurnBuffer,
+            after: int = 0,
+            resume: bool = False,
+            fanout: bool = False,
+    ) -> AsyncIterator[Tuple[str, str]]:
+        """
+        返回 (event_id, data)；订阅期间取消放弃计时，最后一个订阅者离开时开始计时。
+        fanout=True 表示另一个相同请求合并到本生成上。
+        """
+        buffer.subscribers += 1
+        if fanout:
+            buffer.fanout_subscribers += 1
+            self.fanout_joins += 1
+        if buffer._abandon_timer is not None:
+            buffer._abandon_timer.cancel()
+            buffer._abandon_timer = None
+        if resume:
+            self.resumes += 1
+        live_from = buffer.last_seq
+        try:
+            async for seq, data in buffer.subscribe(after):
+                if resume and seq <= live_from:
+                    self.replayed_frames += 1
+                yield buffer.event_id(seq), data
+        except ReplayGap:
+            self.replay_gaps += 1
+            raise
+        finally:
+            buffer.subscribers -= 1
+            if buffer.subscribers == 0:
+                self._on_idle(buffer)
+
+    def _on_idle(self, buffer: TurnBuffer) -> None:
+        if buffer.done:
+            if self.ttl <= 0:
+                self._remove(buffer.key)
+            return
+        if self.grace <= 0:
+            self._abandon(buffer)
+            return
+        buffer._abandon_timer = asyncio.get_running_loop().call_later(self.grace, self._abandon, buffer)
+
+    def _abandon(self, buffer: TurnBuffer) -> None:
+        buffer._abandon_timer = None
+        if buffer.done or buffer.subscribers > 0:
+            return
+        self.abandoned += 1
+        logger.info(f"生成 {buffer.key} 无订阅者超过 {self.grace}s，取消上游生成")
+        if buffer.producer is not None:
+            buffer.producer.cancel()
+
+    # ---------------- 过期与内存上限 ----------------
+    def _remove(self, key: str) -> None:
+        buffer = self._buffers.pop(key, None)
+        if buffer is not None:
+            self.bytes -= buffer.bytes
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        expired = [k for k, b in self._buffers.items() if b.done and b.subscribers == 0 and b.expires_at <= now]
+        for key in expired:
+            self._remove(key)
+
+    def _enforce_memory(self, current: TurnBuffer) -> None:
+        if self.bytes <= self.max_bytes:
+            return
+        self._prune()
+        for key in [k for k, b in self._buffers.items() if b.done and b is not current]:
+            if self.bytes <= self.max_bytes:
+                return
+            self._remove(key)
+            self.evicted_buffers += 1
+        while self.bytes > self.max_bytes and len(current.frames) > 1:
+            self.bytes -= current._drop_oldest()
+            self.evicted_frames += 1
+
+    def stats(self) -> Dict[str, Any]:
+        self._prune()
+        return {
+            "buffers": len(self._buffers),
+            "in_flight": sum(1 for b in self._buffers.values() if not b.done),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "turns": self.turns,
+            "resumes": self.resumes,
+            "replayed_frames": self.replayed_frames,
+            "replay_gaps": self.replay_gaps,
+            "abandoned": self.abandoned,
+            "evicted_buffers": self.evicted_buffers,
+            "evicted_frames": self.evicted_frames,
+            "fanout": {
+                "enabled": self.fanout_enabled,
+                "in_flight_keys": len(self._inflight),
+                "joins": self.fanout_joins,
+                "shared_streams": self.fanout_streams,
+                "max_subscribers": self.fanout_max_subscribers,
+                "recent": list(self._fanout_recent),
+            },
+        }
+
+
+stream_buffers = StreamBufferRegistry(
+    ttl_seconds=settings.SSE_RESUME_TTL_SECONDS,
+    grace_seconds=settings.SSE_RESUME_GRACE_SECONDS,
+    max_frames_per_turn=settings.SSE_RESUME_MAX_FRAMES,
+    max_bytes=settings.SSE_RESUME_MAX_BYTES,
+    fanout_enabled=settings.STREAM_FANOUT_ENABLED,
+    fanout_single_turn_only=settings.STREAM_FANOUT_SINGLE_TURN_ONLY,
+    fanout_allow_tools=settings.STREAM_FANOUT_ALLOW_TOOLS,
+)
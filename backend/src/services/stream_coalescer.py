@@ -0,0 +1,159 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import asyncio
+import logging
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Dict, List, Optional
+
+from src.common.config import settings
+from src.common.stream_pump import StreamPump
+
+logger = logging.getLogger(__name__)
+
+
+class CoalesceStats:
+    """SSE 合并统计：输入 delta 数、输出帧数，以及每个响应的平均写出次数"""
+
+    def __init__(self):
+        self.streams = 0
+        self.deltas = 0
+        self.frames = 0
+        self.bytes = 0
+        self.flush_first = 0
+        self.flush_latency = 0
+        self.flush_bytes = 0
+        self.flush_end = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "streams": self.streams,
+            "deltas": self.deltas,
+            "frames": self.frames,
+            "bytes": self.bytes,
+            "frames_per_stream": round(self.frames / self.streams, 2) if self.streams else None,
+            "deltas_per_frame": round(self.deltas / self.frames, 2) if self.frames else None,
+            "flush_reasons": {
+                "first": self.flush_first,
+                "latency": self.flush_latency,
+                "bytes": self.flush_bytes,
+                "end": self.flush_end,
+            },
+        }
+
+    def reset(self) -> None:
+        self.__init__()
+
+
+class StreamCoalescer:
+    """
+    把模型返回的细碎 delta 合并成较大的块再写成 SSE 帧。
+
+    - 第一个 delta 立即发出，不影响首字延迟；
+    - 之后的 delta 先缓冲，缓冲区中最早的 delta 等待超过 max_latency_ms，
+      或缓冲区达到 max_bytes（UTF-8 字节数）时合并发出；
+    - 上游结束时发出剩余内容。max_latency_ms <= 0 时不做合并，逐个转发。
+
+    需要按时间 flush 时，上游由 StreamPump 在一个长期运行的任务中读取，这里带超时地等待它的队列，
+    超时只放弃这次读取，不会打断上游；下游提前关闭（例如客户端断开）时取消该任务，由它关闭上游。
+    """
+
+    def __init__(self, max_latency_ms: float = 30.0, max_bytes: int = 4096, stats: Optional[CoalesceStats] = None):
+        self.max_latency = max(0.0, max_latency_ms) / 1000.0
+        self.max_bytes = max(1, max_bytes)
+        self.stats = stats if stats is not None else CoalesceStats()
+
+    async def coalesce(self, source: AsyncIterable[str]) -> AsyncIterator[str]:
+        self.stats.streams += 1
+        if self.max_latency <= 0:
+            # 不合并：直接在调用方任务中迭代，不需要额外的任务
+            iterator = source.__aiter__()
+            try:
+                async for delta in iterator:
+                    if delta:
+                        self.stats.deltas += 1
+                        yield self._flush([delta])
+            finally:
+                if hasattr(iterator, "aclose"):
+                    await iterator.aclose()
+            return
+
+        pump = StreamPump(source)
+        buffer: List[str] = []
+        buffered_bytes = 0
+        window_start = 0.0
+        first = True
+        pending: Optional[asyncio.Future] = None
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(pump.get())
+                if buffer:
+                    remaining = window_start + self.max_latency - time.monotonic()
+                    if remaining > 0:
+                        await asyncio.wait({pending}, timeout=remaining)
+                    if not pending.done():
+                        # 时间窗口到期：先发出缓冲区，下一轮继续等待同一次读取
+                        self.stats.flush_latency += 1
+                        yield self._flush(buffer)
+                        buffer, buffered_bytes = [], 0
+                        continue
+                try:
+                    item = await pending
+                except StopAsyncIteration:
+                    pending = None
+                    break
+                except Exception:
+                    # 上游出错：先把已缓冲的内容发出，再把异常交给调用方
+                    pending = None
+                    if buffer:
+                        self.stats.flush_end += 1
+                        yield self._flush(buffer)
+                    raise
+                pending = None
+                if not item:
+                    continue
+                self.stats.deltas += 1
+
+                if first:
+                    first = False
+                    self.stats.flush_first += 1
+                    yield self._flush([item])
+                    continue
+
+                if not buffer:
+                    window_start = time.monotonic()
+                buffer.append(item)
+                buffered_bytes += len(item.encode("utf-8"))
+                if buffered_bytes >= self.max_bytes:
+                    self.stats.flush_bytes += 1
+                    yield self._flush(buffer)
+                    buffer, buffered_bytes = [], 0
+
+            if buffer:
+                self.stats.flush_end += 1
+                yield self._flush(buffer)
+        finally:
+            if pending is not None and not pending.done():
+                pending.cancel()
+            # 下游提前关闭时结束上游（在 pump 的任务内取消并关闭），并等待它真正退出
+            await pump.aclose()
+
+    def _flush(self, parts: List[str]) -> str:
+        text = parts[0] if len(parts) == 1 else "".join(parts)
+        self.stats.frames += 1
+        self.stats.bytes += len(text.encode("utf-8"))
+        return text
+
+
+coalesce_stats = CoalesceStats()
+
+
+def coalesce_deltas(source: AsyncIterable[str]) -> AsyncIterator[str]:
+    """按配置合并聊天流的 delta；所有聊天流共用一份统计"""
+    coalescer = StreamCoalescer(
+        max_latency_ms=settings.SSE_COALESCE_MS,
+        max_bytes=settings.SSE_COALESCE_MAX_BYTES,
+        stats=coalesce_stats,
+    )
+    return coalescer.coalesce(source)
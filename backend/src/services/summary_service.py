@@ -0,0 +1,153 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from src.common.config import settings
+from src.crud.crud_summary import async_get_messages_after, async_get_summary, async_save_summary
+from src.db.session import async_session_scope
+from src.services.admission import admission_controller
+from src.services.scheduler import PRIORITY_BATCH
+
+logger = logging.getLogger(__name__)
+
+# summarize(previous_summary, [(id, role, content), ...]) -> new_summary
+SummarizeFn = Callable[[str, List[Tuple[int, str, str]]], Awaitable[str]]
+
+SUMMARY_SYSTEM_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Merge the previous summary with the new messages into one concise summary that keeps "
+    "facts, user preferences, decisions and open questions. Reply with the summary only, "
+    "in the language of the conversation."
+)
+
+_summary_agent = None
+
+
+async def summarize_with_llm(previous_summary: str, messages: List[Tuple[int, str, str]]) -> str:
+    """默认摘要实现：调用与对话相同的模型，把旧摘要和新消息合并为新摘要"""
+    global _summary_agent
+    if _summary_agent is None:
+        from pydantic_ai import Agent
+        from src.services.ai_service import deepseek_model
+        _summary_agent = Agent(model=deepseek_model, system_prompt=SUMMARY_SYSTEM_PROMPT)
+
+    lines = [f"{role}: {content}" for _, role, content in messages]
+    prompt = (
+        f"Previous summary:\n{previous_summary or '(none)'}\n\n"
+        f"New messages:\n" + "\n".join(lines)
+    )
+    # 摘要是后台批处理，拥塞时排在交互式对话和 agent 运行之后
+    async with admission_controller.upstream_slot(PRIORITY_BATCH):
+        result = await _summary_agent.run(prompt)
+    return str(result.output).strip()
+
+
+class SummaryService:
+    """
+    滚动摘要：每轮对话结束后在后台把较早的消息并入会话摘要。
+
+    - 未摘要的消息达到 trigger_messages 条后才触发，保留最近 keep_recent 条不折叠；
+    - 读取消息和写入摘要各用一个短 Session，调用 LLM 期间不占用数据库连接；
+    - 摘要带版本号，写入时做乐观锁比较；对话请求只读取已提交的版本，从不等待重新生成。
+    """
+
+    def __init__(
+            self,
+            summarize: SummarizeFn = summarize_with_llm,
+            session_scope: Callable = async_session_scope,
+            enabled: bool = True,
+            trigger_messages: int = 16,
+            keep_recent: int = 6,
+            max_fold: int = 100,
+            max_summary_chars: int = 4000,
+    ):
+        self.summarize = summarize
+        self.session_scope = session_scope
+        self.enabled = enabled
+        self.keep_recent = max(0, keep_recent)
+        self.trigger_messages = max(trigger_messages, self.keep_recent + 1)
+        self.max_fold = max(1, max_fold)
+        self.max_summary_chars = max_summary_chars
+        self._running: Dict[int, asyncio.Task] = {}
+        self._dirty: Set[int] = set()
+        # 统计
+        self.runs = 0
+        self.updates = 0
+        self.conflicts = 0
+        self.failures = 0
+
+    def schedule(self, conv_id: int) -> Optional[asyncio.Task]:
+        """在后台为会话刷新摘要；同一会话已有任务在跑时只做标记，任务结束后再跑一轮"""
+        if not self.enabled:
+            return None
+        task = self._running.get(conv_id)
+        if task is not None and not task.done():
+            self._dirty.add(conv_id)
+            return task
+        task = asyncio.get_running_loop().create_task(self._run(conv_id))
+        self._running[conv_id] = task
+        task.add_done_callback(lambda _t, cid=conv_id: self._running.pop(cid, None))
+        return task
+
+    async def _run(self, conv_id: int) -> None:
+        while True:
+            self._dirty.discard(conv_id)
+            try:
+                await self.refresh(conv_id)
+            except Exception as e:
+                self.failures += 1
+                logger.exception(f"会话 {conv_id} 摘要生成失败（非致命）: {e}")
+                return
+            if conv_id not in self._dirty:
+                return
+
+    async def refresh(self, conv_id: int) -> bool:
+        """若未摘要的消息足够多，则生成并保存新版本摘要；返回是否写入了新版本"""
+        self.runs += 1
+        async with self.session_scope() as db:
+            current = await async_get_summary(db, conv_id)
+            previous, watermark, version = current if current else ("", 0, 0)
+            pending = await async_get_messages_after(db, conv_id, watermark, self.max_fold + self.keep_recent)
+
+        if len(pending) < self.trigger_messages:
+            return False
+        # 保留最近 keep_recent 条在上下文中原样发送，其余折叠进摘要
+        fold = pending[:len(pending) - self.keep_recent]
+        if not fold:
+            return False
+
+        summary = await self.summarize(previous, fold)
+        if self.max_summary_chars and len(summary) > self.max_summary_chars:
+            summary = summary[:self.max_summary_chars]
+
+        async with self.session_scope() as db:
+            saved = await async_save_summary(db, conv_id, summary, fold[-1][0], expected_version=version)
+        if saved:
+            self.updates += 1
+            logger.info(f"会话 {conv_id} 摘要更新至 v{version + 1}，水位线 {fold[-1][0]}")
+        else:
+            self.conflicts += 1
+            logger.info(f"会话 {conv_id} 摘要已被其他任务更新，放弃本次结果")
+        return saved
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "in_flight": sum(1 for t in self._running.values() if not t.done()),
+            "runs": self.runs,
+            "updates": self.updates,
+            "conflicts": self.conflicts,
+            "failures": self.failures,
+        }
+
+
+summary_service = SummaryService(
+    enabled=settings.SUMMARY_ENABLED,
+    trigger_messages=settings.SUMMARY_TRIGGER_MESSAGES,
+    keep_recent=settings.SUMMARY_KEEP_RECENT,
+    max_fold=settings.SUMMARY_MAX_FOLD,
+    max_summary_chars=settings.SUMMARY_MAX_CHARS,
+)
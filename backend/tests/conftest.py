@@ -0,0 +1,35 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Shared fixtures.
+
+Some test modules replace `pydantic_ai` in sys.modules with lightweight fakes at import time.
+`real_pydantic_ai` temporarily restores the installed library for tests that must run a real agent
+(e.g. to catch anyio cancel-scope errors that fake async generators hide), then puts the fakes back.
+"""
+
+import importlib
+import sys
+import types
+
+import pytest
+
+
+def _pydantic_ai_modules():
+    return {name: mod for name, mod in sys.modules.items() if name == "pydantic_ai" or name.startswith("pydantic_ai.")}
+
+
+@pytest.fixture
+def real_pydantic_ai():
+    saved = _pydantic_ai_modules()
+    for name in saved:
+        del sys.modules[name]
+    try:
+        pydantic_ai = importlib.import_module("pydantic_ai")
+        function = importlib.import_module("pydantic_ai.models.function")
+        yield types.SimpleNamespace(Agent=pydantic_ai.Agent, FunctionModel=function.FunctionModel)
+    finally:
+        for name in _pydantic_ai_modules():
+            del sys.modules[name]
+        sys.modules.update(saved)
@@ -0,0 +1,89 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for per-user and global admission control (src.services.admission).
+"""
+
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from src.services.admission import AdmissionController, AdmissionRejected
+
+
+async def _admit(controller, user):
+    lease = controller.admit(user)
+    await lease.acquire_upstream()
+    return lease
+
+
+async def test_per_user_cap_rejects_fast_with_429():
+    controller = AdmissionController(max_per_user=2, max_global=10, retry_after=3)
+    a, b = await _admit(controller, "u1"), await _admit(controller, "u1")
+    with pytest.raises(AdmissionRejected) as exc:
+        controller.admit("u1")
+    assert exc.value.status_code == 429 and exc.value.headers == {"Retry-After": "3"}
+    await _admit(controller, "u2")  # other users are unaffected
+    a.release()
+    a.release()  # idempotent
+    await _admit(controller, "u1")
+    assert controller.stats()["rejected"]["per_user_limit"] == 1
+    assert controller.stats()["active"] == 3
+    b.release()
+
+
+async def test_global_cap_queues_fifo_and_hands_over_slots():
+    controller = AdmissionController(max_per_user=0, max_global=1, max_queue=5, queue_timeout=1)
+    first = await _admit(controller, "a")
+    order = []
+
+    async def waiter(name):
+        lease = await _admit(controller, name)
+        order.append(name)
+        return lease
+
+    tasks = [asyncio.ensure_future(waiter(n)) for n in ("b", "c")]
+    await asyncio.sleep(0.01)
+    assert controller.stats()["waiting"] == 2 and not order
+    first.release()
+    second = await tasks[0]
+    assert order == ["b"] and controller.active == 1
+    second.release()
+    (await tasks[1]).release()
+    assert order == ["b", "c"] and controller.active == 0
+    stats = controller.stats()
+    assert stats["queued"] == 2 and stats["wait"]["count"] == 3
+
+
+async def test_queue_full_and_timeout_return_503():
+    controller = AdmissionController(max_per_user=0, max_global=1, max_queue=1, queue_timeout=0.03)
+    held = await _admit(controller, "a")
+    queued = asyncio.ensure_future(_admit(controller, "b"))
+    await asyncio.sleep(0.005)
+    with pytest.raises(AdmissionRejected) as exc:
+        await _admit(controller, "c")
+    assert exc.value.status_code == 503 and exc.value.reason == "queue_full"
+    with pytest.raises(AdmissionRejected) as exc:
+        await queued
+    assert exc.value.reason == "queue_timeout"
+    assert controller.stats()["waiting"] == 0
+    held.release()
+    assert controller.active == 0
+
+
+async def test_cancelled_waiter_does_not_leak_a_slot():
+    controller = AdmissionController(max_per_user=0, max_global=1, queue_timeout=1)
+    held = await _admit(controller, "a")
+    waiting = asyncio.ensure_future(_admit(controller, "b"))
+    await asyncio.sleep(0.005)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    held.release()
+    assert controller.active == 0 and controller.stats()["waiting"] == 0
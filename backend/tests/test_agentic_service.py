@@ -40,7 +40,7 @@ class FakeAgent:
         # store registered tools as name -> function
         self._tools = {}
 
-    def tool(self, name: str = None):
+    def tool(self, name: str = None, **kwargs):
         # returns a decorator that registers the function under the given name
         def decorator(fn):
             key = name or fn.__name__
@@ -63,13 +63,13 @@ providers_openai = types.ModuleType("pydantic_ai.providers.openai")
 
 # Minimal placeholder classes for imported names
 class FakeOpenAIChatModel:
-    def __init__(self, model_name=None, provider=None):
+    def __init__(self, model_name=None, provider=None, **kwargs):
         self.model_name = model_name
         self.provider = provider
 
 
 class FakeOpenAIProvider:
-    def __init__(self, base_url=None, api_key=None):
+    def __init__(self, base_url=None, api_key=None, http_client=None, **kwargs):
         self.base_url = base_url
         self.api_key = api_key
 
@@ -164,3 +164,26 @@ async def test_tool_search_with_fake_ddgs():
     assert "摘要:" in out
     # It should contain our fake URLs
     assert "https://example.one" in out or "https://example.two" in out
+
+
+@pytest.mark.asyncio
+async def test_tool_search_caches_repeated_queries():
+    """
+    Repeated identical queries (after normalization) are served from the search cache.
+    """
+    calls = []
+
+    class CountingDDGS:
+        def text(self, query, max_results=5):
+            calls.append(query)
+            return [{"title": "Weather", "href": "https://example.weather", "body": "Sunny"}]
+
+    agentic_service.DDGS = CountingDDGS
+    agentic_service._agent_singleton = None
+    tool_fn = agentic_service.get_or_create_agent()._tools.get("tool_search")
+
+    first = await tool_fn(agentic_service.RunContext(), "Weather in Oslo today", max_results=2)
+    second = await tool_fn(agentic_service.RunContext(), "  weather in oslo TODAY", max_results=2)
+    assert first == second
+    assert "https://example.weather" in first
+    assert len(calls) == 1
@@ -57,7 +57,7 @@ def test_agui_agent_success_and_unauthorized(monkeypatch):
     monkeypatch.setattr(chat_agui_module, "get_or_create_agent", lambda: fake_agent_obj)
 
     # Monkeypatch handle_ag_ui_request to controlled async function
-    async def fake_handle_ag_ui_request(request, agent):
+    async def fake_handle_ag_ui_request(request, agent, **kwargs):
         from fastapi import Response
         assert agent is fake_agent_obj
         return Response(content="AGUI RESPONSE", media_type="text/plain")
@@ -100,7 +100,7 @@ def test_deferred_results_various(monkeypatch):
     monkeypatch.setattr(chat_agui_module, "get_or_create_agent", lambda: object())
 
     # Patch AGUIAdapter.dispatch_request
-    async def fake_dispatch_request(request, agent=None):
+    async def fake_dispatch_request(request, agent=None, **kwargs):
         from fastapi.responses import JSONResponse
         return JSONResponse({"deferred": "ok"})
 
@@ -135,3 +135,120 @@ def test_deferred_results_various(monkeypatch):
     resp_unauth = client.post("/agui/deferred_results", json=payload)
     assert resp_unauth.status_code == 401
     assert "Invalid token" in resp_unauth.json().get("detail", "")
+
+
+def test_agui_agent_stream_is_guarded_against_disconnects(monkeypatch):
+    """Streaming AG-UI responses are wrapped so a disconnect cancels the run; completed runs are counted."""
+    app = FastAPI()
+    app.include_router(router)
+    monkeypatch.setattr(chat_agui_module, "get_or_create_agent", lambda: object())
+
+    async def fake_handle_ag_ui_request(request, agent, **kwargs):
+        from fastapi.responses import StreamingResponse
+
+        async def events():
+            yield "data: {\"type\": \"RUN_STARTED\"}\n\n"
+            yield "data: {\"type\": \"RUN_FINISHED\"}\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    monkeypatch.setattr(chat_agui_module, "handle_ag_ui_request", fake_handle_ag_ui_request)
+
+    async def fake_get_current_user():
+        return {"id": 1, "username": "tester"}
+
+    app.dependency_overrides[chat_agui_module.get_current_user] = fake_get_current_user
+    stats = chat_agui_module.disconnect_stats["agui"]
+    completed_before = stats.completed
+
+    resp = TestClient(app).post("/agui/agent", json={"foo": "bar"})
+    assert resp.status_code == 200
+    assert "RUN_FINISHED" in resp.text
+    assert stats.completed == completed_before + 1
+
+
+def test_agui_agent_runs_feed_the_provider_router(monkeypatch):
+    """TTFT is taken from the first event after RUN_STARTED; a RUN_ERROR event counts as a failure."""
+    from src.services.llm_router import LLMEndpoint, ProviderRouter
+
+    endpoint = LLMEndpoint(name="e", base_url="http://e", api_key="k", model_name="m")
+    fake_router = ProviderRouter([endpoint])
+    monkeypatch.setattr(fake_router, "model_for", lambda e: None)
+    monkeypatch.setattr(chat_agui_module, "provider_router", fake_router)
+    monkeypatch.setattr(chat_agui_module, "get_or_create_agent", lambda: object())
+
+    events = []
+
+    async def fake_handle_ag_ui_request(request, agent, **kwargs):
+        from fastapi.responses import StreamingResponse
+
+        async def stream():
+            for event_type in events:
+                yield f"data: {{\"type\":\"{event_type}\"}}\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    monkeypatch.setattr(chat_agui_module, "handle_ag_ui_request", fake_handle_ag_ui_request)
+
+    async def fake_get_current_user():
+        return {"id": 1, "username": "tester"}
+
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[chat_agui_module.get_current_user] = fake_get_current_user
+    client = TestClient(app)
+
+    events[:] = ["RUN_STARTED", "TEXT_MESSAGE_CONTENT", "RUN_FINISHED"]
+    assert client.post("/agui/agent", json={}).status_code == 200
+    assert endpoint.requests == 1 and endpoint.in_flight == 0
+    assert endpoint.ttft.count == 1 and endpoint.ewma_ttft_ms is not None
+    assert endpoint.errors == 0
+
+    events[:] = ["RUN_STARTED", "RUN_ERROR"]
+    assert client.post("/agui/agent", json={}).status_code == 200
+    assert endpoint.requests == 2 and endpoint.in_flight == 0
+    assert endpoint.ttft.count == 1  # a failed run does not produce a TTFT sample
+    assert endpoint.errors == 1 and endpoint.consecutive_failures == 1
+
+
+async def test_lease_is_released_when_the_body_is_never_iterated():
+    """A client that disconnects before streaming starts never runs the generator's finally; background releases."""
+    from fastapi.responses import StreamingResponse
+    from src.services.admission import AdmissionController
+    from src.services.llm_router import LLMEndpoint
+
+    async def events():
+        yield "data: {\"type\":\"RUN_STARTED\"}\n\n"
+
+    controller = AdmissionController(max_per_user=1, max_global=1)
+    lease = controller.admit(1)
+    await lease.acquire_upstream()
+    endpoint = LLMEndpoint(name="e", base_url="http://e", api_key="k", model_name="m")
+    response = chat_agui_module._guard_response(
+        StreamingResponse(events(), media_type="text/event-stream"), None, lease, endpoint)
+    assert not lease.released
+    await response.background()
+    assert lease.released
+    assert controller.active == 0
+    assert endpoint.requests == 0  # the run never started, so nothing is reported to the router
+
+
+def test_deferred_results_go_through_admission(monkeypatch):
+    from src.services.admission import AdmissionRejected
+
+    app = FastAPI()
+    app.include_router(router)
+    monkeypatch.setattr(chat_agui_module, "get_or_create_agent", lambda: object())
+
+    async def fake_get_current_user():
+        return {"id": 2, "username": "u2"}
+
+    def shed():
+        raise AdmissionRejected(503, "load_shed", 2)
+
+    app.dependency_overrides[chat_agui_module.get_current_user] = fake_get_current_user
+    monkeypatch.setattr(chat_agui_module.degradation_controller, "check_admission", shed)
+
+    resp = TestClient(app).post("/agui/deferred_results", json={"deferred_results": []})
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "2"
@@ -6,8 +6,7 @@
 Simplified unit tests for src.services.ai_service.
 
 - Ensure required environment variables exist BEFORE importing the module to avoid pydantic Settings ValidationError.
-- Only test pure, synchronous helper functions (_compute_delta and _extract_text_from_partial).
-- Do not require pytest-asyncio or other async plugins.
+- Test the pure helper functions and stream_chat_response (with fake agents) in both output modes.
 """
 
 import os
@@ -76,3 +75,129 @@ def test_extract_from_string_and_nonstring():
     assert ai_service._extract_text_from_partial("plain string") == "plain string"
     # integer fallback to str
     assert ai_service._extract_text_from_partial(123) == "123"
+
+
+# -----------------------
+# Tests for StreamDeltaTracker
+# -----------------------
+def test_tracker_cumulative_partials():
+    tracker = ai_service.StreamDeltaTracker(window=4)
+    deltas = [tracker.feed(p) for p in ["He", "Hello", "Hello", "Hello, wor", "Hello, world!"]]
+    assert deltas == ["He", "llo", "", ", wor", "ld!"]
+    assert tracker.text == "Hello, world!"
+    assert len(tracker) == len("Hello, world!")
+
+
+def test_tracker_fragment_partials_are_appended():
+    tracker = ai_service.StreamDeltaTracker(window=8)
+    assert tracker.feed("abcde") == "abcde"
+    assert tracker.feed("cdef") == "cdef"  # not a continuation of the sent text -> appended as-is
+    assert tracker.feed("xyz") == "xyz"
+    assert tracker.text == "abcdecdefxyz"
+
+
+def test_tracker_keeps_fragments_that_repeat_the_tail():
+    tracker = ai_service.StreamDeltaTracker(window=4)
+    deltas = [tracker.feed(p) for p in ["hel", "l", "o", " wor", "l", "d"]]
+    assert deltas == ["hel", "l", "o", " wor", "l", "d"]
+    assert tracker.text == "hello world"
+
+
+def test_tracker_matches_cumulative_stream_on_long_text():
+    text = "".join(f"token{i} " for i in range(5000))
+    tracker = ai_service.StreamDeltaTracker()
+    out = []
+    for end in range(0, len(text) + 1, 7):
+        out.append(tracker.feed(text[:end]))
+    out.append(tracker.feed(text))
+    assert "".join(out) == text
+    assert tracker.text == text
+
+
+# -----------------------
+# Tests for output modes of stream_chat_response
+# -----------------------
+class _FakeTextResult:
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.stream_text_kwargs = None
+
+    async def stream_text(self, **kwargs):
+        self.stream_text_kwargs = kwargs
+        for d in self.deltas:
+            yield d
+
+
+class _FakeStreamAgent:
+    def __init__(self, result):
+        self.result = result
+        self.prompts = []
+
+    def run_stream(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        agent = self
+
+        class _Ctx:
+            async def __aenter__(self):
+                return agent.result
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return _Ctx()
+
+
+@pytest.fixture(autouse=True)
+def _no_response_cache(monkeypatch):
+    monkeypatch.setattr(ai_service, "response_cache", ai_service.response_cache.__class__(enabled=False))
+
+
+async def _collect(messages):
+    return [d async for d in ai_service.stream_chat_response(messages)]
+
+
+async def test_text_mode_forwards_raw_deltas(monkeypatch):
+    result = _FakeTextResult(["Hel", "", "lo", " world"])
+    text_agent = _FakeStreamAgent(result)
+    structured_agent = _FakeStreamAgent(None)
+    monkeypatch.setattr(ai_service, "text_agent", text_agent)
+    monkeypatch.setattr(ai_service, "agent", structured_agent)
+    monkeypatch.setattr(ai_service.settings, "CHAT_OUTPUT_MODE", "text")
+
+    out = await _collect([
+        {"role": "system", "content": "earlier summary"},
+        {"role": "user", "content": "hi"},
+    ])
+
+    assert out == ["Hel", "lo", " world"]
+    assert result.stream_text_kwargs == {"delta": True, "debounce_by": None}
+    assert structured_agent.prompts == []
+    assert text_agent.prompts[0].startswith("以下是此前对话的摘要：\nearlier summary")
+    assert text_agent.prompts[0].endswith("hi")
+
+
+async def test_structured_mode_uses_output_stream(monkeypatch):
+    class _StructuredResult:
+        async def stream_output(self):
+            for partial in ({"content": "Hel"}, {"content": "Hello"}, {"content": "Hello!"}):
+                yield partial
+
+    structured_agent = _FakeStreamAgent(_StructuredResult())
+    monkeypatch.setattr(ai_service, "agent", structured_agent)
+    monkeypatch.setattr(ai_service, "text_agent", _FakeStreamAgent(None))
+    monkeypatch.setattr(ai_service.settings, "CHAT_OUTPUT_MODE", "structured")
+
+    assert await _collect([{"role": "user", "content": "hi"}]) == ["Hel", "lo", "!"]
+
+
+async def test_stream_errors_and_empty_input(monkeypatch):
+    class _FailingResult:
+        async def stream_text(self, **kwargs):
+            yield "partial"
+            raise RuntimeError("boom")
+
+    monkeypatch.setattr(ai_service, "text_agent", _FakeStreamAgent(_FailingResult()))
+    monkeypatch.setattr(ai_service.settings, "CHAT_OUTPUT_MODE", "text")
+
+    assert await _collect([{"role": "user", "content": "hi"}]) == ["partial", "请求失败: boom"]
+    assert await _collect([{"role": "assistant", "content": "x"}]) == ["错误：没有有效的用户消息"]
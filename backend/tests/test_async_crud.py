@@ -0,0 +1,83 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for the async CRUD variants (AsyncCRUDConversation, async message helpers, AsyncCRUDUser).
+
+- Runs against an in-memory sqlite database through the aiosqlite driver.
+- Each test builds its own engine so tests stay independent from src.db.session.
+"""
+
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.db.base import Base
+from src.db.session import _to_async_url
+from src.models.conversation import Conversation  # noqa: F401 - register mappers
+from src.models.message import Message  # noqa: F401
+from src.models.user import User  # noqa: F401
+from src.crud.crud_conversation import async_conversation
+from src.crud.crud_message import async_create_message, async_get_messages_by_conversation
+from src.crud.crud_user import async_user_crud
+
+
+@pytest.fixture
+async def db():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+    async with session_factory() as session:
+        yield session
+    await engine.dispose()
+
+
+def test_to_async_url():
+    assert _to_async_url("postgresql://u:p@h/db") == "postgresql+psycopg://u:p@h/db"
+    assert _to_async_url("postgresql+psycopg2://u:p@h/db") == "postgresql+psycopg://u:p@h/db"
+    assert _to_async_url("sqlite:///:memory:") == "sqlite+aiosqlite:///:memory:"
+    assert _to_async_url("sqlite+aiosqlite:///x.db") == "sqlite+aiosqlite:///x.db"
+
+
+async def test_conversation_and_messages_roundtrip(db):
+    user_id = await async_user_crud.create(db, {"email": "a@b.com", "name": "A", "hashed_password": "x"})
+    assert user_id
+
+    conv_id = await async_conversation.create_conversation_if_not_exists(db, None, user_id=user_id)
+    # existing conversation is reused
+    assert await async_conversation.create_conversation_if_not_exists(db, conv_id, user_id=user_id) == conv_id
+
+    await async_create_message(db, conv_id, "user", "hi")
+    await async_create_message(db, conv_id, "assistant", "hello")
+    msgs = await async_get_messages_by_conversation(db, conv_id)
+    assert [(m.role, m.content) for m in msgs] == [("user", "hi"), ("assistant", "hello")]
+
+    convs = await async_conversation.get_conversations(db, user_id=user_id)
+    assert [c.id for c in convs] == [conv_id]
+    # messages are eagerly loaded, so accessing them needs no extra IO
+    assert len(convs[0].messages) == 2
+
+
+async def test_create_message_validation(db):
+    with pytest.raises(ValueError):
+        await async_create_message(db, 1, "robot", "x")
+    with pytest.raises(ValueError):
+        await async_create_message(db, 999, "user", "x")
+
+
+async def test_async_user_crud(db):
+    user_id = await async_user_crud.create(db, {"email": "c@d.com", "name": "C", "hashed_password": "x"})
+    assert await async_user_crud.email_exists(db, "c@d.com")
+    assert not await async_user_crud.email_exists(db, "c@d.com", exclude_user_id=user_id)
+    assert (await async_user_crud.get_by_email(db, email="c@d.com"))["id"] == user_id
+    assert await async_user_crud.update(db, user_id, {"name": "CC"})
+    assert (await async_user_crud.get_by_id(db, user_id))["name"] == "CC"
+    assert await async_user_crud.delete(db, user_id)
+    assert await async_user_crud.get_by_id(db, user_id) is None
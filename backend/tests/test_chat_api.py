@@ -5,6 +5,7 @@
 import os
 import json
 import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
 import importlib
@@ -18,25 +19,33 @@ os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
 chat_module = importlib.import_module("src.api.v1.endpoints.chat_api")
 router = getattr(chat_module, "router")
 
+from src.services.admission import AdmissionController  # noqa: E402
+from src.services.stream_buffer import StreamBufferRegistry  # noqa: E402
+
 
 def test_chat_endpoint_streams_and_saves(monkeypatch):
     """
     Synchronous test using TestClient:
-    - monkeypatch internal symbols in chat_module (conversation, create_message, stream_chat_response)
-    - ensure SSE contains yielded chunks and that create_message was called for user and assistant
+    - monkeypatch internal symbols in chat_module (async_conversation, message_writer, stream_chat_response)
+    - ensure SSE contains yielded chunks and that message_writer.write was called for user and assistant
     """
-    # 1) Fake conversation.create_conversation_if_not_exists to always return an id
+    # 1) Fake async_conversation.create_conversation_if_not_exists to always return an id
     fake_conv_id = 42
-    fake_conv = type("C", (), {"create_conversation_if_not_exists": lambda db, cid: fake_conv_id})
-    monkeypatch.setattr(chat_module, "conversation", fake_conv)
 
-    # 2) Capture create_message calls in a list (synchronous)
+    async def fake_create_conversation_if_not_exists(db, cid):
+        return fake_conv_id
+
+    fake_conv = type("C", (), {"create_conversation_if_not_exists": staticmethod(fake_create_conversation_if_not_exists)})
+    monkeypatch.setattr(chat_module, "async_conversation", fake_conv)
+
+    # 2) Capture message_writer.write calls in a list
     saved_messages = []
 
-    def fake_create_message(db, conversation_id, role, content):
-        saved_messages.append({"conversation_id": conversation_id, "role": role, "content": content})
+    class FakeMessageWriter:
+        async def write(self, conversation_id, role, content):
+            saved_messages.append({"conversation_id": conversation_id, "role": role, "content": content})
 
-    monkeypatch.setattr(chat_module, "create_message", fake_create_message)
+    monkeypatch.setattr(chat_module, "message_writer", FakeMessageWriter())
 
     # 3) Fake stream_chat_response: async generator yielding two chunks then ending
     async def fake_stream_chat_response(full_history):
@@ -47,22 +56,36 @@ def test_chat_endpoint_streams_and_saves(monkeypatch):
 
     monkeypatch.setattr(chat_module, "stream_chat_response", fake_stream_chat_response)
 
-    # 4) Ensure get_messages_by_conversation is None so we use provided history
-    monkeypatch.setattr(chat_module, "get_messages_by_conversation", None, raising=False)
+    # 4) The DB context loader must not be used when the client provides history
+    loader_calls = []
+
+    async def fake_load_conversation_context(db, conv_id):
+        loader_calls.append(conv_id)
+        return []
+
+    monkeypatch.setattr(chat_module, "load_conversation_context", fake_load_conversation_context)
+
+    scheduled_summaries = []
+    monkeypatch.setattr(chat_module.summary_service, "schedule", scheduled_summaries.append)
+
+    # 5) Short-lived session scopes: record how many are opened, no real database needed
+    opened_scopes = []
+
+    @asynccontextmanager
+    async def fake_session_scope():
+        opened_scopes.append(True)
+        yield None
+
+    monkeypatch.setattr(chat_module, "async_session_scope", fake_session_scope)
 
     # Build temporary FastAPI app and include router
     app = FastAPI()
     app.include_router(router, prefix="/api/v1")
 
-    # Override dependencies: get_db and get_current_user
-    def fake_get_db():
-        # yield-like behavior not necessary for sync TestClient; returning None is fine
-        return None
-
+    # Override dependencies: get_current_user
     def fake_get_current_user():
         return {"id": 1, "username": "test"}
 
-    app.dependency_overrides[chat_module.get_db] = fake_get_db
     app.dependency_overrides[chat_module.get_current_user] = fake_get_current_user
 
     client = TestClient(app)
@@ -103,6 +126,11 @@ def test_chat_endpoint_streams_and_saves(monkeypatch):
     assert assistant_msgs, "assistant message not saved"
     assert "Hello" in assistant_msgs[-1]["content"]
     assert "world" in assistant_msgs[-1]["content"]
+    assert loader_calls == []
+    assert scheduled_summaries == [fake_conv_id]
+
+    # only the pre-stream reads open a session; writes go through the message writer
+    assert len(opened_scopes) == 1
 
 
 def test_chat_endpoint_unauthorized(monkeypatch):
@@ -112,13 +140,9 @@ def test_chat_endpoint_unauthorized(monkeypatch):
     app = FastAPI()
     app.include_router(router, prefix="/api/v1")
 
-    def fake_get_db():
-        return None
-
     def fake_get_current_user_none():
         return None
 
-    app.dependency_overrides[chat_module.get_db] = fake_get_db
     app.dependency_overrides[chat_module.get_current_user] = fake_get_current_user_none
 
     client = TestClient(app)
@@ -133,3 +157,305 @@ def test_chat_endpoint_unauthorized(monkeypatch):
     assert resp.status_code == 401
     data = resp.json()
     assert "Invalid token" in data.get("detail", "")
+
+
+async def test_chat_stream_cancels_and_saves_partial_answer_on_disconnect(monkeypatch):
+    """A client that goes away mid-answer stops the upstream run; the partial answer is saved as truncated."""
+    async def fake_create_conversation_if_not_exists(db, cid):
+        return 7
+
+    fake_conv = type("C", (), {"create_conversation_if_not_exists": staticmethod(fake_create_conversation_if_not_exists)})
+    monkeypatch.setattr(chat_module, "async_conversation", fake_conv)
+
+    saved_messages = []
+
+    class FakeMessageWriter:
+        async def write(self, conversation_id, role, content):
+            saved_messages.append((role, content))
+
+    monkeypatch.setattr(chat_module, "message_writer", FakeMessageWriter())
+    monkeypatch.setattr(chat_module.summary_service, "schedule", lambda conv_id: None)
+    monkeypatch.setattr(chat_module.settings, "SSE_DISCONNECT_POLL_SECONDS", 0.01)
+    monkeypatch.setattr(chat_module.settings, "SSE_COALESCE_MS", 0)
+    # no reconnect grace: the run is cancelled as soon as its only subscriber leaves
+    monkeypatch.setattr(chat_module, "stream_buffers", StreamBufferRegistry(grace_seconds=0))
+
+    upstream = {"produced": 0, "cancelled": False}
+
+    async def slow_stream_chat_response(full_history):
+        try:
+            for i in range(100):
+                upstream["produced"] += 1
+                yield f"part{i} "
+                await asyncio.sleep(0.02)
+        except asyncio.CancelledError:
+            upstream["cancelled"] = True
+            raise
+
+    monkeypatch.setattr(chat_module, "stream_chat_response", slow_stream_chat_response)
+
+    @asynccontextmanager
+    async def fake_session_scope():
+        yield None
+
+    monkeypatch.setattr(chat_module, "async_session_scope", fake_session_scope)
+
+    class FakeHttpRequest:
+        headers = {}
+
+        def __init__(self):
+            self.gone = False
+
+        async def is_disconnected(self):
+            return self.gone
+
+    http_request = FakeHttpRequest()
+    stats = chat_module.disconnect_stats["chat"]
+    cancelled_before = stats.cancelled
+
+    payload = chat_module.ChatRequest(conversation_id=None, message="hi", history=[{"role": "user", "content": "q"}])
+    response = await chat_module.chat(payload, http_request, current_user={"id": 1})
+    frames = []
+    async for frame in response.body_iterator:
+        frames.append(frame)
+        if len(frames) == 3:  # comment + two content frames, then the tab closes
+            http_request.gone = True
+    await asyncio.sleep(0.05)  # the truncated answer is saved by a detached task
+
+    assert upstream["cancelled"] and upstream["produced"] < 10
+    assert not any("[DONE]" in f for f in frames)
+    assert saved_messages[0] == ("user", "hi")
+    role, content = saved_messages[-1]
+    assert role == "assistant" and content.startswith("part0 part1") and content.endswith(chat_module.TRUNCATED_MARKER)
+    assert stats.cancelled == cancelled_before + 1
+
+
+async def test_chat_stream_resumes_from_last_event_id(monkeypatch):
+    """A reconnect with Last-Event-ID replays the missed frames, then follows the live tail, without a new upstream run."""
+    async def fake_create_conversation_if_not_exists(db, cid):
+        return 9
+
+    fake_conv = type("C", (), {"create_conversation_if_not_exists": staticmethod(fake_create_conversation_if_not_exists)})
+    monkeypatch.setattr(chat_module, "async_conversation", fake_conv)
+
+    class FakeMessageWriter:
+        async def write(self, conversation_id, role, content):
+            pass
+
+    monkeypatch.setattr(chat_module, "message_writer", FakeMessageWriter())
+    monkeypatch.setattr(chat_module.summary_service, "schedule", lambda conv_id: None)
+    monkeypatch.setattr(chat_module.settings, "SSE_DISCONNECT_POLL_SECONDS", 0.01)
+    monkeypatch.setattr(chat_module.settings, "SSE_COALESCE_MS", 0)
+    monkeypatch.setattr(chat_module, "stream_buffers", StreamBufferRegistry(grace_seconds=5, ttl_seconds=5))
+
+    upstream_runs = []
+
+    async def fake_stream_chat_response(full_history):
+        upstream_runs.append(True)
+        for i in range(6):
+            yield f"p{i} "
+            await asyncio.sleep(0.02)
+
+    monkeypatch.setattr(chat_module, "stream_chat_response", fake_stream_chat_response)
+
+    @asynccontextmanager
+    async def fake_session_scope():
+        yield None
+
+    monkeypatch.setattr(chat_module, "async_session_scope", fake_session_scope)
+
+    class FakeHttpRequest:
+        def __init__(self, headers=None):
+            self.headers = headers or {}
+            self.gone = False
+
+        async def is_disconnected(self):
+            return self.gone
+
+    def parse(frames):
+        events = []
+        for frame in frames:
+            lines = dict(line.split(": ", 1) for line in frame.strip().split("\n") if ": " in line)
+            if "id" in lines:
+                events.append((lines["id"], lines["data"]))
+        return events
+
+    user = {"user_id": 5}
+    payload = chat_module.ChatRequest(conversation_id=None, message="hi", history=[{"role": "user", "content": "q"}])
+    first = FakeHttpRequest()
+    response = await chat_module.chat(payload, first, current_user=user)
+    frames = []
+    async for frame in response.body_iterator:
+        frames.append(frame)
+        if len(parse(frames)) == 2:
+            first.gone = True  # connection drops after two content frames
+    received = parse(frames)
+    assert [d for _, d in received] == [json.dumps({"content": "p0 "}), json.dumps({"content": "p1 "})]
+
+    await asyncio.sleep(0.05)  # the generation keeps running while nobody is attached
+    second = FakeHttpRequest({"last-event-id": received[-1][0]})
+    response = await chat_module.chat(payload, second, current_user=user)
+    resumed = parse([f async for f in response.body_iterator])
+    contents = [json.loads(d)["content"] for _, d in resumed[:-1]]
+    assert contents == ["p2 ", "p3 ", "p4 ", "p5 "] and resumed[-1][1] == "[DONE]"
+    assert len(upstream_runs) == 1
+    stats = chat_module.stream_buffers.stats()
+    assert stats["resumes"] == 1 and stats["replayed_frames"] >= 1
+
+    # other users cannot attach to the stream, and unknown ids are rejected
+    with pytest.raises(chat_module.HTTPException) as exc:
+        await chat_module.chat(payload, FakeHttpRequest({"last-event-id": received[-1][0]}), current_user={"user_id": 6})
+    assert exc.value.status_code == 404
+    with pytest.raises(chat_module.HTTPException):
+        await chat_module.chat(payload, FakeHttpRequest({"last-event-id": "nope"}), current_user=user)
+
+
+async def test_identical_concurrent_chats_share_one_upstream_stream(monkeypatch):
+    """A byte-identical first message arriving while the same generation is in flight subscribes to it."""
+    conv_ids = iter([11, 12])
+
+    async def fake_create_conversation_if_not_exists(db, cid):
+        return next(conv_ids)
+
+    fake_conv = type("C", (), {"create_conversation_if_not_exists": staticmethod(fake_create_conversation_if_not_exists)})
+    monkeypatch.setattr(chat_module, "async_conversation", fake_conv)
+
+    saved = []
+
+    class FakeMessageWriter:
+        async def write(self, conversation_id, role, content):
+            saved.append((conversation_id, role, content))
+
+    monkeypatch.setattr(chat_module, "message_writer", FakeMessageWriter())
+    monkeypatch.setattr(chat_module.summary_service, "schedule", lambda conv_id: None)
+    monkeypatch.setattr(chat_module.settings, "SSE_COALESCE_MS", 0)
+    registry = StreamBufferRegistry(grace_seconds=5, ttl_seconds=5)
+    monkeypatch.setattr(chat_module, "stream_buffers", registry)
+
+    upstream_runs = []
+
+    async def fake_stream_chat_response(full_history):
+        upstream_runs.append(full_history)
+        for word in ("shared ", "answer"):
+            yield word
+            await asyncio.sleep(0.03)
+
+    monkeypatch.setattr(chat_module, "stream_chat_response", fake_stream_chat_response)
+
+    @asynccontextmanager
+    async def fake_session_scope():
+        yield None
+
+    monkeypatch.setattr(chat_module, "async_session_scope", fake_session_scope)
+
+    class FakeHttpRequest:
+        headers = {}
+
+        async def is_disconnected(self):
+            return False
+
+    async def read(response):
+        out = []
+        async for frame in response.body_iterator:
+            for line in frame.split("\n"):
+                if line.startswith("data: ") and line != "data: [DONE]":
+                    out.append(json.loads(line[6:])["content"])
+        return "".join(out)
+
+    payload = chat_module.ChatRequest(conversation_id=None, message="What happened?", history=[])
+    first = await chat_module.chat(payload, FakeHttpRequest(), current_user={"user_id": 1})
+    first_reader = asyncio.ensure_future(read(first))
+    await asyncio.sleep(0.04)  # the second request arrives mid-generation
+    second = await chat_module.chat(payload, FakeHttpRequest(), current_user={"user_id": 2})
+    texts = [await first_reader, await read(second)]
+
+    assert texts == ["shared answer", "shared answer"]
+    assert len(upstream_runs) == 1
+    assistant = sorted((c, content) for c, role, content in saved if role == "assistant")
+    assert assistant == [(11, "shared answer"), (12, "shared answer")]
+    assert registry.stats()["fanout"]["recent"][0]["subscribers"] == 2
+
+
+def test_chat_endpoint_rejects_over_the_per_user_cap(monkeypatch):
+    """A user already at the in-flight cap gets a fast 429 with Retry-After, before any DB work."""
+    controller = AdmissionController(max_per_user=1, retry_after=7)
+    controller.admit(3)
+    monkeypatch.setattr(chat_module, "admission_controller", controller)
+
+    @asynccontextmanager
+    async def failing_session_scope():
+        raise AssertionError("rejected requests must not touch the database")
+        yield
+
+    monkeypatch.setattr(chat_module, "async_session_scope", failing_session_scope)
+
+    app = FastAPI()
+    app.include_router(router, prefix="/api/v1")
+    app.dependency_overrides[chat_module.get_current_user] = lambda: {"user_id": 3}
+
+    resp = TestClient(app).post("/api/v1/chat", json={"conversation_id": None, "message": "hi"})
+    assert resp.status_code == 429
+    assert resp.headers["retry-after"] == "7"
+
+
+def test_chat_endpoint_sheds_and_caps_history_under_load(monkeypatch):
+    """Degradation levels: history is capped (summary kept) and the level header is set; the shed level returns 503."""
+    from src.services.degradation import DegradationController
+
+    load = [0.95]
+    controller = DegradationController(
+        thresholds=(0.5, 0.7, 1.0, 1.2), inflight_high=1, inflight_fn=lambda: load[0],
+        history_max_messages=2, sample_interval=0, retry_after=4,
+    )
+    monkeypatch.setattr(chat_module, "degradation_controller", controller)
+
+    async def fake_create_conversation_if_not_exists(db, cid):
+        return 7
+
+    fake_conv = type("C", (), {"create_conversation_if_not_exists": staticmethod(fake_create_conversation_if_not_exists)})
+    monkeypatch.setattr(chat_module, "async_conversation", fake_conv)
+
+    class FakeMessageWriter:
+        async def write(self, conversation_id, role, content):
+            pass
+
+    monkeypatch.setattr(chat_module, "message_writer", FakeMessageWriter())
+    monkeypatch.setattr(chat_module.summary_service, "schedule", lambda cid: None)
+
+    async def fake_load_conversation_context(db, conv_id):
+        return [{"role": "system", "content": "summary"}] + [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": f"m{i}"} for i in range(6)
+        ]
+
+    monkeypatch.setattr(chat_module, "load_conversation_context", fake_load_conversation_context)
+
+    sent = []
+
+    async def fake_stream_chat_response(full_history):
+        sent.append(full_history)
+        yield "ok"
+
+    monkeypatch.setattr(chat_module, "stream_chat_response", fake_stream_chat_response)
+
+    @asynccontextmanager
+    async def fake_session_scope():
+        yield None
+
+    monkeypatch.setattr(chat_module, "async_session_scope", fake_session_scope)
+
+    app = FastAPI()
+    app.include_router(router, prefix="/api/v1")
+    app.dependency_overrides[chat_module.get_current_user] = lambda: {"user_id": 9}
+    client = TestClient(app)
+
+    resp = client.post("/api/v1/chat", json={"conversation_id": 7, "message": "next"})
+    assert resp.status_code == 200
+    assert resp.headers["x-service-level"] == "2"
+    assert [m["content"] for m in sent[0]] == ["summary", "m4", "m5", "next"]
+
+    load[0] = 1.5
+    resp = client.post("/api/v1/chat", json={"conversation_id": 7, "message": "again"})
+    assert resp.status_code == 503
+    assert resp.headers["retry-after"] == "4"
+    assert resp.headers["x-service-level"] == "4"
+    assert len(sent) == 1
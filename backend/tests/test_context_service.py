@@ -0,0 +1,67 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for the bounded context-window loader (src.services.context_service).
+"""
+
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.db.base import Base
+from src.models.conversation import Conversation
+from src.models.message import Message
+from src.models.user import User  # noqa: F401 - register mappers
+from src.services.context_service import estimate_tokens, load_context_window, trim_history
+
+
+@pytest.fixture
+async def db():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+    async with factory() as session:
+        session.add(Conversation(id=1, user_id=1))
+        session.add_all([
+            Message(conversation_id=1, role="user" if i % 2 == 0 else "assistant", content=f"msg-{i:03d}")
+            for i in range(100)
+        ])
+        await session.commit()
+        yield session
+    await engine.dispose()
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcdefgh") == 2
+    assert estimate_tokens("你好世界") == 4
+
+
+async def test_loads_only_newest_messages_in_order(db):
+    window = await load_context_window(db, 1, max_messages=4, max_chars=0, max_tokens=0)
+    assert window == [
+        ("user", "msg-096"), ("assistant", "msg-097"), ("user", "msg-098"), ("assistant", "msg-099"),
+    ]
+
+
+async def test_char_and_token_budgets(db):
+    # each message is 7 characters / 2 estimated tokens
+    assert len(await load_context_window(db, 1, max_messages=50, max_chars=21, max_tokens=0)) == 3
+    assert len(await load_context_window(db, 1, max_messages=50, max_chars=0, max_tokens=4)) == 2
+    assert await load_context_window(db, 1, max_messages=0) == []
+    assert await load_context_window(db, 2, max_messages=10) == []
+
+
+def test_trim_client_history():
+    history = [{"role": "user", "content": "x" * 10} for _ in range(5)]
+    history[-1] = {"role": "assistant", "content": "last"}
+    trimmed = trim_history(history, max_messages=3, max_chars=14, max_tokens=0)
+    assert trimmed == [{"role": "user", "content": "x" * 10}, {"role": "assistant", "content": "last"}]
@@ -0,0 +1,70 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for the connection pool telemetry (src.db.pool_stats) and the shared LatencyHistogram.
+"""
+
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from sqlalchemy import create_engine, exc
+
+from src.common.metrics import LatencyHistogram
+from src.db.pool_stats import PoolStats, TimedQueuePool
+
+
+def test_latency_histogram_percentiles():
+    hist = LatencyHistogram(buckets_ms=(1, 10, 100))
+    assert hist.percentile(50) is None
+    for v in (0.5, 5, 5, 5, 50, 500):
+        hist.observe(v)
+    snap = hist.snapshot()
+    assert snap["count"] == 6
+    assert snap["p50_ms"] == 10
+    assert snap["p99_ms"] == 500  # +Inf bucket reports the observed max
+    assert snap["buckets"] == {"le_1": 1, "le_10": 3, "le_100": 1, "le_inf": 1}
+
+
+def test_pool_stats_records_checkouts_and_timeouts(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'pool.db'}",
+        poolclass=TimedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.05,
+    )
+    stats = PoolStats("test")
+    stats.attach(engine)
+
+    conn = engine.connect()
+    snap = stats.snapshot()
+    assert snap["counters"]["checked_out"] == 1
+    assert snap["live"]["checkedout"] == 1
+
+    # pool exhausted -> timeout is counted
+    with pytest.raises(exc.TimeoutError):
+        engine.connect()
+    conn.close()
+
+    with engine.connect():
+        pass
+
+    snap = stats.snapshot()
+    assert snap["counters"]["timeouts"] == 1
+    assert snap["counters"]["checkouts"] == 2
+    assert snap["counters"]["checked_out"] == 0
+    assert snap["counters"]["peak_checked_out"] == 1
+    assert snap["checkout_wait"]["count"] == 2
+
+    # dispose() recreates the pool; telemetry keeps following it
+    engine.dispose()
+    with engine.connect():
+        pass
+    assert stats.snapshot()["checkout_wait"]["count"] == 3
+    engine.dispose()
@@ -0,0 +1,69 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for the query timing / slow-query log (src.db.query_stats).
+"""
+
+import logging
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.db.base import Base
+from src.db.query_stats import OTHER_FINGERPRINT, QueryStats, normalize_sql
+from src.models.conversation import Conversation  # noqa: F401 - register mappers
+from src.models.message import Message  # noqa: F401
+from src.models.user import User  # noqa: F401
+from src.crud.crud_message import async_get_messages_by_conversation
+
+
+def test_normalize_sql():
+    a = normalize_sql("SELECT * FROM messages WHERE id = 5 AND role = 'user'")
+    b = normalize_sql("SELECT *   FROM messages\n WHERE id = 77 AND role = 'assistant'")
+    assert a == b == "SELECT * FROM messages WHERE id = ? AND role = ?"
+    assert normalize_sql("SELECT x FROM t WHERE id IN (1, 2, 3)") == normalize_sql("SELECT x FROM t WHERE id IN (4, 5)")
+    assert normalize_sql("SELECT x::int FROM t WHERE a = :a_1") == "SELECT x::int FROM t WHERE a = ?"
+
+
+def test_aggregates_and_bounded_fingerprints():
+    stats = QueryStats(slow_query_ms=10_000, max_fingerprints=2)
+    for ms in (1, 2, 3, 4, 100):
+        stats.record("SELECT 1 FROM a WHERE id = 1", ms, rowcount=1)
+    stats.record("SELECT 1 FROM b", 1)
+    stats.record("SELECT 1 FROM c", 1)  # over the cap -> <other>
+
+    snap = stats.snapshot(order_by="count")
+    assert snap["fingerprints"] == 3
+    top = snap["queries"][0]
+    assert top["count"] == 5
+    assert top["total_ms"] == 110
+    assert top["p50_ms"] == 3
+    assert top["p95_ms"] == 100
+    assert top["rows"] == 5
+    assert OTHER_FINGERPRINT in [q["sql"] for q in snap["queries"]]
+    assert snap["slow_queries"] == 0
+
+
+async def test_slow_query_logged_with_crud_caller(caplog):
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    stats = QueryStats(slow_query_ms=0)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    stats.attach(engine.sync_engine)
+
+    session_factory = async_sessionmaker(bind=engine)
+    with caplog.at_level(logging.WARNING, logger="src.db.query_stats"):
+        async with session_factory() as db:
+            await async_get_messages_by_conversation(db, 1)
+    await engine.dispose()
+
+    records = [r.getMessage() for r in caplog.records if "Slow query" in r.getMessage()]
+    assert records
+    assert "caller=src.crud.crud_message.async_get_messages_by_conversation" in records[0]
+    assert "FROM messages" in records[0]
+    assert stats.snapshot()["slow_queries"] >= 1
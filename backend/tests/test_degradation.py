@@ -0,0 +1,152 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for load-adaptive degradation levels (src.services.degradation).
+"""
+
+import asyncio
+import os
+import time
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from src.services.admission import AdmissionRejected
+from src.services.degradation import (
+    LEVEL_CAP_HISTORY, LEVEL_CAP_OUTPUT, LEVEL_NO_TOOLS, LEVEL_NORMAL, LEVEL_SHED,
+    DegradationController, parse_level_thresholds,
+)
+
+
+def _controller(load, **kwargs):
+    """压力只来自 in-flight：inflight_high=100，所以压力 = load[0] / 100"""
+    return DegradationController(
+        thresholds=(0.5, 0.7, 0.9, 1.2), hysteresis=0.1, min_dwell=10, inflight_high=100,
+        inflight_fn=lambda: load[0], sample_interval=0, **kwargs,
+    )
+
+
+def test_parse_level_thresholds():
+    assert parse_level_thresholds("0.75, 0.9,1.0,1.25") == [0.75, 0.9, 1.0, 1.25]
+    with pytest.raises(ValueError):
+        parse_level_thresholds("0.5,0.9")
+    with pytest.raises(ValueError):
+        parse_level_thresholds("0.5,0.4,0.9,1.0")
+
+
+def test_escalates_immediately_and_steps_down_with_hysteresis_and_dwell():
+    load = [10]
+    controller = _controller(load)
+    assert controller.evaluate(now=0) == LEVEL_NORMAL
+
+    load[0] = 95  # 一次跳到 no_tools
+    assert controller.evaluate(now=1) == LEVEL_NO_TOOLS
+
+    # 刚低于阈值但仍在滞回带内（0.85 > 0.9 - 0.1）：不降级
+    load[0] = 85
+    assert controller.evaluate(now=100) == LEVEL_NO_TOOLS
+
+    # 低于滞回带后需要持续 min_dwell 才降一级，且每次只降一级
+    load[0] = 20
+    assert controller.evaluate(now=101) == LEVEL_NO_TOOLS
+    assert controller.evaluate(now=110) == LEVEL_NO_TOOLS
+    assert controller.evaluate(now=111) == LEVEL_CAP_HISTORY
+    assert controller.evaluate(now=112) == LEVEL_CAP_HISTORY
+    assert controller.evaluate(now=121) == LEVEL_CAP_HISTORY  # 计时从上次切换重新开始
+    assert controller.evaluate(now=122) == LEVEL_CAP_OUTPUT
+
+    # 回落过程中压力反弹进入滞回带，计时清零
+    load[0] = 45
+    assert controller.evaluate(now=130) == LEVEL_CAP_OUTPUT
+    load[0] = 20
+    assert controller.evaluate(now=135) == LEVEL_CAP_OUTPUT
+    assert controller.evaluate(now=144) == LEVEL_CAP_OUTPUT
+    assert controller.evaluate(now=145) == LEVEL_NORMAL
+
+    stats = controller.stats()
+    assert stats["transitions"] == 4
+    assert [t["to"] for t in stats["recent_transitions"]] == ["no_tools", "cap_history", "cap_output", "normal"]
+
+
+def test_level_effects_accumulate():
+    load = [0]
+    controller = _controller(load, max_output_tokens=256, history_max_messages=4, retry_after=5)
+    assert controller.model_settings() is None
+    assert controller.history_limit() is None
+    assert controller.tools_enabled()
+    assert controller.headers() == {"X-Service-Level": "0"}
+
+    load[0] = 60
+    assert controller.check_admission() == LEVEL_CAP_OUTPUT
+    assert controller.model_settings() == {"max_tokens": 256}
+    assert controller.history_limit() is None
+
+    load[0] = 80
+    controller.evaluate()
+    assert controller.history_limit() == 4
+    assert controller.tools_enabled()
+
+    load[0] = 100
+    controller.evaluate()
+    assert not controller.tools_enabled()
+    assert controller.model_settings() == {"max_tokens": 256}
+
+    load[0] = 150
+    with pytest.raises(AdmissionRejected) as exc:
+        controller.check_admission()
+    assert exc.value.status_code == 503 and exc.value.headers == {"Retry-After": "5"}
+    assert controller.level == LEVEL_SHED
+    assert controller.headers() == {"X-Service-Level": "4"}
+    assert controller.stats()["shed"] == 1
+
+
+def test_pressure_is_the_worst_signal():
+    sampled_at = time.monotonic()
+    controller = DegradationController(
+        thresholds=(0.5, 0.7, 0.9, 1.2), inflight_high=100, loop_lag_high_ms=100, ttft_high_ms=1000,
+        inflight_fn=lambda: 10, ttft_fn=lambda: [(800, sampled_at), (1500, sampled_at)], alpha=1.0, sample_interval=0,
+    )
+    assert controller.evaluate() == LEVEL_CAP_HISTORY  # ttft 800 / 1000
+    controller.record_loop_lag(95)
+    assert controller.evaluate() == LEVEL_NO_TOOLS
+    assert controller.stats()["signals"]["ratios"] == {"inflight": 0.1, "loop_lag": 0.95, "ttft": 0.8}
+
+
+def test_stale_ttft_does_not_pin_the_shed_level():
+    """shed 时没有新的上游请求，也就没有新的首字延迟样本；过期样本不计入压力，等级能逐级恢复"""
+    controller = DegradationController(
+        thresholds=(0.5, 0.7, 0.9, 1.2), hysteresis=0.1, min_dwell=10, ttft_high_ms=1000, ttft_max_age=30,
+        ttft_fn=lambda: [(5000, 0.0)], sample_interval=0,
+    )
+    assert controller.evaluate(now=1) == LEVEL_SHED
+    assert controller.evaluate(now=30) == LEVEL_SHED  # 样本仍在有效期内
+
+    levels = [controller.evaluate(now=t) for t in range(31, 80)]
+    assert controller.signals["ttft_ms"] is None
+    assert levels[0] == LEVEL_SHED
+    assert levels[-1] == LEVEL_NORMAL
+    assert sorted(set(levels), reverse=True) == [LEVEL_SHED, LEVEL_NO_TOOLS, LEVEL_CAP_HISTORY, LEVEL_CAP_OUTPUT,
+                                                 LEVEL_NORMAL]
+
+
+def test_disabled_controller_stays_normal():
+    controller = DegradationController(enabled=False, inflight_high=1, inflight_fn=lambda: 100)
+    assert controller.check_admission() == LEVEL_NORMAL
+    assert controller.model_settings() is None
+
+
+async def test_monitor_samples_event_loop_lag():
+    controller = DegradationController(sample_interval=0.01, alpha=0.5, loop_lag_high_ms=10_000)
+    controller.start()
+    try:
+        await asyncio.sleep(0.02)
+        time.sleep(0.1)  # 阻塞事件循环
+        await asyncio.sleep(0.03)
+        assert controller.loop_lag_ms > 1
+    finally:
+        await controller.stop()
+    assert controller._task is None
@@ -0,0 +1,61 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for client-disconnect detection on streaming responses (src.services.disconnect_guard).
+"""
+
+import asyncio
+
+import pytest
+
+from src.services.disconnect_guard import ClientDisconnected, DisconnectStats, cancel_on_disconnect
+
+
+async def test_passes_through_when_client_stays():
+    async def source():
+        for i in range(3):
+            yield i
+
+    async def connected():
+        return False
+
+    assert [x async for x in cancel_on_disconnect(source(), connected, poll_interval=0.0)] == [0, 1, 2]
+
+
+async def test_disconnect_while_waiting_for_upstream_cancels_it():
+    state = {"closed": False}
+
+    async def source():
+        try:
+            yield "first"
+            await asyncio.sleep(10)  # e.g. a long tool call
+            yield "never"
+        finally:
+            state["closed"] = True
+
+    checks = []
+
+    async def is_disconnected():
+        checks.append(True)
+        return len(checks) > 1
+
+    received = []
+    with pytest.raises(ClientDisconnected):
+        async for item in cancel_on_disconnect(source(), is_disconnected, poll_interval=0.01):
+            received.append(item)
+    assert received == ["first"]
+    assert state["closed"]
+
+
+def test_stats_estimate_tokens_saved():
+    stats = DisconnectStats(alpha=0.5)
+    assert stats.record_cancelled(10) == 0  # no completed answers yet, nothing to compare against
+    stats.record_completed(100)
+    stats.record_completed(300)
+    assert stats.avg_completion_tokens == 200
+    assert stats.record_cancelled(50) == 150
+    assert stats.record_cancelled(500) == 0
+    snap = stats.snapshot()
+    assert snap["cancelled"] == 3 and snap["estimated_tokens_saved"] == 150
+    assert snap["emitted_tokens_before_cancel"] == 560
@@ -0,0 +1,203 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for hedged LLM streaming requests (src.services.llm_hedging).
+"""
+
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+import src.services.ai_service as ai_service
+from src.common.metrics import SampleWindow
+from src.services.llm_hedging import LLMHedger
+from src.services.llm_router import LLMEndpoint, ProviderRouter
+from src.services.near_dup_cache import NearDuplicateCache
+from src.services.response_cache import ResponseCache
+
+
+class _Upstream:
+    """A fake streaming request that records whether it was closed before finishing."""
+
+    def __init__(self, first_delay, deltas=("a", "b"), error=None):
+        self.first_delay = first_delay
+        self.deltas = deltas
+        self.error = error
+        self.started = False
+        self.closed_early = False
+        self.finished = False
+
+    async def stream(self):
+        self.started = True
+        try:
+            await asyncio.sleep(self.first_delay)
+            if self.error:
+                raise self.error
+            for delta in self.deltas:
+                yield delta
+                await asyncio.sleep(0)
+            self.finished = True
+        finally:
+            if not self.finished and not self.error:
+                self.closed_early = True
+
+
+async def _collect(agen):
+    return [d async for d in agen]
+
+
+async def test_fast_primary_never_hedges():
+    hedger = LLMHedger(enabled=True)
+    primary, hedge = _Upstream(0.0), _Upstream(0.0)
+    out = await _collect(hedger.stream(primary.stream, hedge.stream, delay_ms=50))
+    assert out == ["a", "b"]
+    assert not hedge.started
+    stats = hedger.stats()
+    assert stats["requests"] == 1 and stats["hedged"] == 0 and stats["primary_wins"] == 1
+
+
+async def test_slow_primary_is_hedged_and_cancelled():
+    hedger = LLMHedger(enabled=True)
+    primary, hedge = _Upstream(1.0), _Upstream(0.0, deltas=("x", "y"))
+    out = await asyncio.wait_for(_collect(hedger.stream(primary.stream, hedge.stream, delay_ms=20)), 0.5)
+    assert out == ["x", "y"]
+    assert primary.closed_early  # the loser stops consuming tokens
+    stats = hedger.stats()
+    assert stats["hedged"] == 1 and stats["hedge_wins"] == 1 and stats["cancelled"] == 1
+    assert stats["hedge_rate"] == 1.0
+
+
+async def test_primary_can_still_win_after_hedge_starts():
+    hedger = LLMHedger(enabled=True)
+    primary, hedge = _Upstream(0.03), _Upstream(1.0)
+    out = await asyncio.wait_for(_collect(hedger.stream(primary.stream, hedge.stream, delay_ms=10)), 0.5)
+    assert out == ["a", "b"]
+    assert hedge.started and hedge.closed_early
+    assert hedger.stats()["primary_wins"] == 1 and hedger.stats()["hedge_wins"] == 0
+
+
+async def test_early_primary_failure_hedges_immediately():
+    hedger = LLMHedger(enabled=True)
+    primary, hedge = _Upstream(0.0, error=RuntimeError("boom")), _Upstream(0.0)
+    out = await asyncio.wait_for(_collect(hedger.stream(primary.stream, hedge.stream, delay_ms=10_000)), 0.5)
+    assert out == ["a", "b"]
+    assert hedger.stats()["hedge_wins"] == 1
+
+    failing = LLMHedger(enabled=True)
+    with pytest.raises(RuntimeError, match="second"):
+        await _collect(failing.stream(
+            _Upstream(0.0, error=RuntimeError("first")).stream,
+            _Upstream(0.0, error=RuntimeError("second")).stream,
+            delay_ms=10,
+        ))
+    assert failing.stats()["failures"] == 1
+
+
+def test_delay_uses_ttft_percentile_within_bounds():
+    hedger = LLMHedger(percentile=95, default_delay_ms=1500, min_delay_ms=100, max_delay_ms=3000, min_samples=10)
+    assert hedger.delay_ms(None) == 1500
+    window = SampleWindow(size=100)
+    for _ in range(5):
+        window.observe(400)
+    assert hedger.delay_ms(window) == 1500  # too few samples
+    for _ in range(20):
+        window.observe(400)
+    assert hedger.delay_ms(window) == 400
+    # the real p95 is used, not a histogram bucket's upper bound (1100 would round up to 2500)
+    for ms in range(1, 101):
+        window.observe(1000 + ms)
+    assert hedger.delay_ms(window) == 1095
+    for _ in range(100):
+        window.observe(60_000)
+    assert hedger.delay_ms(window) == 3000
+
+
+class _StubRouter(ProviderRouter):
+    def model_for(self, endpoint):
+        return endpoint.name
+
+
+class _StubEndpointsAgent:
+    def __init__(self, delays):
+        self.delays = delays
+        self.calls = []
+        self.aborted = []
+
+    def run_stream(self, prompt, model=None, **kwargs):
+        self.calls.append(model)
+        delay, aborted = self.delays[model], self.aborted
+
+        class _Result:
+            async def stream_text(self, **kw):
+                try:
+                    await asyncio.sleep(delay)
+                    yield f"from {model}"
+                except asyncio.CancelledError:
+                    aborted.append(model)
+                    raise
+
+        class _Ctx:
+            async def __aenter__(self):
+                return _Result()
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return _Ctx()
+
+
+async def test_stream_chat_response_hedges_to_alternate_endpoint(monkeypatch):
+    endpoints = [LLMEndpoint(name=n, base_url=f"http://{n}.local/v1", api_key="k", model_name="m") for n in ("stuck", "ok")]
+    router = _StubRouter(endpoints)
+    agent = _StubEndpointsAgent({"stuck": 5.0, "ok": 0.0})
+    hedger = LLMHedger(enabled=True, default_delay_ms=20, min_delay_ms=1)
+    monkeypatch.setattr(ai_service, "provider_router", router)
+    monkeypatch.setattr(ai_service, "text_agent", agent)
+    monkeypatch.setattr(ai_service, "llm_hedger", hedger)
+    monkeypatch.setattr(ai_service.settings, "CHAT_OUTPUT_MODE", "text")
+    monkeypatch.setattr(ai_service, "response_cache", ResponseCache(enabled=False))
+    monkeypatch.setattr(ai_service, "near_dup_cache", NearDuplicateCache(enabled=False))
+
+    # the first pick is the unprobed "stuck" endpoint; the hedge goes to "ok"
+    out = await asyncio.wait_for(
+        _collect(ai_service.stream_chat_response([{"role": "user", "content": "hi"}])), 1.0)
+    assert "".join(out) == "from ok"
+    assert agent.calls == ["stuck", "ok"] and agent.aborted == ["stuck"]
+    assert hedger.stats()["hedge_wins"] == 1
+    assert all(e["in_flight"] == 0 for e in router.stats()["endpoints"])
+    assert router.stats()["endpoints"][0]["errors"] == 0  # a cancelled loser is not a failure
+
+
+async def test_real_agent_streams_are_iterated_in_their_own_tasks(real_pydantic_ai):
+    """pydantic-ai 的 run_stream 不能跨任务迭代：主请求胜出、对冲请求胜出与落败者被取消时都不能报 cancel scope 错误"""
+
+    def agent_with(first_delay):
+        async def stream_function(messages, info):
+            await asyncio.sleep(first_delay)
+            for word in ["Hel", "lo"]:
+                yield word
+                await asyncio.sleep(0.005)
+
+        return real_pydantic_ai.Agent(real_pydantic_ai.FunctionModel(stream_function=stream_function))
+
+    def answer(agent):
+        async def run():
+            async with agent.run_stream("hi") as result:
+                async for delta in result.stream_text(delta=True, debounce_by=None):
+                    yield delta
+
+        return run
+
+    fast, slow = agent_with(0.0), agent_with(1.0)
+    hedger = LLMHedger(enabled=True)
+    assert "".join(await _collect(hedger.stream(answer(fast), answer(slow), delay_ms=500))) == "Hello"
+    out = await asyncio.wait_for(_collect(hedger.stream(answer(slow), answer(fast), delay_ms=20)), 0.5)
+    assert "".join(out) == "Hello"
+    assert hedger.stats()["primary_wins"] == 1 and hedger.stats()["hedge_wins"] == 1
+    assert hedger.stats()["cancelled"] == 1
@@ -0,0 +1,79 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for the shared LLM provider registry and connection reuse statistics (src.services.llm_providers).
+"""
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from src.services.llm_providers import ProviderRegistry
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"ok"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def local_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+async def test_shared_client_reuses_connections(local_server):
+    registry = ProviderRegistry(max_connections=4, max_keepalive_connections=2, keepalive_expiry=30)
+    client = registry.http_client
+    assert registry.http_client is client
+
+    for _ in range(3):
+        resp = await client.get(f"{local_server}/v1/models")
+        assert resp.status_code == 200
+
+    conns = registry.stats()["connections"]
+    assert conns["requests"] == 3
+    assert conns["new_connections"] == 1
+    assert conns["reused_connections"] == 2
+    assert conns["tls_handshakes"] == 0
+    assert conns["connect_latency"]["count"] == 1
+
+    await registry.aclose()
+    assert client.is_closed
+    assert registry.http_client is not client  # recreated on demand after close
+    await registry.aclose()
+
+
+async def test_providers_and_models_are_shared():
+    registry = ProviderRegistry(connect_timeout=1.5, read_timeout=30)
+    p1 = registry.get_provider("https://api.one.local/v1", "k")
+    p2 = registry.get_provider("https://api.one.local/v1", "k")
+    p3 = registry.get_provider("https://api.two.local/v1", "k")
+    assert p1 is p2 and p1 is not p3
+
+    m1 = registry.get_model("chat-model", "https://api.one.local/v1", "k")
+    assert registry.get_model("chat-model", "https://api.one.local/v1", "k") is m1
+    stats = registry.stats()
+    assert stats["providers"] == 2 and stats["models"] == 1
+    assert registry.timeout.connect == 1.5 and registry.timeout.read == 30
+    await registry.aclose()
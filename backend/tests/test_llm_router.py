@@ -0,0 +1,173 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for the latency-aware LLM endpoint router (src.services.llm_router).
+"""
+
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+import src.services.ai_service as ai_service
+import src.services.llm_router as llm_router
+from src.services.llm_router import LLMEndpoint, ProviderRouter, parse_endpoints
+from src.services.near_dup_cache import NearDuplicateCache
+from src.services.response_cache import ResponseCache
+
+
+def _endpoints(*names, **weights):
+    return [LLMEndpoint(name=n, base_url=f"http://{n}.local/v1", api_key="k", model_name="m",
+                        weight=weights.get(n, 1.0)) for n in names]
+
+
+def test_parse_endpoints_from_ai_provider_and_json():
+    [ep] = parse_endpoints("", "deepseek:deepseek-chat", None, "key")
+    assert (ep.name, ep.base_url, ep.model_name, ep.api_key) == ("deepseek", "https://api.deepseek.com", "deepseek-chat", "key")
+    [ep] = parse_endpoints("", "openai", "https://proxy.local/v1", "key")
+    assert ep.base_url == "https://proxy.local/v1" and ep.model_name == "gpt-4o-mini"
+    with pytest.raises(ValueError):
+        parse_endpoints("", "unknown", None, "key")
+
+    eps = parse_endpoints(
+        '[{"name": "a", "base_url": "http://a/v1", "model": "m1", "weight": 2},'
+        ' {"base_url": "http://b/v1", "model": "m2", "api_key": "other"}]',
+        "deepseek", None, "key",
+    )
+    assert [e.name for e in eps] == ["a", "endpoint-1"]
+    assert eps[0].weight == 2.0 and eps[0].api_key == "key" and eps[1].api_key == "other"
+
+
+def test_least_latency_prefers_fast_and_explores_unknown():
+    router = ProviderRouter(_endpoints("slow", "fast", "new"))
+    slow, fast, new = router.endpoints
+    router.record_ttft(slow, 900)
+    router.record_ttft(fast, 100)
+    assert router.choose() is new  # no samples yet -> probed first
+    router.record_ttft(new, 400)
+    assert router.choose() is fast
+    fast.in_flight = 5  # 100 * 6 > 400 * 1
+    assert router.choose() is new
+    assert router.choose(exclude=[new]) is fast
+
+
+def test_recovered_endpoint_wins_traffic_back_after_stale_probe(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(llm_router.time, "monotonic", lambda: clock[0])
+    router = ProviderRouter(_endpoints("a", "b"), ttft_stale_seconds=30)
+    a, b = router.endpoints
+    router.record_ttft(a, 5000)  # a had a bad spell
+    router.record_ttft(b, 800)
+
+    # b keeps serving and stays fresh; a gets no traffic, so its EWMA is not updated
+    for _ in range(5):
+        clock[0] += 5
+        assert router.choose() is b
+        router.record_ttft(b, 800)
+    assert a.ewma_ttft_ms == 5000
+
+    # a's sample is now stale: it gets a single probe (not while the probe is in flight)
+    clock[0] += 10
+    router.record_ttft(b, 800)
+    assert router.choose() is a
+    router.begin(a)
+    assert router.choose() is b
+    router.record_ttft(a, 300)  # recovered: the fresh sample replaces the stale EWMA
+    router.end(a)
+    assert a.ewma_ttft_ms == 300
+    assert router.choose() is a
+
+    # a fresh slow sample is blended as usual, and b wins again
+    router.record_ttft(a, 3000)
+    router.record_ttft(a, 3000)
+    assert a.ewma_ttft_ms > 800
+    assert router.choose() is b
+
+
+def test_failures_trigger_cooldown_and_recovery(monkeypatch):
+    router = ProviderRouter(_endpoints("a", "b"), cooldown_seconds=10)
+    a, b = router.endpoints
+    router.record_ttft(a, 50)
+    router.record_ttft(b, 500)
+    router.record_failure(a)
+    assert router.choose() is a  # one failure is tolerated
+    router.record_failure(a)
+    assert router.choose() is b
+    assert router.stats()["endpoints"][0]["healthy"] is False
+
+    # every endpoint cooling down -> pick the one that recovers first instead of failing
+    router.record_failure(b)
+    router.record_failure(b)
+    assert router.choose() is a
+
+    real = llm_router.time.monotonic
+    monkeypatch.setattr(llm_router.time, "monotonic", lambda: real() + 11)
+    assert router.choose() is a
+    router.record_success(a)
+    assert a.consecutive_failures == 0 and a.ewma_error < 0.51
+
+
+def test_weighted_strategy_respects_weights():
+    router = ProviderRouter(_endpoints("heavy", "light", heavy=9.0), strategy="weighted")
+    picks = [router.choose().name for _ in range(2000)]
+    assert 0.8 < picks.count("heavy") / len(picks) < 0.97
+
+
+class _StubRouter(ProviderRouter):
+    """Models are the endpoint names, so the fake agent can act as a set of local stub endpoints."""
+
+    def model_for(self, endpoint):
+        return endpoint.name
+
+
+class _StubEndpointsAgent:
+    def __init__(self, behaviour):
+        self.behaviour = behaviour  # endpoint name -> (delay_s, error)
+        self.calls = []
+
+    def run_stream(self, prompt, model=None, **kwargs):
+        self.calls.append(model)
+        delay, error = self.behaviour[model]
+
+        class _Result:
+            async def stream_text(self, **kw):
+                await asyncio.sleep(delay)
+                if error:
+                    raise RuntimeError(f"{model} failed")
+                yield f"from {model}"
+
+        class _Ctx:
+            async def __aenter__(self):
+                return _Result()
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return _Ctx()
+
+
+async def test_stream_chat_response_routes_around_slow_and_failing_endpoints(monkeypatch):
+    router = _StubRouter(_endpoints("broken", "slow", "fast"), cooldown_seconds=60)
+    agent = _StubEndpointsAgent({"broken": (0, True), "slow": (0.05, False), "fast": (0.0, False)})
+    monkeypatch.setattr(ai_service, "provider_router", router)
+    monkeypatch.setattr(ai_service, "text_agent", agent)
+    monkeypatch.setattr(ai_service.settings, "CHAT_OUTPUT_MODE", "text")
+    monkeypatch.setattr(ai_service, "response_cache", ResponseCache(enabled=False))
+    monkeypatch.setattr(ai_service, "near_dup_cache", NearDuplicateCache(enabled=False))
+
+    async def ask():
+        return "".join([d async for d in ai_service.stream_chat_response([{"role": "user", "content": "hi"}])])
+
+    outputs = [await ask() for _ in range(8)]
+    assert outputs[-1] == "from fast"
+    assert agent.calls.count("broken") == 2  # probed, then put into cooldown
+    assert agent.calls[-3:] == ["fast", "fast", "fast"]
+    stats = {e["name"]: e for e in router.stats()["endpoints"]}
+    assert stats["broken"]["healthy"] is False and stats["broken"]["errors"] == 2
+    assert stats["slow"]["ewma_ttft_ms"] > stats["fast"]["ewma_ttft_ms"]
+    assert all(e["in_flight"] == 0 for e in stats.values())
@@ -0,0 +1,92 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for the write-behind message writer (src.services.message_writer).
+
+- Uses an in-memory aiosqlite database and passes its own session scope to MessageWriter.
+"""
+
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.db.base import Base
+from src.models.conversation import Conversation
+from src.models.message import Message
+from src.models.user import User  # noqa: F401 - register mappers
+from src.services.message_writer import MODE_ACK, MODE_ASYNC, MessageWriter
+
+
+@pytest.fixture
+async def session_scope():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+    async with factory() as db:
+        db.add_all([Conversation(id=1, user_id=1), Conversation(id=2, user_id=1)])
+        await db.commit()
+
+    @asynccontextmanager
+    async def scope():
+        async with factory() as db:
+            yield db
+
+    yield scope
+    await engine.dispose()
+
+
+async def _contents(scope):
+    async with scope() as db:
+        rows = await db.execute(select(Message.conversation_id, Message.role, Message.content).order_by(Message.id))
+        return [tuple(r) for r in rows]
+
+
+async def test_concurrent_writes_are_batched(session_scope):
+    writer = MessageWriter(session_scope=session_scope, mode=MODE_ACK, batch_size=50, flush_interval_ms=20)
+    await asyncio.gather(*[writer.write(1 + i % 2, "user", f"m{i}") for i in range(40)])
+
+    stats = writer.stats()
+    assert stats["written"] == 40
+    assert stats["batches"] < 40  # far fewer commits than messages
+    assert len(await _contents(session_scope)) == 40
+    await writer.drain()
+
+
+async def test_failed_row_is_isolated(session_scope):
+    writer = MessageWriter(session_scope=session_scope, mode=MODE_ACK, batch_size=10, flush_interval_ms=20)
+    results = await asyncio.gather(
+        writer.write(1, "user", "ok-1"),
+        writer.write(1, "assistant", None),  # NOT NULL violation
+        writer.write(2, "user", "ok-2"),
+        return_exceptions=True,
+    )
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], Exception)
+    assert [c for _, _, c in await _contents(session_scope)] == ["ok-1", "ok-2"]
+    assert writer.stats()["failed"] == 1
+    await writer.drain()
+
+
+async def test_async_mode_drain_flushes_queue(session_scope):
+    writer = MessageWriter(session_scope=session_scope, mode=MODE_ASYNC, batch_size=100, flush_interval_ms=1000)
+    for i in range(5):
+        await writer.write(1, "user", f"m{i}")  # returns immediately
+    await writer.drain()
+    assert len(await _contents(session_scope)) == 5
+
+
+async def test_invalid_role_rejected(session_scope):
+    writer = MessageWriter(session_scope=session_scope)
+    with pytest.raises(ValueError):
+        await writer.write(1, "robot", "x")
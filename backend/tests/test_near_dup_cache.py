@@ -0,0 +1,119 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for the MinHash/LSH near-duplicate prompt cache (src.services.near_dup_cache).
+"""
+
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+import numpy as np
+
+import src.services.ai_service as ai_service
+import src.services.near_dup_cache as ndc
+from src.services.near_dup_cache import MinHasher, NearDuplicateCache, normalize_prompt
+from src.services.response_cache import ResponseCache
+
+QUESTION = "How do I reset my password if I no longer have access to my email account?"
+
+
+def test_normalize_prompt():
+    assert normalize_prompt("  How do I RESET my password?!\n") == "how do i reset my password"
+
+
+def test_signature_similarity_tracks_jaccard():
+    hasher = MinHasher(num_perm=128)
+    a = hasher.signature(normalize_prompt(QUESTION))
+    b = hasher.signature(normalize_prompt(QUESTION.replace("?", "??").replace("  ", " ")))
+    c = hasher.signature(normalize_prompt("What is the weather like in Paris tomorrow afternoon?"))
+    assert a.dtype == np.uint32 and a.shape == (128,)
+    assert (a == b).mean() == 1.0
+    assert (a == c).mean() < 0.2
+
+
+def test_lookup_hits_near_duplicates_only():
+    cache = NearDuplicateCache(threshold=0.8)
+    cache.add(QUESTION, "Use the account recovery form.")
+
+    hit = cache.lookup("how do i reset my password if i no longer have access to my email account")
+    assert hit is not None and hit[0] == "Use the account recovery form." and hit[1] == 1.0
+    hit = cache.lookup("How can I reset my password if I no longer have access to my email account?")
+    assert hit is not None and hit[1] >= 0.8
+    assert cache.lookup("What is the weather like in Paris tomorrow afternoon?") is None
+    stats = cache.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 1
+
+
+def test_numbers_must_match():
+    cache = NearDuplicateCache(threshold=0.5)
+    cache.add("Please calculate what 2 + 2 equals for me", "4")
+    assert cache.lookup("Please calculate what 2 + 3 equals for me") is None
+    assert cache.lookup("please calculate what 2 + 2 equals for me!") is not None
+
+
+def test_scope_must_match():
+    cache = NearDuplicateCache(threshold=0.8)
+    cache.add(QUESTION, "from model a", scope="model-a|text")
+    assert cache.lookup(QUESTION, scope="model-b|text") is None
+    assert cache.lookup(QUESTION) is None
+    assert cache.lookup(QUESTION, scope="model-a|text")[0] == "from model a"
+
+
+def test_bounded_with_lru_eviction_and_ttl(monkeypatch):
+    cache = NearDuplicateCache(max_entries=2, threshold=0.9)
+    cache.add("first prompt about databases and indexes", "1")
+    cache.add("second prompt about gardening and tomatoes", "2")
+    assert cache.lookup("first prompt about databases and indexes") is not None  # touch first
+    cache.add("third prompt about astronomy and telescopes", "3")  # evicts second
+    assert len(cache) == 2
+    assert cache.stats()["evictions"] == 1
+    assert cache.lookup("second prompt about gardening and tomatoes") is None
+    assert cache.lookup("third prompt about astronomy and telescopes")[0] == "3"
+    # evicted slots are unlinked from every bucket
+    assert sum(len(h) for h in cache._heads) <= 2 * cache.bands
+
+    real_time = ndc.time.time
+    monkeypatch.setattr(ndc.time, "time", lambda: real_time() + cache.ttl + 1)
+    assert cache.lookup("third prompt about astronomy and telescopes") is None
+    assert len(cache) == 1
+
+
+class _Agent:
+    def __init__(self):
+        self.calls = 0
+
+    def run_stream(self, prompt, **kwargs):
+        self.calls += 1
+
+        class _Result:
+            async def stream_text(self, **kwargs):
+                yield "Use the account recovery form."
+
+        class _Ctx:
+            async def __aenter__(self):
+                return _Result()
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return _Ctx()
+
+
+async def test_stream_chat_response_uses_near_duplicate_answer(monkeypatch):
+    agent = _Agent()
+    monkeypatch.setattr(ai_service, "text_agent", agent)
+    monkeypatch.setattr(ai_service.settings, "CHAT_OUTPUT_MODE", "text")
+    monkeypatch.setattr(ai_service, "response_cache", ResponseCache())
+    monkeypatch.setattr(ai_service, "near_dup_cache", NearDuplicateCache(threshold=0.8))
+
+    async def ask(text):
+        return "".join([d async for d in ai_service.stream_chat_response([{"role": "user", "content": text}])])
+
+    assert await ask(QUESTION) == "Use the account recovery form."
+    assert await ask(QUESTION.replace("How do I", "how do i").rstrip("?") + "!!") == "Use the account recovery form."
+    assert agent.calls == 1
+    assert ai_service.near_dup_cache.stats()["hits"] == 1
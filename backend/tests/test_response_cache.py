@@ -0,0 +1,230 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for the exact-match LLM response cache (src.services.response_cache).
+"""
+
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+import pytest
+
+import src.services.ai_service as ai_service
+import src.services.response_cache as rc
+from src.services.llm_router import LLMEndpoint, ProviderRouter
+from src.services.near_dup_cache import NearDuplicateCache
+from src.services.response_cache import ResponseCache, cache_key, replay_chunks
+
+
+@pytest.fixture(autouse=True)
+def _no_near_dup_cache(monkeypatch):
+    monkeypatch.setattr(ai_service, "near_dup_cache", NearDuplicateCache(enabled=False))
+
+
+def test_cache_key_normalizes_whitespace_and_includes_model_and_prompt():
+    a = cache_key([{"role": "user", "content": "  How do I   reset my password?\n"}], "m", "sys")
+    b = cache_key([{"role": "user", "content": "How do I reset my password?"}], "m", "sys")
+    assert a == b
+    assert a != cache_key([{"role": "user", "content": "How do I reset my password?"}], "other", "sys")
+    assert a != cache_key([{"role": "user", "content": "How do I reset my password?"}], "m", "other")
+
+
+def test_replay_chunks_roundtrip():
+    text = "x" * 70 + "中文"
+    assert "".join(replay_chunks(text, chunk_size=32)) == text
+    assert len(list(replay_chunks(text, chunk_size=32))) == 3
+
+
+def test_policy_excludes_history():
+    cache = ResponseCache()
+    single = [{"role": "user", "content": "hi"}]
+    assert cache.is_cacheable(single)
+    assert not cache.is_cacheable([{"role": "assistant", "content": "a"}] + single)
+    assert cache.stats()["bypassed"] == 1
+    assert ResponseCache(allow_history=True).is_cacheable([{"role": "system", "content": "s"}] + single)
+    assert not ResponseCache(enabled=False).is_cacheable(single)
+
+
+async def test_lru_ttl_and_byte_limits(monkeypatch):
+    cache = ResponseCache(max_entries=2, ttl_seconds=10)
+    await cache.set("a", "A")
+    await cache.set("b", "B")
+    assert await cache.get("a") == "A"  # a becomes most recently used
+    await cache.set("c", "C")  # evicts b
+    assert await cache.get("b") is None
+    assert await cache.get("c") == "C"
+
+    real_time = rc.time.time
+    monkeypatch.setattr(rc.time, "time", lambda: real_time() + 11)
+    assert await cache.get("a") is None  # expired
+
+    small = ResponseCache(max_bytes=4)
+    await small.set("k1", "abc")
+    await small.set("k2", "de")  # 5 bytes > 4 -> k1 evicted
+    assert await small.get("k1") is None
+    assert small.stats()["bytes"] == 2
+
+    stats = cache.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 2 and stats["evictions"] == 1
+
+
+async def test_disk_tier(tmp_path):
+    first = ResponseCache(disk_dir=str(tmp_path))
+    await first.set("key", "cached answer")
+
+    second = ResponseCache(disk_dir=str(tmp_path))  # e.g. after a restart
+    assert await second.get("key") == "cached answer"
+    assert second.stats()["disk_hits"] == 1
+    assert await second.get("key") == "cached answer"  # now served from memory
+    assert second.stats()["disk_hits"] == 1
+
+
+class _TextResult:
+    def __init__(self, deltas):
+        self.deltas = deltas
+
+    async def stream_text(self, **kwargs):
+        for d in self.deltas:
+            if isinstance(d, Exception):
+                raise d
+            yield d
+
+
+class _Agent:
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.calls = 0
+
+    def run_stream(self, prompt, **kwargs):
+        self.calls += 1
+        result = _TextResult(self.deltas)
+
+        class _Ctx:
+            async def __aenter__(self):
+                return result
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return _Ctx()
+
+
+async def _collect(messages):
+    return [d async for d in ai_service.stream_chat_response(messages)]
+
+
+async def test_stream_chat_response_replays_cached_answer(monkeypatch):
+    agent = _Agent(["Hello", " there"])
+    monkeypatch.setattr(ai_service, "text_agent", agent)
+    monkeypatch.setattr(ai_service.settings, "CHAT_OUTPUT_MODE", "text")
+    monkeypatch.setattr(ai_service, "response_cache", ResponseCache())
+
+    messages = [{"role": "user", "content": "What is this?"}]
+    assert "".join(await _collect(messages)) == "Hello there"
+    assert "".join(await _collect([{"role": "user", "content": "What  is this? "}])) == "Hello there"
+    assert agent.calls == 1
+    assert ai_service.response_cache.stats()["hits"] == 1
+
+    # with history the request bypasses the cache
+    await _collect([{"role": "assistant", "content": "earlier"}] + messages)
+    assert agent.calls == 2
+
+
+async def test_failed_generation_is_not_cached(monkeypatch):
+    agent = _Agent(["partial", RuntimeError("boom")])
+    monkeypatch.setattr(ai_service, "text_agent", agent)
+    monkeypatch.setattr(ai_service.settings, "CHAT_OUTPUT_MODE", "text")
+    monkeypatch.setattr(ai_service, "response_cache", ResponseCache())
+
+    messages = [{"role": "user", "content": "fails"}]
+    assert await _collect(messages) == ["partial", "请求失败: boom"]
+    assert ai_service.response_cache.stats()["stores"] == 0
+    await _collect(messages)
+    assert agent.calls == 2
+
+
+class _ModelAgent:
+    """按路由到的模型返回不同的回答"""
+
+    def __init__(self):
+        self.calls = []
+
+    def run_stream(self, prompt, model=None, **kwargs):
+        self.calls.append(model)
+        return _Agent([f"answer from {model}"]).run_stream(prompt)
+
+
+class _PinnedRouter(ProviderRouter):
+    """总是选择 pinned 指向的端点"""
+
+    def __init__(self, endpoints):
+        super().__init__(endpoints)
+        self.pinned = endpoints[0]
+
+    def choose(self, exclude=()):
+        return self.pinned
+
+    def model_for(self, endpoint):
+        return endpoint.model_name
+
+
+async def test_cached_answers_are_scoped_to_the_routed_model(monkeypatch):
+    endpoints = [LLMEndpoint(name=n, base_url=f"http://{n}.local/v1", api_key="k", model_name=f"model-{n}")
+                 for n in ("a", "b")]
+    router = _PinnedRouter(endpoints)
+    agent = _ModelAgent()
+    monkeypatch.setattr(ai_service, "provider_router", router)
+    monkeypatch.setattr(ai_service, "text_agent", agent)
+    monkeypatch.setattr(ai_service.settings, "CHAT_OUTPUT_MODE", "text")
+    monkeypatch.setattr(ai_service, "response_cache", ResponseCache())
+    monkeypatch.setattr(ai_service, "near_dup_cache", NearDuplicateCache())
+
+    messages = [{"role": "user", "content": "Which model are you?"}]
+    assert "".join(await _collect(messages)) == "answer from model-a"
+    router.pinned = endpoints[1]
+    assert "".join(await _collect(messages)) == "answer from model-b"
+    assert "".join(await _collect(messages)) == "answer from model-b"  # cached under model-b
+    router.pinned = endpoints[0]
+    assert "".join(await _collect(messages)) == "answer from model-a"
+    assert agent.calls == ["model-a", "model-b"]
+
+
+async def test_answers_capped_by_degradation_are_not_cached(monkeypatch):
+    """负载降级限制了最大输出 token 时回答可能被截断，负载恢复后不能继续回放"""
+    from src.services.degradation import DegradationController
+
+    load = [1.0]
+    controller = DegradationController(thresholds=(0.5, 0.7, 0.9, 1.2), inflight_high=1, min_dwell=0,
+                                       inflight_fn=lambda: load[0], max_output_tokens=8, sample_interval=0)
+    controller.evaluate()
+    seen_settings = []
+
+    class _RecordingAgent(_Agent):
+        def run_stream(self, prompt, **kwargs):
+            seen_settings.append(kwargs.get("model_settings"))
+            return super().run_stream(prompt, **kwargs)
+
+    agent = _RecordingAgent(["truncated"])
+    monkeypatch.setattr(ai_service, "degradation_controller", controller)
+    monkeypatch.setattr(ai_service, "text_agent", agent)
+    monkeypatch.setattr(ai_service.settings, "CHAT_OUTPUT_MODE", "text")
+    monkeypatch.setattr(ai_service, "response_cache", ResponseCache())
+
+    messages = [{"role": "user", "content": "Tell me everything"}]
+    await _collect(messages)
+    assert seen_settings == [{"max_tokens": 8}]
+    assert ai_service.response_cache.stats()["stores"] == 0
+
+    load[0] = 0.0
+    controller.evaluate()
+    controller.evaluate()
+    controller.evaluate()
+    assert controller.model_settings() is None
+    await _collect(messages)
+    await _collect(messages)
+    assert seen_settings == [{"max_tokens": 8}, None]
+    assert ai_service.response_cache.stats()["stores"] == 1
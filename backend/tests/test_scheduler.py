@@ -0,0 +1,99 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for weighted fair queuing of upstream slots (src.services.scheduler) and its use by admission control.
+"""
+
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from src.services.admission import AdmissionController
+from src.services.scheduler import FairScheduler, parse_class_weights
+
+
+def _drain(scheduler):
+    out = []
+    while True:
+        item = scheduler.pop()
+        if item is None:
+            return out
+        out.append(item)
+
+
+def test_parse_class_weights():
+    assert parse_class_weights("interactive:8, agent:3") == {"interactive": 8.0, "agent": 3.0, "batch": 1.0}
+    assert parse_class_weights("") == {"interactive": 1.0, "agent": 1.0, "batch": 1.0}
+    with pytest.raises(ValueError):
+        parse_class_weights("vip:10")
+
+
+def test_users_within_a_class_are_served_round_robin():
+    scheduler = FairScheduler()
+    for i in range(5):
+        scheduler.push(f"heavy{i}", "heavy", "interactive")
+    scheduler.push("light0", "light", "interactive")
+    scheduler.push("light1", "light", "interactive")
+    assert _drain(scheduler) == ["heavy0", "light0", "heavy1", "light1", "heavy2", "heavy3", "heavy4"]
+
+    scheduler = FairScheduler(quantum=2)
+    for i in range(3):
+        scheduler.push(f"a{i}", "a", "batch")
+        scheduler.push(f"b{i}", "b", "batch")
+    assert _drain(scheduler) == ["a0", "a1", "b0", "b1", "a2", "b2"]
+
+
+def test_classes_share_slots_by_weight_without_starvation():
+    scheduler = FairScheduler(parse_class_weights("interactive:8,agent:3,batch:1"))
+    for i in range(40):
+        for klass in ("batch", "agent", "interactive"):
+            scheduler.push((klass, i), f"user{i}", klass)
+    first = [klass for klass, _ in _drain(scheduler)[:24]]
+    assert first.count("interactive") == 16 and first.count("agent") == 6 and first.count("batch") == 2
+    assert first[0] == "interactive"
+
+
+def test_idle_class_cannot_bank_credit():
+    scheduler = FairScheduler(parse_class_weights("interactive:1,agent:1,batch:1"))
+    for i in range(10):
+        scheduler.push(("interactive", i), "u", "interactive")
+    for _ in range(6):
+        scheduler.pop()
+    for i in range(4):
+        scheduler.push(("batch", i), "v", "batch")
+    nxt = [k for k, _ in _drain(scheduler)[:4]]
+    # batch joins at the current virtual time and alternates instead of taking the next six slots
+    assert nxt.count("batch") == 2
+
+
+async def test_admission_hands_slots_to_interactive_before_batch():
+    controller = AdmissionController(
+        max_per_user=0, max_global=1, max_queue=50, queue_timeout=2,
+        scheduler=FairScheduler(parse_class_weights("interactive:8,agent:3,batch:1")),
+    )
+    held = controller.admit("x")
+    await held.acquire_upstream("agent")
+    order = []
+
+    async def run(user, klass):
+        lease = controller.admit(user)
+        await lease.acquire_upstream(klass)
+        order.append(klass)
+        await asyncio.sleep(0)
+        lease.release()
+
+    tasks = [asyncio.ensure_future(run("bulk", "batch")) for _ in range(6)]
+    await asyncio.sleep(0.01)
+    tasks += [asyncio.ensure_future(run(f"chat{i}", "interactive")) for i in range(3)]
+    await asyncio.sleep(0.01)
+    held.release()
+    await asyncio.gather(*tasks)
+    assert order[:3] == ["interactive"] * 3
+    stats = controller.stats()["classes"]
+    assert stats["batch"]["dispatched"] == 6 and stats["interactive"]["queue_delay"]["count"] == 3
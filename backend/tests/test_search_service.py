@@ -0,0 +1,290 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for the web search result cache with single-flight (src.services.search_service).
+"""
+
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+import src.services.search_service as search_service
+from src.services.search_service import SearchCache, normalize_query
+
+
+def _fetcher(calls, results=None, delay=0.0, error=None):
+    async def fetch():
+        calls.append(1)
+        if delay:
+            await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return results if results is not None else [{"title": "t", "url": "u", "snippet": "s"}]
+
+    return fetch
+
+
+def test_normalize_query():
+    assert normalize_query("  Today's   WEATHER in\tParis ") == "today's weather in paris"
+
+
+async def test_hit_after_miss_keyed_on_query_and_max_results():
+    cache = SearchCache(ttl_seconds=60)
+    calls = []
+    await cache.get_or_fetch("Weather Paris", 5, _fetcher(calls))
+    await cache.get_or_fetch("weather   paris", 5, _fetcher(calls))
+    await cache.get_or_fetch("weather paris", 3, _fetcher(calls))
+    assert len(calls) == 2
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 2
+
+
+async def test_ttl_and_size_bound(monkeypatch):
+    cache = SearchCache(ttl_seconds=10, max_entries=2)
+    calls = []
+    for q in ("a", "b", "c"):
+        await cache.get_or_fetch(q, 5, _fetcher(calls))
+    assert cache.stats()["entries"] == 2 and cache.stats()["evictions"] == 1
+
+    real = search_service.time.monotonic
+    monkeypatch.setattr(search_service.time, "monotonic", lambda: real() + 11)
+    await cache.get_or_fetch("c", 5, _fetcher(calls))
+    assert len(calls) == 4
+
+
+async def test_concurrent_identical_lookups_share_one_fetch():
+    cache = SearchCache()
+    calls = []
+    results = await asyncio.gather(*[
+        cache.get_or_fetch("popular query", 5, _fetcher(calls, delay=0.01)) for _ in range(10)
+    ])
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    stats = cache.stats()
+    assert stats["misses"] == 1 and stats["coalesced"] == 9 and stats["in_flight"] == 0
+
+
+async def test_errors_propagate_to_waiters_and_are_not_cached():
+    cache = SearchCache()
+    calls = []
+    outcomes = await asyncio.gather(*[
+        cache.get_or_fetch("flaky", 5, _fetcher(calls, delay=0.01, error=RuntimeError("backend down")))
+        for _ in range(3)
+    ], return_exceptions=True)
+    assert len(calls) == 1
+    assert all(isinstance(o, RuntimeError) for o in outcomes)
+    assert cache.stats()["errors"] == 1
+
+    await cache.get_or_fetch("flaky", 5, _fetcher(calls))
+    assert len(calls) == 2
+
+
+async def test_cancelled_waiter_does_not_cancel_fetch():
+    cache = SearchCache()
+    calls = []
+    owner = asyncio.ensure_future(cache.get_or_fetch("q", 5, _fetcher(calls, delay=0.02)))
+    await asyncio.sleep(0)
+    waiter = asyncio.ensure_future(cache.get_or_fetch("q", 5, _fetcher(calls)))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert (await owner)[0]["url"] == "u"
+    assert len(calls) == 1
+
+
+async def test_cancelled_owner_does_not_cancel_followers():
+    """发起抓取的调用方（例如客户端断开后被取消的 agent 运行）被取消时，合并进来的其他调用方仍拿到结果"""
+    cache = SearchCache()
+    calls = []
+    owner = asyncio.ensure_future(cache.get_or_fetch("q", 5, _fetcher(calls, delay=0.02)))
+    await asyncio.sleep(0)
+    follower = asyncio.ensure_future(cache.get_or_fetch("q", 5, _fetcher(calls)))
+    await asyncio.sleep(0)
+    owner.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await owner
+    assert (await follower)[0]["url"] == "u"
+    assert len(calls) == 1
+    assert cache.stats()["errors"] == 0 and cache.stats()["in_flight"] == 0
+    await cache.get_or_fetch("q", 5, _fetcher(calls))  # the shared fetch still populated the cache
+    assert len(calls) == 1
+
+
+async def test_executor_does_not_block_event_loop_and_reuses_clients():
+    executor = search_service.SearchExecutor(max_concurrent=2, timeout=5)
+    created = []
+
+    class SlowClient:
+        def __init__(self):
+            created.append(self)
+
+        def text(self, query, max_results=5):
+            import time as _time
+            _time.sleep(0.05)  # blocking network call
+            return [{"title": query}]
+
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.005)
+            ticks += 1
+
+    tick_task = asyncio.ensure_future(ticker())
+    for i in range(4):
+        result = await executor.run(SlowClient, lambda c, i=i: c.text(f"q{i}"))
+        assert result == [{"title": f"q{i}"}]
+    tick_task.cancel()
+    executor.shutdown()
+
+    assert ticks >= 10  # the loop kept running while searches blocked in threads
+    assert len(created) <= 2  # at most one client per pool thread
+    stats = executor.stats()
+    assert stats["completed"] == 4 and stats["clients_created"] == len(created)
+    assert stats["latency"]["count"] == 4
+
+
+async def test_executor_caps_concurrency_and_enforces_deadline():
+    import threading
+    import time as _time
+
+    executor = search_service.SearchExecutor(max_concurrent=1, timeout=0.05)
+    release = threading.Event()
+
+    def blocked(_client):
+        release.wait(1)
+        return "late"
+
+    with pytest.raises(TimeoutError):
+        await executor.run(object, blocked)
+    # the timed-out search still holds the only slot, so the next call times out waiting for it
+    with pytest.raises(TimeoutError, match="free slot"):
+        await executor.run(object, lambda c: "fast")
+    release.set()
+    _time.sleep(0.01)
+    await asyncio.sleep(0.01)
+    assert await executor.run(object, lambda c: "fast") == "fast"
+    stats = executor.stats()
+    assert stats["timeouts"] == 2 and stats["in_flight"] == 0
+    executor.shutdown()
+
+
+def _backend(results, delay=0.0, error=None, log=None, name=None):
+    async def fetch(query, max_results):
+        if log is not None:
+            log.append(name)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return [{"title": r, "url": f"https://{r}", "snippet": ""} for r in results]
+
+    return fetch
+
+
+async def test_orchestrator_hedges_slow_primary_and_cancels_loser():
+    orchestrator = search_service.SearchOrchestrator(hedge_delay_ms=10, fanout=2)
+    log = []
+    results = await orchestrator.search("q", 5, [
+        ("slow", _backend(["a"], delay=0.5, log=log, name="slow")),
+        ("fast", _backend(["b"], delay=0.0, log=log, name="fast")),
+    ])
+    assert [r["title"] for r in results] == ["b"]
+    assert log == ["slow", "fast"]
+    stats = orchestrator.stats()
+    assert stats["hedged"] == 1
+    assert stats["backends"]["fast"]["wins"] == 1
+    assert stats["backends"]["slow"]["cancelled"] == 1
+    assert stats["backends"]["fast"]["latency"]["count"] == 1
+
+
+async def test_orchestrator_does_not_hedge_fast_primary():
+    orchestrator = search_service.SearchOrchestrator(hedge_delay_ms=200, fanout=3)
+    log = []
+    results = await orchestrator.search("q", 5, [
+        ("one", _backend(["a"], log=log, name="one")),
+        ("two", _backend(["b"], log=log, name="two")),
+    ])
+    assert [r["title"] for r in results] == ["a"]
+    assert log == ["one"]
+
+
+async def test_orchestrator_fails_over_immediately_and_merges_within_window():
+    orchestrator = search_service.SearchOrchestrator(hedge_delay_ms=1000, fanout=3, merge_window_ms=50)
+    results = await orchestrator.search("q", 3, [
+        ("broken", _backend([], error=RuntimeError("down"))),
+        ("empty", _backend([])),
+        ("good", _backend(["a", "b"])),
+    ])
+    assert [r["title"] for r in results] == ["a", "b"]
+
+    orchestrator = search_service.SearchOrchestrator(hedge_delay_ms=0, fanout=2, merge_window_ms=100)
+    results = await orchestrator.search("q", 3, [
+        ("first", _backend(["a", "b"])),
+        ("second", _backend(["b", "c", "d"], delay=0.01)),
+    ])
+    assert [r["title"] for r in results] == ["a", "b", "c"]
+
+
+async def test_orchestrator_raises_when_all_backends_fail():
+    orchestrator = search_service.SearchOrchestrator(hedge_delay_ms=0, fanout=2)
+    with pytest.raises(RuntimeError, match="second"):
+        await orchestrator.search("q", 5, [
+            ("a", _backend([], error=RuntimeError("first"))),
+            ("b", _backend([], delay=0.01, error=RuntimeError("second"))),
+        ])
+    assert orchestrator.stats()["backends"]["a"]["errors"] == 1
+
+
+def test_truncate_at_sentence():
+    text = "First sentence here. Second sentence is longer than the rest. Third."
+    assert search_service.truncate_at_sentence(text, 30) == "First sentence here."
+    assert search_service.truncate_at_sentence(text, 200) == text
+    cut = search_service.truncate_at_sentence("no sentence boundary in this long piece of text", 20)
+    assert cut.endswith("…") and len(cut) <= 20
+    assert search_service.truncate_at_sentence("第一句话。第二句话比较长一些。", 8) == "第一句话。"
+
+
+def test_shaper_dedupes_ranks_and_caps():
+    shaper = search_service.ResultShaper(max_results=3, snippet_chars=100, max_chars=0)
+    results = [
+        {"title": "Cooking pasta", "url": "https://food.example/pasta", "snippet": "How to cook pasta well."},
+        {"title": "Oslo weather today", "url": "https://www.weather.example/oslo/", "snippet": "Rain in Oslo."},
+        {"title": "Oslo weather", "url": "http://weather.example/oslo#now", "snippet": "Duplicate by URL."},
+        {"title": "Mirror", "url": "https://mirror.example/pasta", "snippet": "How to cook pasta well!"},
+        {"title": "Norway news", "url": "https://news.example", "snippet": "Weather warnings for Norway."},
+        {"title": "Misc", "url": "https://misc.example", "snippet": "Unrelated."},
+    ]
+    text = shaper.shape("oslo weather today", results, max_results=50)
+    blocks = text.split("\n\n")
+    assert len(blocks) == 3
+    assert blocks[0].startswith("标题: Oslo weather today")
+    assert "Duplicate by URL" not in text and "Mirror" not in text
+    assert blocks[1].startswith("标题: Norway news")
+    assert shaper.cap(50) == 3 and shaper.cap(2) == 2
+    stats = shaper.stats()
+    assert stats["results_in"] == 6 and stats["results_out"] == 3
+
+
+def test_shaper_enforces_char_and_token_budget():
+    long_snippet = "This sentence talks about the query topic. " * 20
+    results = [{"title": f"T{i}", "url": f"https://e{i}.example", "snippet": f"{i} {long_snippet}"} for i in range(5)]
+
+    shaper = search_service.ResultShaper(max_results=5, snippet_chars=200, max_chars=500)
+    text = shaper.shape("query topic", results, 5)
+    assert 0 < len(text) <= 500
+    assert text.count("标题:") >= 2
+    for block in text.split("\n\n"):
+        snippet = block.split("摘要: ", 1)[1]
+        assert len(snippet) <= 200 and snippet.endswith(".")
+
+    shaper = search_service.ResultShaper(max_results=5, snippet_chars=200, max_chars=0, max_tokens=120)
+    text = shaper.shape("query topic", results, 5)
+    assert search_service.estimate_tokens(text) <= 120
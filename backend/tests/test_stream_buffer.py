@@ -0,0 +1,122 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for the resumable SSE ring buffers (src.services.stream_buffer).
+"""
+
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from src.services.stream_buffer import ReplayGap, StreamBufferRegistry
+
+
+def _producer(registry, frames, delay=0.0, started=None):
+    async def produce(buffer):
+        if started is not None:
+            started.append(buffer)
+        for frame in frames:
+            registry.append(buffer, frame)
+            await asyncio.sleep(delay)
+    return produce
+
+
+async def test_late_subscriber_gets_prefix_then_live_tail():
+    registry = StreamBufferRegistry(grace_seconds=1, ttl_seconds=1)
+    buffer = registry.start(1, "u", _producer(registry, ["a", "b", "c", "d"], delay=0.01))
+    await asyncio.sleep(0.015)
+    events = [e async for e in registry.subscribe(buffer)]
+    assert [d for _, d in events] == ["a", "b", "c", "d"]
+    assert events[0][0] == f"{buffer.key}:1"
+    assert registry.parse_event_id(events[2][0]) == (buffer.key, 3)
+
+    resumed = [d async for _, d in registry.subscribe(buffer, after=2, resume=True)]
+    assert resumed == ["c", "d"]
+    assert registry.stats()["replayed_frames"] == 2
+
+
+async def test_ring_buffer_evicts_oldest_frames():
+    registry = StreamBufferRegistry(max_frames_per_turn=3, ttl_seconds=1)
+    buffer = registry.start(1, "u", _producer(registry, ["1", "2", "3", "4", "5"]))
+    await buffer.producer
+    assert buffer.first_seq == 3 and registry.bytes == 3
+    assert [d async for _, d in registry.subscribe(buffer, after=2)] == ["3", "4", "5"]
+    assert not buffer.can_replay(1)
+    with pytest.raises(ReplayGap):
+        [e async for e in registry.subscribe(buffer, after=1)]
+
+
+async def test_memory_cap_evicts_finished_buffers_first():
+    registry = StreamBufferRegistry(max_bytes=10, ttl_seconds=60)
+    done = registry.start(1, "u", _producer(registry, ["xxxxxx"]))
+    await done.producer
+    live = registry.start(2, "u", _producer(registry, ["yyyyyy", "zzzzzz"]))
+    await live.producer
+    assert registry.get(done.key) is None
+    assert registry.bytes <= 10 and live.first_seq == 2
+    assert registry.stats()["evicted_buffers"] == 1
+
+
+async def test_unattended_generation_is_cancelled_after_grace():
+    registry = StreamBufferRegistry(grace_seconds=0.02, ttl_seconds=0)
+    buffer = registry.start(1, "u", _producer(registry, ["a"] * 100, delay=0.01))
+    async for _ in registry.subscribe(buffer):
+        break  # the client goes away after the first frame
+    await asyncio.sleep(0.1)
+    assert buffer.producer.cancelled() and buffer.done
+    assert registry.stats()["abandoned"] == 1
+    assert registry.get(buffer.key) is None  # ttl 0: dropped right away
+
+
+async def test_reattaching_within_grace_keeps_generation_alive():
+    registry = StreamBufferRegistry(grace_seconds=0.05, ttl_seconds=1)
+    buffer = registry.start(1, "u", _producer(registry, ["a", "b", "c"], delay=0.02))
+    async for seq_id, _ in registry.subscribe(buffer):
+        last = seq_id
+        break
+    await asyncio.sleep(0.02)
+    _, seq = registry.parse_event_id(last)
+    rest = [d async for _, d in registry.subscribe(buffer, after=seq, resume=True)]
+    assert rest == ["b", "c"] and not buffer.producer.cancelled()
+
+
+async def test_finished_buffers_expire_after_ttl(monkeypatch):
+    import src.services.stream_buffer as module
+    registry = StreamBufferRegistry(ttl_seconds=10)
+    buffer = registry.start(1, "u", _producer(registry, ["a"]))
+    await buffer.producer
+    assert registry.get(buffer.key) is buffer
+    real = module.time.monotonic
+    monkeypatch.setattr(module.time, "monotonic", lambda: real() + 11)
+    assert registry.get(buffer.key) is None and registry.bytes == 0
+
+
+def test_fanout_key_policy():
+    single = [{"role": "user", "content": "Hello"}]
+    multi = [{"role": "assistant", "content": "hi"}, {"role": "user", "content": "Hello"}]
+    registry = StreamBufferRegistry()
+    assert registry.fanout_key(single, "m", "sys") == registry.fanout_key([{"role": "user", "content": " Hello "}], "m", "sys")
+    assert registry.fanout_key(single, "m", "sys") != registry.fanout_key(single, "other", "sys")
+    assert registry.fanout_key(multi, "m", "sys") is None
+    assert registry.fanout_key(single, "m", "sys", uses_tools=True) is None
+    assert StreamBufferRegistry(fanout_single_turn_only=False).fanout_key(multi, "m", "sys") is not None
+    assert StreamBufferRegistry(fanout_enabled=False).fanout_key(single, "m", "sys") is None
+
+
+async def test_inflight_generation_is_shared_and_counted():
+    registry = StreamBufferRegistry(ttl_seconds=1)
+    origin = registry.start(1, "u", _producer(registry, ["a", "b", "c"], delay=0.01), context_key="k")
+    await asyncio.sleep(0.015)
+    assert registry.find_inflight("k") is origin and registry.find_inflight("other") is None
+    joined = [d async for _, d in registry.subscribe(origin, fanout=True)]
+    assert joined == ["a", "b", "c"]
+    assert registry.find_inflight("k") is None  # finished generations are not joined
+    fanout = registry.stats()["fanout"]
+    assert fanout["joins"] == 1 and fanout["shared_streams"] == 1
+    assert fanout["recent"] == [{"turn": origin.key, "subscribers": 2}]
@@ -0,0 +1,134 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for SSE delta coalescing (src.services.stream_coalescer).
+"""
+
+import asyncio
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from src.services.stream_coalescer import CoalesceStats, StreamCoalescer
+
+
+async def _source(items, gap=0.0):
+    for item in items:
+        if gap:
+            await asyncio.sleep(gap)
+        yield item
+
+
+async def _collect(coalescer, source):
+    return [frame async for frame in coalescer.coalesce(source)]
+
+
+async def test_first_delta_flushed_then_merged():
+    stats = CoalesceStats()
+    coalescer = StreamCoalescer(max_latency_ms=1000, max_bytes=4096, stats=stats)
+    frames = await _collect(coalescer, _source(["He", "l", "lo", "", " wor", "ld"]))
+
+    assert frames == ["He", "llo world"]
+    snap = stats.snapshot()
+    assert snap["deltas"] == 5
+    assert snap["frames"] == 2
+    assert snap["frames_per_stream"] == 2
+    assert snap["flush_reasons"]["first"] == 1
+    assert snap["flush_reasons"]["end"] == 1
+
+
+async def test_byte_window_flushes():
+    stats = CoalesceStats()
+    coalescer = StreamCoalescer(max_latency_ms=1000, max_bytes=4, stats=stats)
+    frames = await _collect(coalescer, _source(["a", "bb", "cc", "d", "中"]))
+
+    assert frames == ["a", "bbcc", "d中"]
+    assert "".join(frames) == "abbccd中"
+    assert stats.flush_bytes == 2
+
+
+async def test_latency_window_flushes_while_upstream_is_slow():
+    stats = CoalesceStats()
+    coalescer = StreamCoalescer(max_latency_ms=10, max_bytes=4096, stats=stats)
+
+    async def slow():
+        yield "first"
+        yield "a"
+        yield "b"
+        await asyncio.sleep(0.1)
+        yield "c"
+
+    frames = await _collect(coalescer, slow())
+    assert frames == ["first", "ab", "c"]
+    assert stats.flush_latency == 1
+
+
+async def test_zero_latency_passes_through():
+    coalescer = StreamCoalescer(max_latency_ms=0)
+    assert await _collect(coalescer, _source(["a", "b", "c"])) == ["a", "b", "c"]
+
+
+async def test_upstream_error_propagates_after_first_frame():
+    async def failing():
+        yield "ok"
+        yield "buffered"
+        raise RuntimeError("boom")
+
+    coalescer = StreamCoalescer(max_latency_ms=1000)
+    frames = []
+    try:
+        async for frame in coalescer.coalesce(failing()):
+            frames.append(frame)
+    except RuntimeError as e:
+        assert str(e) == "boom"
+    else:
+        raise AssertionError("error was swallowed")
+    assert frames == ["ok", "buffered"]
+
+
+async def test_real_agent_stream_is_iterated_in_one_task(real_pydantic_ai):
+    """pydantic-ai 的 run_stream 在同一任务中进入 / 退出 anyio cancel scope；按时间 flush 不能把上游拆到多个任务里"""
+
+    async def stream_function(messages, info):
+        for word in ["Hel", "lo", " wor", "ld"]:
+            await asyncio.sleep(0.005)
+            yield word
+
+    agent = real_pydantic_ai.Agent(real_pydantic_ai.FunctionModel(stream_function=stream_function))
+
+    async def answer():
+        async with agent.run_stream("hi") as result:
+            async for delta in result.stream_text(delta=True, debounce_by=None):
+                yield delta
+
+    coalescer = StreamCoalescer(max_latency_ms=30)
+    frames = await _collect(coalescer, answer())
+    assert frames[0] == "Hel"
+    assert "".join(frames) == "Hello world"
+
+    # 下游提前关闭时上游在它自己的任务中被取消，同样不能报错
+    stream = coalescer.coalesce(answer())
+    assert await stream.__anext__() == "Hel"
+    await stream.aclose()
+
+
+async def test_downstream_close_cancels_upstream():
+    closed = []
+
+    async def endless():
+        try:
+            yield "first"
+            while True:
+                await asyncio.sleep(0.01)
+                yield "x"
+        finally:
+            closed.append(True)
+
+    stream = StreamCoalescer(max_latency_ms=5).coalesce(endless())
+    assert await stream.__anext__() == "first"
+    await stream.__anext__()
+    await stream.aclose()
+    assert closed == [True]
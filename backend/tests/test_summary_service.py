@@ -0,0 +1,107 @@
+# @Home    : www.pi-apple.com
+# @Author  : Leon
+# @Email   : pi.apple.lab@gmail.com
+"""
+Tests for rolling conversation summaries (src.services.summary_service) and the
+summary-aware context loader.
+"""
+
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-api-key")
+os.environ.setdefault("OPENAI_BASE_URL", "https://api.test-openai.local")
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.db.base import Base
+from src.models.conversation import Conversation
+from src.models.conversation_summary import ConversationSummary  # noqa: F401 - register mappers
+from src.models.message import Message
+from src.models.user import User  # noqa: F401
+from src.crud.crud_summary import async_get_summary, async_save_summary
+from src.services.context_service import load_conversation_context
+from src.services.summary_service import SummaryService
+
+
+@pytest.fixture
+async def session_scope():
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    factory = async_sessionmaker(bind=engine, expire_on_commit=False)
+    async with factory() as db:
+        db.add(Conversation(id=1, user_id=1))
+        db.add_all([Message(conversation_id=1, role="user", content=f"m{i}") for i in range(1, 21)])
+        await db.commit()
+
+    @asynccontextmanager
+    async def scope():
+        async with factory() as db:
+            yield db
+
+    yield scope
+    await engine.dispose()
+
+
+async def test_refresh_folds_old_messages_and_advances_watermark(session_scope):
+    folded = []
+
+    async def fake_summarize(previous, messages):
+        folded.append([c for _, _, c in messages])
+        return f"{previous}+{len(messages)}"
+
+    service = SummaryService(summarize=fake_summarize, session_scope=session_scope,
+                             trigger_messages=10, keep_recent=5)
+    assert await service.refresh(1)
+    assert folded[0] == [f"m{i}" for i in range(1, 16)]
+
+    async with session_scope() as db:
+        assert await async_get_summary(db, 1) == ("+15", 15, 1)
+        history = await load_conversation_context(db, 1)
+    # summary first, then only the tail after the watermark
+    assert history[0] == {"role": "system", "content": "+15"}
+    assert [m["content"] for m in history[1:]] == [f"m{i}" for i in range(16, 21)]
+
+    # not enough new messages since the watermark -> no new version
+    assert not await service.refresh(1)
+
+
+async def test_stale_version_is_rejected(session_scope):
+    async with session_scope() as db:
+        assert await async_save_summary(db, 1, "v1", 3, expected_version=0)
+        assert await async_save_summary(db, 1, "v2", 5, expected_version=1)
+        assert not await async_save_summary(db, 1, "stale", 9, expected_version=1)
+        assert await async_get_summary(db, 1) == ("v2", 5, 2)
+
+
+async def test_schedule_runs_in_background_and_coalesces(session_scope):
+    started = asyncio.Event()
+    release = asyncio.Event()
+    calls = []
+
+    async def slow_summarize(previous, messages):
+        calls.append(len(messages))
+        started.set()
+        await release.wait()
+        return "summary"
+
+    service = SummaryService(summarize=slow_summarize, session_scope=session_scope,
+                             trigger_messages=10, keep_recent=5)
+    task = service.schedule(1)
+    await started.wait()
+    # a second turn finishing while the summary is regenerating neither blocks nor starts a duplicate
+    assert service.schedule(1) is task
+    release.set()
+    await task
+    assert service.stats()["updates"] == 1
+    assert calls == [15]  # the rerun found nothing new to fold
+
+
+def test_disabled_service_does_nothing():
+    service = SummaryService(enabled=False)
+    assert service.schedule(1) is None